@@ -9,15 +9,21 @@ from admin_config import (
     LOG_TABLE_NAME,
     SERVICE_HEALTH_TABLE_NAME,
     STG_CARDS_LIST_TABLE_NAME,
+    STG_CARDS_SYNC_CURSOR_TABLE_NAME,
     STG_NM_REPORT_DETAIL_INFO_TABLE_NAME,
     STG_NM_REPORT_DETAIL_TABLE_NAME,
+    STG_NM_REPORT_QUEUE_TABLE_NAME,
     STG_FACT_STOCK_TABLE_NAME,
+    STG_FACT_STOCK_LOAD_INFO_TABLE_NAME,
     STG_FACT_SALES_INFO_TABLE_NAME,
     STG_FACT_SALES_TABLE_NAME,
     STG_ADVERT_TYPE_MAPPING_TABLE_NAME,
     STG_ADVERT_INFO_TABLE_NAME,
     STG_ADVERT_LOAD_INFO_TABLE_NAME,
+    STG_ADVERT_LOAD_PROGRESS_TABLE_NAME,
     STG_ADVERT_STAT_TABLE_NAME,
+    STG_STORE_PROGRESS_TABLE_NAME,
+    STG_RAW_RESPONSE_TABLE_NAME,
     DIM_TECH_LIST_TABLE_NAME,
 )
 
@@ -145,7 +151,10 @@ def create_cards_list(
         store_id INTEGER NOT NULL,
         vendor_code TEXT NOT NULL,
         title TEXT NOT NULL,
-        created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+
+        -- Уникальное ограничение для работы ON CONFLICT
+        CONSTRAINT uniq_cards_list_record UNIQUE (store_id, nm_id)
     );
     
     -- Индексы для ускорения поиска
@@ -160,6 +169,80 @@ def create_cards_list(
         return f"Error while creating product table: {str(e)}"
 
 
+def add_cards_list_unique_constraint(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_CARDS_LIST_TABLE_NAME,
+):
+    """Для уже созданной таблицы: удаляет дубли и добавляет UNIQUE (store_id, nm_id)"""
+    db_handler = AdminDBHandler()
+    query = f"""
+    DELETE FROM {schema_name}.{table_name} t
+    USING {schema_name}.{table_name} d
+    WHERE t.store_id = d.store_id
+    AND t.nm_id = d.nm_id
+    AND t.id < d.id;
+
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_constraint
+            WHERE conname = 'uniq_cards_list_record'
+        ) THEN
+            ALTER TABLE {schema_name}.{table_name}
+            ADD CONSTRAINT uniq_cards_list_record UNIQUE (store_id, nm_id);
+        END IF;
+    END $$;
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"Unique constraint added to {schema_name}.{table_name}."
+    except Exception as e:
+        return f"Error while adding unique constraint: {str(e)}"
+
+
+def create_cards_sync_cursor_table(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_CARDS_SYNC_CURSOR_TABLE_NAME,
+):
+    db_handler = AdminDBHandler()
+    query = f"""
+    CREATE TABLE IF NOT EXISTS {schema_name}.{table_name} (
+        store_id INTEGER PRIMARY KEY,
+        updated_at TEXT,  -- cursor.updatedAt последней полученной карточки, как его вернул WB
+        nm_id BIGINT,  -- cursor.nmID последней полученной карточки
+        synced_at TIMESTAMPTZ,  -- время последней синхронизации (дошли до конца списка)
+        full_sync_started_at TIMESTAMPTZ,  -- начало идущего полного прохода с начала списка
+        full_synced_at TIMESTAMPTZ  -- конец последнего полного прохода (удалённые карточки убраны)
+    );
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"Cards sync cursor table {schema_name}.{table_name} created successfully."
+    except Exception as e:
+        return f"Error while creating cards sync cursor table: {str(e)}"
+
+
+def add_cards_sync_full_pass_columns(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_CARDS_SYNC_CURSOR_TABLE_NAME,
+):
+    """Для уже созданной таблицы курсора: колонки полного прохода"""
+    db_handler = AdminDBHandler()
+    query = f"""
+    ALTER TABLE {schema_name}.{table_name}
+    ADD COLUMN IF NOT EXISTS full_sync_started_at TIMESTAMPTZ,
+    ADD COLUMN IF NOT EXISTS full_synced_at TIMESTAMPTZ;
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"Full pass columns added to {schema_name}.{table_name}."
+    except Exception as e:
+        return f"Error while adding full pass columns: {str(e)}"
+
+
 def create_nm_report_detail_info_table(
     schema_name=STG_SCHEMA_NAME,
     table_name=STG_NM_REPORT_DETAIL_INFO_TABLE_NAME,
@@ -226,6 +309,110 @@ def create_nm_report_detail_table(
         return f"Error while creating detail report table: {str(e)}"
 
 
+def create_nm_report_queue_table(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_NM_REPORT_QUEUE_TABLE_NAME,
+):
+    db_handler = AdminDBHandler()
+    query = f"""
+    CREATE TABLE IF NOT EXISTS {schema_name}.{table_name} (
+        store_id INTEGER NOT NULL,
+        fact_date DATE NOT NULL,
+        page INTEGER NOT NULL DEFAULT 1,  -- следующая страница к загрузке
+        status TEXT NOT NULL DEFAULT 'pending',  -- pending / claimed / done
+        strategy TEXT NOT NULL DEFAULT 'detail',  -- detail / history, см. NmReportStrategy воркера
+        history_nm_id BIGINT NOT NULL DEFAULT 0,  -- последний загруженный nmID стратегии history
+        refresh_started_at TIMESTAMPTZ,  -- начало обновления загруженной даты (строки не удаляются)
+        claimed_by TEXT,
+        lease_until TIMESTAMPTZ,
+        updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (store_id, fact_date)
+    );
+
+    -- выборка свободных элементов - по незавершённым строкам
+    CREATE INDEX IF NOT EXISTS idx_nm_report_queue_unfinished
+    ON {schema_name}.{table_name} (store_id, fact_date)
+    WHERE status <> 'done';
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"NM Report queue table {schema_name}.{table_name} created successfully."
+    except Exception as e:
+        return f"Error while creating NM Report queue table: {str(e)}"
+
+
+def add_nm_report_queue_strategy_column(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_NM_REPORT_QUEUE_TABLE_NAME,
+):
+    """Для уже созданной очереди: колонка strategy"""
+    db_handler = AdminDBHandler()
+    query = f"""
+    ALTER TABLE {schema_name}.{table_name}
+    ADD COLUMN IF NOT EXISTS strategy TEXT NOT NULL DEFAULT 'detail';
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"Column strategy added to {schema_name}.{table_name}."
+    except Exception as e:
+        return f"Error while adding strategy column: {str(e)}"
+
+
+def add_nm_report_queue_refresh_column(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_NM_REPORT_QUEUE_TABLE_NAME,
+):
+    """Для уже созданной очереди: колонка refresh_started_at"""
+    db_handler = AdminDBHandler()
+    query = f"""
+    ALTER TABLE {schema_name}.{table_name}
+    ADD COLUMN IF NOT EXISTS refresh_started_at TIMESTAMPTZ;
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"Column refresh_started_at added to {schema_name}.{table_name}."
+    except Exception as e:
+        return f"Error while adding refresh_started_at column: {str(e)}"
+
+
+def add_nm_report_queue_history_nm_id_column(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_NM_REPORT_QUEUE_TABLE_NAME,
+):
+    """
+    Для уже созданной очереди: колонка history_nm_id. Начатые по номеру пачки
+    даты history начинаются заново (page сбрасывается, строки не удаляются).
+    """
+    db_handler = AdminDBHandler()
+    query = f"""
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = '{schema_name}'
+            AND table_name = '{table_name}'
+            AND column_name = 'history_nm_id'
+        ) THEN
+            ALTER TABLE {schema_name}.{table_name}
+            ADD COLUMN history_nm_id BIGINT NOT NULL DEFAULT 0;
+
+            UPDATE {schema_name}.{table_name}
+            SET page = 1
+            WHERE strategy = 'history' AND status <> 'done';
+        END IF;
+    END $$;
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"Column history_nm_id added to {schema_name}.{table_name}."
+    except Exception as e:
+        return f"Error while adding history_nm_id column: {str(e)}"
+
+
 def create_stock_table(
     schema_name=STG_SCHEMA_NAME,
     table_name=STG_FACT_STOCK_TABLE_NAME,
@@ -240,7 +427,10 @@ def create_stock_table(
         stock_count INTEGER,
         to_client_count INTEGER,
         from_client_count INTEGER,
-        created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+
+        -- Уникальное ограничение для работы ON CONFLICT
+        CONSTRAINT uniq_fact_stock_record UNIQUE (date, store_id, nm_id)
     );
 
     -- Индексы для ускорения выборок
@@ -256,6 +446,62 @@ def create_stock_table(
         return f"Error while creating stock report table: {str(e)}"
 
 
+def create_stock_load_info_table(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_FACT_STOCK_LOAD_INFO_TABLE_NAME,
+):
+    db_handler = AdminDBHandler()
+    query = f"""
+    CREATE TABLE IF NOT EXISTS {schema_name}.{table_name} (
+        store_id INTEGER NOT NULL,
+        date DATE NOT NULL,
+        page_offset INTEGER NOT NULL DEFAULT 0,  -- смещение следующей страницы
+        loaded BOOLEAN NOT NULL DEFAULT FALSE,
+        updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (store_id, date)
+    );
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"Stock load info table {schema_name}.{table_name} created successfully."
+    except Exception as e:
+        return f"Error while creating stock load info table: {str(e)}"
+
+
+def add_stock_unique_constraint(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_FACT_STOCK_TABLE_NAME,
+):
+    """Для уже созданной таблицы: удаляет дубли и добавляет UNIQUE (date, store_id, nm_id)"""
+    db_handler = AdminDBHandler()
+    query = f"""
+    DELETE FROM {schema_name}.{table_name} t
+    USING {schema_name}.{table_name} d
+    WHERE t.date = d.date
+    AND t.store_id = d.store_id
+    AND t.nm_id = d.nm_id
+    AND t.id < d.id;
+
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_constraint
+            WHERE conname = 'uniq_fact_stock_record'
+        ) THEN
+            ALTER TABLE {schema_name}.{table_name}
+            ADD CONSTRAINT uniq_fact_stock_record UNIQUE (date, store_id, nm_id);
+        END IF;
+    END $$;
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"Unique constraint added to {schema_name}.{table_name}."
+    except Exception as e:
+        return f"Error while adding unique constraint: {str(e)}"
+
+
 def create_fact_sales_info_table(
     schema_name=STG_SCHEMA_NAME,
     table_name=STG_FACT_SALES_INFO_TABLE_NAME,
@@ -384,7 +630,9 @@ def create_advert_load_info_table(
         advert_id INTEGER,
         date DATE,
         loaded BOOLEAN,
-        created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        loaded_at TIMESTAMPTZ,  -- когда день был загружен; до конца дня статистика неполная
+        created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+        CONSTRAINT uniq_advert_load_info_record UNIQUE (store_id, advert_id, date)
     );
 
     -- Индексы для ускорения запросов
@@ -400,6 +648,164 @@ def create_advert_load_info_table(
         return f"Error while creating advert info table: {str(e)}"
 
 
+def add_advert_load_info_unique_constraint(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_ADVERT_LOAD_INFO_TABLE_NAME,
+):
+    """
+    Для уже созданной таблицы: добавляет loaded_at, удаляет дубли
+    (оставляя загруженную запись) и добавляет UNIQUE (store_id, advert_id, date)
+    """
+    db_handler = AdminDBHandler()
+    query = f"""
+    ALTER TABLE {schema_name}.{table_name}
+    ADD COLUMN IF NOT EXISTS loaded_at TIMESTAMPTZ;
+
+    DELETE FROM {schema_name}.{table_name} t
+    USING {schema_name}.{table_name} d
+    WHERE t.store_id = d.store_id
+    AND t.advert_id = d.advert_id
+    AND t.date = d.date
+    AND (t.loaded, t.ctid) < (d.loaded, d.ctid);
+
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_constraint
+            WHERE conname = 'uniq_advert_load_info_record'
+        ) THEN
+            ALTER TABLE {schema_name}.{table_name}
+            ADD CONSTRAINT uniq_advert_load_info_record UNIQUE (store_id, advert_id, date);
+        END IF;
+    END $$;
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"Unique constraint added to {schema_name}.{table_name}."
+    except Exception as e:
+        return f"Error while adding unique constraint: {str(e)}"
+
+
+def create_advert_load_progress_table(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_ADVERT_LOAD_PROGRESS_TABLE_NAME,
+):
+    """Прогресс загрузки fullstats диапазонами дат (datemultirange, PostgreSQL 14+)"""
+    db_handler = AdminDBHandler()
+    query = f"""
+    CREATE TABLE IF NOT EXISTS {schema_name}.{table_name} (
+        store_id INTEGER NOT NULL,
+        advert_id INTEGER NOT NULL,
+        loaded DATEMULTIRANGE NOT NULL DEFAULT '{{}}',  -- загруженные завершившиеся дни
+        fresh DATEMULTIRANGE NOT NULL DEFAULT '{{}}',  -- дни, загруженные до своего окончания
+        fresh_loaded_at TIMESTAMPTZ,
+        updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (store_id, advert_id)
+    );
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"Advert load progress table {schema_name}.{table_name} created successfully."
+    except Exception as e:
+        return f"Error while creating advert load progress table: {str(e)}"
+
+
+def migrate_advert_load_info_to_progress(
+    schema_name=STG_SCHEMA_NAME,
+    source_table_name=STG_ADVERT_LOAD_INFO_TABLE_NAME,
+    table_name=STG_ADVERT_LOAD_PROGRESS_TABLE_NAME,
+):
+    """
+    Переносит флаги loaded из построчной таблицы в диапазоны.
+    Дни, загруженные до своего окончания, не переносятся и будут загружены заново.
+    loaded_at добавляется, если add_advert_load_info_unique_constraint не запускался.
+    """
+    db_handler = AdminDBHandler()
+    query = f"""
+    ALTER TABLE {schema_name}.{source_table_name}
+    ADD COLUMN IF NOT EXISTS loaded_at TIMESTAMPTZ;
+
+    INSERT INTO {schema_name}.{table_name} (store_id, advert_id, loaded)
+    SELECT
+        store_id,
+        advert_id,
+        COALESCE(
+            range_agg(daterange(date, date, '[]')) FILTER (
+                WHERE loaded AND (loaded_at IS NULL OR loaded_at >= date + INTERVAL '1 day')
+            ),
+            '{{}}'
+        )
+    FROM {schema_name}.{source_table_name}
+    GROUP BY store_id, advert_id
+    ON CONFLICT (store_id, advert_id) DO NOTHING;
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"Advert load info migrated to {schema_name}.{table_name}."
+    except Exception as e:
+        return f"Error while migrating advert load info: {str(e)}"
+
+
+def create_store_progress_table(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_STORE_PROGRESS_TABLE_NAME,
+):
+    db_handler = AdminDBHandler()
+    query = f"""
+    CREATE TABLE IF NOT EXISTS {schema_name}.{table_name} (
+        store_id INTEGER NOT NULL,
+        source TEXT NOT NULL,  -- ProgressSource воркера: advert_list, advert_info, advert_stat
+        total BIGINT NOT NULL DEFAULT 0,
+        done BIGINT NOT NULL DEFAULT 0,
+        refreshed_at TIMESTAMPTZ,  -- последняя загрузка
+        checked_at TIMESTAMPTZ,  -- последняя сверка с полным агрегатом
+        PRIMARY KEY (store_id, source)
+    );
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"Store progress table {schema_name}.{table_name} created successfully."
+    except Exception as e:
+        return f"Error while creating store progress table: {str(e)}"
+
+
+def create_raw_response_table(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_RAW_RESPONSE_TABLE_NAME,
+):
+    """Сырые ответы WB API для RAW_RESPONSE_STORE=postgres (тело - zstd)"""
+    db_handler = AdminDBHandler()
+    query = f"""
+    CREATE TABLE IF NOT EXISTS {schema_name}.{table_name} (
+        id BIGSERIAL PRIMARY KEY,
+        store_id INTEGER NOT NULL,
+        endpoint TEXT NOT NULL,  -- путь url, например /adv/v2/fullstats
+        request_hash TEXT NOT NULL,  -- sha256 метода, url, параметров и тела запроса
+        request JSONB NOT NULL,
+        content_hash TEXT NOT NULL,  -- sha256 несжатого тела
+        status_code INTEGER NOT NULL,
+        fetched_at TIMESTAMPTZ NOT NULL,
+        body BYTEA NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS {table_name}_request_idx
+    ON {schema_name}.{table_name} (store_id, endpoint, request_hash, fetched_at DESC);
+
+    CREATE INDEX IF NOT EXISTS {table_name}_fetched_at_idx
+    ON {schema_name}.{table_name} (fetched_at);
+    """
+
+    try:
+        db_handler.execute_query(query)
+        return f"Raw response table {schema_name}.{table_name} created successfully."
+    except Exception as e:
+        return f"Error while creating raw response table: {str(e)}"
+
+
 def create_advert_stat_table(
     schema_name=STG_SCHEMA_NAME,
     table_name=STG_ADVERT_STAT_TABLE_NAME,
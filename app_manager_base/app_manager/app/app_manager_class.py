@@ -6,6 +6,7 @@ from app.app_manager_public_config import (
     STORE_TABLE_NAME,
     STORE_PROCESS_TABLE_NAME,
     SERVICE_HEALTH_TABLE_NAME,
+    LOG_TABLE_NAME,
 )
 
 from app.google_sheet_uploader import GoogleSheetUploader
@@ -14,6 +15,7 @@ from app.app_manager_sql_former import (insert_query)
 
 from app.app_manager_db_hanler import AppManagerDBHandler
 from app.app_manager_logger import AppManagerLogger
+from wb_shared.log_buffer import BufferedLogWriter
 
 DATA_LOAD_SCHEDUAL = '6 hours 15 minutes'
 DIM_ETL_SCHEDUAL = '6 hours 15 minutes'
@@ -32,7 +34,16 @@ class AppManager:
 
     def __init__(self):
         self.db_handler = AppManagerDBHandler()
-        self.logger = AppManagerLogger(self.db_handler, "app_manager")
+        self.log_writer = BufferedLogWriter(
+            db_handler_factory=AppManagerDBHandler,
+            schema_name=CORE_SCHEMA_NAME,
+            table_name=LOG_TABLE_NAME,
+        )
+        self.logger = AppManagerLogger(
+            self.db_handler,
+            "app_manager",
+            log_writer=self.log_writer,
+        )
         self.google_shet_uploader = GoogleSheetUploader(
             credentials_file="credentials.json",
             sheet_name="tech_list",
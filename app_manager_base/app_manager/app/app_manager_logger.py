@@ -4,6 +4,7 @@ from typing import Optional, Dict, Any
 from datetime import datetime
 
 from app.app_manager_db_hanler import AppManagerDBHandler
+from wb_shared.log_buffer import BufferedLogWriter
 from app.app_manager_public_config import (CORE_SCHEMA_NAME, LOG_TABLE_NAME)
 
 
@@ -13,12 +14,14 @@ class AppManagerLogger:
                  db_handler: AppManagerDBHandler,
                  app_manager: str,
                  schema_name: str = CORE_SCHEMA_NAME,
-                 table_name: str = LOG_TABLE_NAME):
+                 table_name: str = LOG_TABLE_NAME,
+                 log_writer: BufferedLogWriter = None):
 
         self.db_handler = db_handler
         self.schema_name = schema_name
         self.table_name = table_name
         self.app_manager = app_manager
+        self.log_writer = log_writer
 
     def log(
         self,
@@ -39,6 +42,16 @@ class AppManagerLogger:
 
         print(f"[{level.upper()} ({source})] {message}")
 
+        if self.log_writer:
+            return self.log_writer.write(
+                level=level,
+                service=self.app_manager,
+                source=source,
+                message=message,
+                store_id=store_id,
+                metadata=metadata,
+            )
+
         try:
             metadata_json = json.dumps(metadata) if metadata else None
             self.db_handler.execute_query(
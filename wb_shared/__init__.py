@@ -0,0 +1,4 @@
+"""
+Общий код сервисов worker и app_manager. В образы копируется в /opt/shared
+(PYTHONPATH); при локальном запуске из каталога сервиса - PYTHONPATH=../..
+"""
@@ -0,0 +1,201 @@
+import atexit
+import json
+import os
+import queue
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from enum import Enum
+from io import StringIO
+from typing import Any, Callable, Dict, Optional
+
+from wb_shared.copy_text import copy_text_value
+
+LOG_BUFFER_MAX_SIZE = int(os.getenv("LOG_BUFFER_MAX_SIZE", 10000))
+LOG_FLUSH_INTERVAL_SECONDS = float(os.getenv("LOG_FLUSH_INTERVAL_SECONDS", 2))
+LOG_FLUSH_BATCH_SIZE = 2000
+
+LOG_COLUMNS = (
+    "log_level",
+    "service",
+    "store_id",
+    "source",
+    "message",
+    "metadata",
+    "created_at",
+)
+
+
+class LogOverflowPolicy(Enum):
+    DROP = "drop"
+    AGGREGATE = "aggregate"
+
+
+LOG_OVERFLOW_POLICY = LogOverflowPolicy(
+    os.getenv("LOG_OVERFLOW_POLICY", LogOverflowPolicy.AGGREGATE.value))
+
+
+class BufferedLogWriter:
+    """
+    Копит записи логов в памяти и пишет их пачками через COPY
+    из фонового потока по своему соединению с БД.
+
+    При переполнении очереди записи отбрасываются (drop) или считаются
+    по (level, source, store_id) и пишутся одной сводной записью (aggregate).
+    Пачка, которую не удалось записать, повторяется при следующем flush.
+    """
+
+    def __init__(
+        self,
+        db_handler_factory: Callable,
+        schema_name: str,
+        table_name: str,
+        max_size: int = LOG_BUFFER_MAX_SIZE,
+        flush_interval_seconds: float = LOG_FLUSH_INTERVAL_SECONDS,
+        overflow_policy: LogOverflowPolicy = LOG_OVERFLOW_POLICY,
+    ):
+        self.db_handler_factory = db_handler_factory
+        self.db_handler = None
+        self.schema_name = schema_name
+        self.table_name = table_name
+        self.flush_interval_seconds = flush_interval_seconds
+        self.overflow_policy = overflow_policy
+        self.max_size = max_size
+
+        self.queue: queue.Queue = queue.Queue(maxsize=max_size)
+        self.dropped: Counter = Counter()
+        # записи неудавшейся пачки, пишутся первыми при следующем flush
+        self.retry_records: list = []
+        self.dropped_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run,
+            name="log_writer",
+            daemon=True,
+        )
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _count_dropped(self, level: str, service: str, store_id: int,
+                       source: str, count: int = 1):
+        with self.dropped_lock:
+            if self.overflow_policy == LogOverflowPolicy.AGGREGATE:
+                self.dropped[(level, service, store_id, source)] += count
+            else:
+                self.dropped[None] += count
+
+    def write(
+        self,
+        level: str,
+        service: str,
+        source: str,
+        message: str,
+        store_id: int = None,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> bool:
+        record = (
+            level.upper(),
+            service,
+            store_id,
+            source,
+            message,
+            json.dumps(metadata) if metadata else None,
+            datetime.now(timezone.utc).isoformat(),
+        )
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self._count_dropped(level.upper(), service, store_id, source)
+            return False
+
+    def _return_records(self, records: list):
+        """Неудавшаяся пачка - на повтор; сверх max_size - в счётчик отброшенных"""
+        self.retry_records = records[:self.max_size]
+        for level, service, store_id, source, *_ in records[self.max_size:]:
+            self._count_dropped(level, service, store_id, source)
+
+    def _take_dropped_records(self) -> list:
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, Counter()
+
+        records = []
+        created_at = datetime.now(timezone.utc).isoformat()
+        for key, count in dropped.items():
+            if key is None:
+                print(f"[log_writer] dropped {count} log records")
+                continue
+            level, service, store_id, source = key
+            records.append((
+                level,
+                service,
+                store_id,
+                source,
+                f"{count} log records dropped: log buffer overflow",
+                json.dumps({"dropped": count}),
+                created_at,
+            ))
+        return records
+
+    def _take_batch(self) -> list:
+        records = []
+        while len(records) < LOG_FLUSH_BATCH_SIZE:
+            try:
+                records.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return records
+
+    def _copy_records(self, records: list):
+        buf = StringIO()
+        for record in records:
+            buf.write("\t".join(copy_text_value(v) for v in record))
+            buf.write("\n")
+        buf.seek(0)
+
+        if self.db_handler is None:
+            self.db_handler = self.db_handler_factory()
+
+        query = f"""
+            COPY {self.schema_name}.{self.table_name} ({", ".join(LOG_COLUMNS)})
+            FROM STDIN
+        """
+        with self.db_handler.connection:
+            with self.db_handler.connection.cursor() as cur:
+                cur.copy_expert(query, buf)
+
+    def flush(self) -> int:
+        written = 0
+        with self.flush_lock:
+            records, self.retry_records = self.retry_records, []
+            records += self._take_dropped_records() + self._take_batch()
+            while records:
+                try:
+                    self._copy_records(records)
+                    written += len(records)
+                except Exception as e:
+                    print(
+                        f"Failed to write {len(records)} logs to database: {str(e)}"
+                    )
+                    self._return_records(records)
+                    if self.db_handler:
+                        self.db_handler.close()
+                    self.db_handler = None
+                    return written
+                records = self._take_batch()
+        return written
+
+    def _run(self):
+        while not self.stop_event.wait(self.flush_interval_seconds):
+            self.flush()
+
+    def close(self):
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.flush()
+        if self.db_handler:
+            self.db_handler.close()
+            self.db_handler = None
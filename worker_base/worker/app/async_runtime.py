@@ -0,0 +1,50 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from app.wb_async_client import WBAsyncClient
+
+
+class AsyncTaskRuntime:
+    """
+    Event loop в отдельном потоке. Корутины магазинов отправляются в него
+    из основного цикла воркера и возвращают concurrent.futures.Future,
+    поэтому учёт выполняющихся магазинов общий с режимом threads.
+
+    Блокирующие вызовы БД уходят в executor loop-а (asyncio.to_thread),
+    сетевые запросы к WB идут через общий WBAsyncClient.
+    """
+
+    def __init__(self, max_blocking_threads: int):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(
+            ThreadPoolExecutor(
+                max_workers=max_blocking_threads,
+                thread_name_prefix="async_blocking",
+            ))
+        self.thread = threading.Thread(
+            target=self._run_loop,
+            name="async_runtime",
+            daemon=True,
+        )
+        self.thread.start()
+
+        self.http_client = WBAsyncClient()
+        self.run(self.http_client.start())
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout: float = None):
+        return self.submit(coro).result(timeout)
+
+    def close(self):
+        if not self.loop.is_running():
+            return
+        self.run(self.http_client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
@@ -0,0 +1,363 @@
+import datetime
+import struct
+import time
+import zlib
+from enum import Enum
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from wb_shared.copy_text import copy_text_value
+
+COPY_STREAM_CHUNK_ROWS = 500
+
+PG_EPOCH_DATE = datetime.date(2000, 1, 1)
+PG_EPOCH_DATETIME = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+BINARY_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+BINARY_COPY_TRAILER = struct.pack(">h", -1)
+
+
+class UpsertPolicy(Enum):
+    INSERT = "insert"  # обычный INSERT, конфликт по ключу - ошибка
+    NOTHING = "nothing"  # ON CONFLICT DO NOTHING
+    UPDATE = "update"  # ON CONFLICT DO UPDATE
+    UPDATE_EXISTING = "update_existing"  # только UPDATE ... FROM, без вставки
+
+
+class CopyFormat(Enum):
+    TEXT = "text"
+    BINARY = "binary"
+
+
+def to_date(value) -> datetime.date:
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(str(value)[:10])
+
+
+def to_datetime(value) -> datetime.datetime:
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.fromisoformat(
+            str(value).replace("Z", "+00:00"))
+    # naive считаем UTC
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def encode_binary_date(value) -> bytes:
+    return struct.pack(">i", (to_date(value) - PG_EPOCH_DATE).days)
+
+
+def encode_binary_timestamptz(value) -> bytes:
+    delta = to_datetime(value) - PG_EPOCH_DATETIME
+    microseconds = (delta.days * 86400 +
+                    delta.seconds) * 1000000 + delta.microseconds
+    return struct.pack(">q", microseconds)
+
+
+BINARY_ENCODERS = {
+    "int4": lambda v: struct.pack(">i", int(v)),
+    "integer": lambda v: struct.pack(">i", int(v)),
+    "int8": lambda v: struct.pack(">q", int(v)),
+    "bigint": lambda v: struct.pack(">q", int(v)),
+    "float8": lambda v: struct.pack(">d", float(v)),
+    "double precision": lambda v: struct.pack(">d", float(v)),
+    "text": lambda v: str(v).encode("utf-8"),
+    "bool": lambda v: b"\x01" if v else b"\x00",
+    "boolean": lambda v: b"\x01" if v else b"\x00",
+    "date": encode_binary_date,
+    "timestamptz": encode_binary_timestamptz,
+}
+
+
+def encode_text_row(row: Sequence) -> bytes:
+    return ("\t".join(copy_text_value(v) for v in row) + "\n").encode("utf-8")
+
+
+def make_binary_row_encoder(column_types: Sequence[str]):
+    encoders = [BINARY_ENCODERS[pg_type] for pg_type in column_types]
+    field_count = struct.pack(">h", len(encoders))
+
+    def encode_binary_row(row: Sequence) -> bytes:
+        parts = [field_count]
+        for encode, value in zip(encoders, row):
+            if value is None:
+                parts.append(b"\xff\xff\xff\xff")
+                continue
+            data = encode(value)
+            parts.append(struct.pack(">i", len(data)))
+            parts.append(data)
+        return b"".join(parts)
+
+    return encode_binary_row
+
+
+class CopyRowsStream:
+    """
+    Файлоподобный объект для copy_expert: кодирует строки по мере чтения,
+    поэтому весь COPY-буфер в памяти не собирается.
+    """
+
+    def __init__(self, rows: Iterable[Sequence], encode_row, header=b"",
+                 trailer=b""):
+        self.rows = iter(rows)
+        self.encode_row = encode_row
+        self.trailer = trailer
+        self.buffer = bytearray(header)
+        self.finished = False
+        self.rows_count = 0
+
+    def _fill(self, size: int):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            chunk = []
+            for row in self.rows:
+                chunk.append(self.encode_row(row))
+                if len(chunk) >= COPY_STREAM_CHUNK_ROWS:
+                    break
+            if not chunk:
+                self.buffer.extend(self.trailer)
+                self.finished = True
+                break
+            self.rows_count += len(chunk)
+            self.buffer.extend(b"".join(chunk))
+
+    def read(self, size: int = -1) -> bytes:
+        self._fill(size)
+        if size < 0 or size >= len(self.buffer):
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            return data
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        while b"\n" not in self.buffer and not self.finished:
+            self._fill(len(self.buffer) + 1)
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+        if 0 <= size < end:
+            end = size
+        data = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return data
+
+
+class CopyChunksStream(CopyRowsStream):
+    """
+    То же для уже закодированных кусков: chunks - итератор (bytes, количество строк),
+    например колонки, сериализованные целиком в binary COPY.
+    """
+
+    def __init__(self, chunks: Iterable[Tuple[bytes, int]], header=b"",
+                 trailer=b""):
+        super().__init__(chunks, None, header=header, trailer=trailer)
+
+    def _fill(self, size: int):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            chunk = next(self.rows, None)
+            if chunk is None:
+                self.buffer.extend(self.trailer)
+                self.finished = True
+                break
+            data, rows_count = chunk
+            self.rows_count += rows_count
+            self.buffer.extend(data)
+
+
+class BulkLoadResult:
+
+    def __init__(self, processed: int, inserted: int, updated: int,
+                 duration: float):
+        self.processed = processed
+        self.inserted = inserted
+        self.updated = updated
+        self.duration = duration
+
+    def __repr__(self):
+        return (f"processed={self.processed} inserted={self.inserted} "
+                f"updated={self.updated} in {self.duration:.2f} seconds")
+
+
+class BulkUpsert:
+    """
+    Загрузка строк в таблицу через COPY во временную staging-таблицу
+    и один INSERT/UPDATE из неё.
+
+    columns - [(имя, тип в staging)], key_columns - ключ для ON CONFLICT
+    или для UPDATE ... FROM. Staging-таблица создаётся один раз на соединение
+    (ON COMMIT DELETE ROWS). Количество вставленных/обновлённых строк
+    берётся из RETURNING самого запроса.
+    """
+
+    def __init__(
+        self,
+        schema_name: str,
+        table_name: str,
+        columns: List[Tuple[str, str]],
+        key_columns: Sequence[str] = (),
+        policy: UpsertPolicy = UpsertPolicy.INSERT,
+        update_columns: Optional[Sequence[str]] = None,
+        extra_updates: Optional[Dict[str, str]] = None,
+        copy_format: CopyFormat = CopyFormat.TEXT,
+    ):
+        self.schema_name = schema_name
+        self.table_name = table_name
+        self.columns = list(columns)
+        self.column_names = [name for name, _ in self.columns]
+        self.key_columns = list(key_columns)
+        self.policy = policy
+        if update_columns is None:
+            update_columns = [
+                name for name in self.column_names
+                if name not in self.key_columns
+            ]
+        self.update_columns = list(update_columns)
+        self.extra_updates = extra_updates or {}
+        self.copy_format = copy_format
+
+        if policy != UpsertPolicy.INSERT and not self.key_columns:
+            raise ValueError(f"Policy {policy.value} requires key_columns")
+
+        if copy_format == CopyFormat.BINARY:
+            unsupported = [
+                pg_type for _, pg_type in self.columns
+                if pg_type not in BINARY_ENCODERS
+            ]
+            if unsupported:
+                raise ValueError(
+                    f"Binary COPY does not support types: {unsupported}")
+            self.encode_row = make_binary_row_encoder(
+                [pg_type for _, pg_type in self.columns])
+        else:
+            self.encode_row = encode_text_row
+
+        signature = f"{schema_name}.{table_name}:{self.columns}"
+        self.staging_table_name = f"bulk_{table_name}_{zlib.crc32(signature.encode()):08x}"
+
+        self.staging_query = self.make_staging_query()
+        self.copy_query = self.make_copy_query()
+        self.upsert_query = self.make_upsert_query()
+
+    def make_staging_query(self) -> str:
+        columns = ",\n                ".join(f"{name} {pg_type}"
+                                             for name, pg_type in self.columns)
+        return f"""
+            CREATE TEMP TABLE IF NOT EXISTS {self.staging_table_name} (
+                {columns}
+            ) ON COMMIT DELETE ROWS;
+            DELETE FROM {self.staging_table_name};
+        """
+
+    def make_copy_query(self) -> str:
+        copy_options = "WITH (FORMAT binary)" if self.copy_format == CopyFormat.BINARY else ""
+        return f"""
+            COPY {self.staging_table_name} ({", ".join(self.column_names)})
+            FROM STDIN {copy_options}
+        """
+
+    def make_set_clause(self, source: str, indent: int) -> str:
+        assignments = [f"{name} = {source}.{name}" for name in self.update_columns]
+        assignments += [
+            f"{name} = {expression}"
+            for name, expression in self.extra_updates.items()
+        ]
+        return (",\n" + " " * indent).join(assignments)
+
+    def make_upsert_query(self) -> str:
+        target = f"{self.schema_name}.{self.table_name}"
+        column_list = ", ".join(self.column_names)
+
+        if self.policy == UpsertPolicy.UPDATE_EXISTING:
+            key_condition = " AND ".join(f"target.{name} = staging.{name}"
+                                         for name in self.key_columns)
+            return f"""
+                WITH affected AS (
+                    UPDATE {target} AS target
+                    SET
+                        {self.make_set_clause("staging", indent=24)}
+                    FROM {self.staging_table_name} AS staging
+                    WHERE {key_condition}
+                    RETURNING 1
+                )
+                SELECT 0 AS inserted, COUNT(*) AS updated FROM affected;
+            """
+
+        conflict_clause = ""
+        if self.policy == UpsertPolicy.NOTHING:
+            conflict_clause = f"ON CONFLICT ({', '.join(self.key_columns)}) DO NOTHING"
+        elif self.policy == UpsertPolicy.UPDATE:
+            conflict_clause = f"""ON CONFLICT ({', '.join(self.key_columns)})
+                    DO UPDATE SET
+                        {self.make_set_clause("EXCLUDED", indent=24)}"""
+
+        return f"""
+            WITH affected AS (
+                INSERT INTO {target} ({column_list})
+                SELECT {column_list}
+                FROM {self.staging_table_name}
+                {conflict_clause}
+                RETURNING (xmax = 0) AS is_inserted
+            )
+            SELECT
+                COUNT(*) FILTER (WHERE is_inserted) AS inserted,
+                COUNT(*) FILTER (WHERE NOT is_inserted) AS updated
+            FROM affected;
+        """
+
+    def make_stream(self, rows: Iterable[Sequence]) -> CopyRowsStream:
+        if self.copy_format == CopyFormat.BINARY:
+            return CopyRowsStream(rows,
+                                  self.encode_row,
+                                  header=BINARY_COPY_HEADER,
+                                  trailer=BINARY_COPY_TRAILER)
+        return CopyRowsStream(rows, self.encode_row)
+
+    def load_stream(self, cursor, stream: CopyRowsStream) -> BulkLoadResult:
+        start_time = time.time()
+
+        cursor.execute(self.staging_query)
+        cursor.copy_expert(self.copy_query, stream)
+        if stream.rows_count == 0:
+            return BulkLoadResult(0, 0, 0, time.time() - start_time)
+
+        cursor.execute(self.upsert_query)
+        inserted, updated = cursor.fetchone()
+        return BulkLoadResult(stream.rows_count, inserted, updated,
+                              time.time() - start_time)
+
+    def run(self, db_handler, stream: CopyRowsStream,
+            cursor=None) -> BulkLoadResult:
+        if cursor is not None:
+            return self.load_stream(cursor, stream)
+
+        # with connection - commit при успехе, rollback при ошибке
+        with db_handler.connection as connection:
+            with connection.cursor() as cur:
+                return self.load_stream(cur, stream)
+
+    def load(self,
+             db_handler,
+             rows: Iterable[Sequence],
+             cursor=None) -> BulkLoadResult:
+        """
+        Загружает rows (кортежи в порядке columns). Если передан cursor,
+        работает внутри внешней транзакции и не коммитит,
+        иначе выполняется одной транзакцией на соединении потока.
+        """
+        return self.run(db_handler, self.make_stream(rows), cursor=cursor)
+
+    def load_copy_chunks(self,
+                         db_handler,
+                         chunks: Iterable[Tuple[bytes, int]],
+                         cursor=None) -> BulkLoadResult:
+        """
+        Загружает готовые куски binary COPY (без заголовка и трейлера),
+        поля в порядке columns.
+        """
+        if self.copy_format != CopyFormat.BINARY:
+            raise ValueError("load_copy_chunks requires binary COPY format")
+        stream = CopyChunksStream(chunks,
+                                  header=BINARY_COPY_HEADER,
+                                  trailer=BINARY_COPY_TRAILER)
+        return self.run(db_handler, stream, cursor=cursor)
@@ -3,6 +3,7 @@ import threading
 from fastapi import FastAPI, Request
 import uvicorn
 from app.worker_class import Worker
+from app.worker_supervisor import WorkerSupervisor
 import os
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import JSONResponse
@@ -18,6 +19,9 @@ worker_status = {
 }
 stop_event.clear()
 
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 1))
+supervisor = None
+
 
 def worker_loop():
     worker_status["last_response"] = "try to make worker"
@@ -26,12 +30,12 @@ def worker_loop():
     worker_status["last_response"] = "main loop started"
 
     while not stop_event.is_set():
-        time.sleep(0.01)
         result = worker_obj.run_iteration()
         with info_lock:
             worker_status["last_response"] = result
         print(result)
 
+    worker_obj.close()
     worker_status["running"] = False
     print("Worker stopped.")
 
@@ -76,6 +80,8 @@ app.add_middleware(MicroserviceAuthMiddleware)
 
 @app.get("/status")
 def get_status():
+    if supervisor:
+        return supervisor.get_status()
     with info_lock:
         return {
             "running": worker_status["running"],
@@ -85,12 +91,20 @@ def get_status():
 
 @app.post("/stop")
 def stop_worker():
+    if supervisor:
+        supervisor.stop()
+        return {"message": "Workers stopping..."}
     stop_event.set()
     return {"message": "Worker stopping..."}
 
 
 @app.post("/start")
 def start_worker():
+    if supervisor:
+        started = supervisor.start()
+        if started:
+            return {"message": f"Workers started: {started}"}
+        return {"message": "Workers already running"}
     stop_event.clear()
     if not worker_status["running"]:
         threading.Thread(target=worker_loop, daemon=True).start()
@@ -108,8 +122,19 @@ def start_api():
     uvicorn.run(app, host="0.0.0.0", port=5553)
 
 
-api_thread = threading.Thread(target=start_api, daemon=True)
-api_thread.start()
-threading.Thread(target=worker_loop, daemon=True).start()
-while True:
-    time.sleep(1)
+# процессы супервизора (spawn) импортируют этот модуль заново - запуск только здесь
+if __name__ == "__main__":
+    if WORKER_PROCESSES > 1:
+        supervisor = WorkerSupervisor(
+            processes_amount=WORKER_PROCESSES,
+            base_worker_id=os.getenv("WORKER", "worker_default"),
+        )
+        supervisor.start()
+        supervisor.start_monitor()
+
+    api_thread = threading.Thread(target=start_api, daemon=True)
+    api_thread.start()
+    if not supervisor:
+        threading.Thread(target=worker_loop, daemon=True).start()
+    while True:
+        time.sleep(1)
@@ -0,0 +1,476 @@
+import datetime
+import hashlib
+import io
+import json
+import os
+import tempfile
+from typing import Iterator, Optional
+
+import zstandard
+
+from app.worker_public_config import STG_SCHEMA_NAME, STG_RAW_RESPONSE_TABLE_NAME
+
+# "" - хранилище выключено, "disk" - файлы в RAW_RESPONSE_DIR, "postgres" - bytea-таблица
+RAW_RESPONSE_STORE = os.getenv("RAW_RESPONSE_STORE", "")
+RAW_RESPONSE_DIR = os.getenv("RAW_RESPONSE_DIR", "/data/raw_responses")
+RAW_RESPONSE_RETENTION_DAYS = int(os.getenv("RAW_RESPONSE_RETENTION_DAYS", 30))
+# > 0 - задачи берут ответ из хранилища, если он не старше этого, вместо запроса к WB
+RAW_RESPONSE_REUSE_SECONDS = int(os.getenv("RAW_RESPONSE_REUSE_SECONDS", 0))
+RAW_RESPONSE_ZSTD_LEVEL = 3
+
+
+def request_hash(request: dict) -> str:
+    """Хеш запроса: метод, url, тело и параметры (без заголовков с токеном)"""
+    canonical = json.dumps(request,
+                           sort_keys=True,
+                           ensure_ascii=False,
+                           default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def compress(body: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=RAW_RESPONSE_ZSTD_LEVEL).compress(body)
+
+
+def decompress(data: bytes) -> bytes:
+    # потоковые кадры не содержат размер, поэтому decompressobj
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+def utc_now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class RawResponse:
+    """
+    Сохранённый ответ с интерфейсом requests.Response (status_code, content,
+    text, json(), raw), чтобы обработчики ответов в задачах были общими.
+    """
+
+    def __init__(self, store_id: int, endpoint: str, request: dict,
+                 request_hash: str, content_hash: str,
+                 fetched_at: datetime.datetime, status_code: int,
+                 compressed: bytes):
+        self.store_id = store_id
+        self.endpoint = endpoint
+        self.request = request
+        self.request_hash = request_hash
+        self.content_hash = content_hash
+        self.fetched_at = fetched_at
+        self.status_code = status_code
+        self.compressed = compressed
+        self._content = None
+        self._raw = None
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None:
+            self._content = decompress(self.compressed)
+        return self._content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+    @property
+    def payload(self):
+        """Тело запроса: json= или data= (строка JSON)"""
+        if self.request.get("json") is not None:
+            return self.request["json"]
+        if self.request.get("data"):
+            return json.loads(self.request["data"])
+        return None
+
+    @property
+    def raw(self):
+        # для iter_json_items
+        if self._raw is None:
+            self._raw = io.BytesIO(self.content)
+        return self._raw
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __repr__(self):
+        return (f"RawResponse({self.endpoint} store_id={self.store_id} "
+                f"fetched_at={self.fetched_at.isoformat()} size={len(self.compressed)})")
+
+
+class DiskRawResponseBackend:
+    """
+    {root}/{store_id}/{endpoint}/{request_hash}/request.json - сам запрос,
+    рядом {fetched_at_ms}_{status_code}_{content_hash}.zst - ответы.
+    """
+
+    def __init__(self, root_dir: str = RAW_RESPONSE_DIR):
+        self.root_dir = root_dir
+
+    def request_dir(self, store_id: int, endpoint: str,
+                    request_hash: str) -> str:
+        return os.path.join(self.root_dir, str(store_id),
+                            endpoint.strip("/").replace("/", "_"),
+                            request_hash)
+
+    @staticmethod
+    def parse_name(name: str):
+        fetched_at_ms, status_code, content_hash = name[:-len(".zst")].split(
+            "_")
+        fetched_at = datetime.datetime.fromtimestamp(
+            int(fetched_at_ms) / 1000, datetime.timezone.utc)
+        return fetched_at, int(status_code), content_hash
+
+    def list_names(self, path: str) -> list:
+        try:
+            return sorted(name for name in os.listdir(path)
+                          if name.endswith(".zst"))
+        except FileNotFoundError:
+            return []
+
+    def read(self,
+             path: str,
+             name: str,
+             store_id: int,
+             endpoint: str,
+             request: dict,
+             with_body: bool = True) -> RawResponse:
+        fetched_at, status_code, content_hash = self.parse_name(name)
+        compressed = None
+        if with_body:
+            with open(os.path.join(path, name), "rb") as f:
+                compressed = f.read()
+        return RawResponse(store_id, endpoint, request, os.path.basename(path),
+                           content_hash, fetched_at, status_code, compressed)
+
+    def read_request(self, path: str) -> Optional[dict]:
+        """None - request.json нет (каталог удаляется purge или ещё не записан)"""
+        try:
+            with open(os.path.join(path, "request.json"),
+                      encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def write_request(self, path: str, request: dict):
+        """request.json через временный файл и os.replace: читатели видят его целиком"""
+        fd, tmp_path = tempfile.mkstemp(dir=path,
+                                        prefix=".request.",
+                                        suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(request, f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, os.path.join(path, "request.json"))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def put(self, response: RawResponse):
+        path = self.request_dir(response.store_id, response.endpoint,
+                                response.request_hash)
+        os.makedirs(path, exist_ok=True)
+        # пишется каждый раз: purge мог удалить его между проверкой и записью ответа
+        self.write_request(path, response.request)
+
+        name = (f"{int(response.fetched_at.timestamp() * 1000)}_"
+                f"{response.status_code}_{response.content_hash}.zst")
+        names = self.list_names(path)
+        if names and names[-1].endswith(f"_{response.content_hash}.zst"):
+            # тот же ответ, что и в прошлый раз: тело не дублируем, только время получения
+            os.replace(os.path.join(path, names[-1]), os.path.join(path, name))
+            return
+
+        tmp_path = os.path.join(path, f".{name}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(response.compressed)
+        os.replace(tmp_path, os.path.join(path, name))
+
+    def latest(self, store_id: int, endpoint: str,
+               request_hash: str) -> Optional[RawResponse]:
+        path = self.request_dir(store_id, endpoint, request_hash)
+        names = self.list_names(path)
+        request = self.read_request(path)
+        if not names or request is None:
+            return None
+        return self.read(path, names[-1], store_id, endpoint, request)
+
+    def iter_latest(self,
+                    store_id: int,
+                    endpoint: str,
+                    with_body: bool = True) -> Iterator[RawResponse]:
+        endpoint_dir = os.path.dirname(self.request_dir(store_id, endpoint, "x"))
+        try:
+            request_hashes = sorted(os.listdir(endpoint_dir))
+        except FileNotFoundError:
+            return
+        latest = []
+        for hash_value in request_hashes:
+            path = os.path.join(endpoint_dir, hash_value)
+            names = self.list_names(path)
+            if names:
+                latest.append((self.parse_name(names[-1])[0], path, names[-1]))
+        # тела читаются по одному, в порядке получения
+        for _, path, name in sorted(latest):
+            request = self.read_request(path)
+            if request is None:
+                # каталог без request.json (гонка с purge) не должен обрывать обход
+                print(f"-- raw response without request.json skipped: {path}")
+                continue
+            try:
+                response = self.read(path, name, store_id, endpoint, request,
+                                     with_body)
+            except FileNotFoundError:
+                # ответ удалён purge после листинга
+                continue
+            yield response
+
+    def purge(self, older_than: datetime.datetime) -> int:
+        removed = 0
+        for dir_path, _, names in os.walk(self.root_dir):
+            for name in names:
+                if not name.endswith(".zst"):
+                    continue
+                fetched_at, _, _ = self.parse_name(name)
+                if fetched_at < older_than:
+                    os.remove(os.path.join(dir_path, name))
+                    removed += 1
+            if dir_path != self.root_dir and not self.list_names(dir_path):
+                request_path = os.path.join(dir_path, "request.json")
+                if os.path.exists(request_path):
+                    os.remove(request_path)
+        return removed
+
+
+class PostgresRawResponseBackend:
+    """Строка на ответ в stg_raw_response, тело - zstd в bytea"""
+
+    def __init__(self, db_handler):
+        self.db_handler = db_handler
+        self.table = f"{STG_SCHEMA_NAME}.{STG_RAW_RESPONSE_TABLE_NAME}"
+
+    def row_to_response(self, row: dict) -> RawResponse:
+        body = row.get("body")
+        return RawResponse(row["store_id"], row["endpoint"], row["request"],
+                           row["request_hash"], row["content_hash"],
+                           row["fetched_at"], row["status_code"],
+                           bytes(body) if body is not None else None)
+
+    def put(self, response: RawResponse):
+        # тот же ответ, что и в прошлый раз: тело не дублируем, только время получения
+        query = f"""
+            WITH last AS (
+                SELECT id, content_hash
+                FROM {self.table}
+                WHERE store_id = %(store_id)s AND endpoint = %(endpoint)s
+                AND request_hash = %(request_hash)s
+                ORDER BY fetched_at DESC
+                LIMIT 1
+            ),
+            touched AS (
+                UPDATE {self.table} t
+                SET fetched_at = %(fetched_at)s, status_code = %(status_code)s
+                FROM last
+                WHERE t.id = last.id AND last.content_hash = %(content_hash)s
+                RETURNING t.id
+            )
+            INSERT INTO {self.table} (
+                store_id, endpoint, request_hash, request, content_hash,
+                status_code, fetched_at, body
+            )
+            SELECT
+                %(store_id)s, %(endpoint)s, %(request_hash)s, %(request)s::jsonb,
+                %(content_hash)s, %(status_code)s, %(fetched_at)s, %(body)s
+            WHERE NOT EXISTS (SELECT 1 FROM touched);
+        """
+        self.db_handler.execute_query(
+            query, {
+                "store_id": response.store_id,
+                "endpoint": response.endpoint,
+                "request_hash": response.request_hash,
+                "request": json.dumps(response.request, default=str),
+                "content_hash": response.content_hash,
+                "status_code": response.status_code,
+                "fetched_at": response.fetched_at,
+                "body": response.compressed,
+            })
+
+    def latest(self, store_id: int, endpoint: str,
+               request_hash: str) -> Optional[RawResponse]:
+        query = f"""
+            SELECT *
+            FROM {self.table}
+            WHERE store_id = %s AND endpoint = %s AND request_hash = %s
+            ORDER BY fetched_at DESC
+            LIMIT 1;
+        """
+        row = self.db_handler.execute_and_fetch_single_row(
+            query, (store_id, endpoint, request_hash))
+        return self.row_to_response(row) if row else None
+
+    def iter_latest(self,
+                    store_id: int,
+                    endpoint: str,
+                    with_body: bool = True) -> Iterator[RawResponse]:
+        columns = "store_id, endpoint, request_hash, request, content_hash, status_code, fetched_at"
+        if with_body:
+            columns += ", body"
+        query = f"""
+            SELECT *
+            FROM (
+                SELECT DISTINCT ON (request_hash) {columns}
+                FROM {self.table}
+                WHERE store_id = %s AND endpoint = %s
+                ORDER BY request_hash, fetched_at DESC
+            ) latest
+            ORDER BY fetched_at;
+        """
+        for row in self.db_handler.execute_and_fetch_all(
+                query, (store_id, endpoint)) or []:
+            yield self.row_to_response(row)
+
+    def purge(self, older_than: datetime.datetime) -> int:
+        query = f"""
+            WITH removed AS (
+                DELETE FROM {self.table}
+                WHERE fetched_at < %s
+                RETURNING 1
+            )
+            SELECT COUNT(*) AS removed FROM removed;
+        """
+        row = self.db_handler.execute_and_fetch_single_row(query, (older_than, ))
+        return row["removed"] if row else 0
+
+
+class RawResponseSink:
+    """
+    Приёмник тела потокового ответа: сжимает и хеширует куски по мере чтения,
+    сохраняет в хранилище в close(). Недочитанный ответ (discard) не сохраняется.
+    """
+
+    def __init__(self, store, store_id: int, endpoint: str, request: dict,
+                 status_code: int):
+        self.store = store
+        self.store_id = store_id
+        self.endpoint = endpoint
+        self.request = request
+        self.status_code = status_code
+        self.hasher = hashlib.sha256()
+        self.compressor = zstandard.ZstdCompressor(
+            level=RAW_RESPONSE_ZSTD_LEVEL).compressobj()
+        self.buffer = io.BytesIO()
+        self.closed = False
+
+    def write(self, data: bytes):
+        if self.closed or not data:
+            return
+        self.hasher.update(data)
+        self.buffer.write(self.compressor.compress(data))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.buffer.write(self.compressor.flush())
+        self.store.put_compressed(self.store_id, self.endpoint, self.request,
+                                  self.buffer.getvalue(),
+                                  self.hasher.hexdigest(), self.status_code)
+
+    def discard(self):
+        self.closed = True
+        self.buffer = io.BytesIO()
+
+
+class RawResponseStore:
+    """
+    Хранилище сырых ответов WB API: тело (zstd) по ключу
+    (store_id, endpoint, хеш запроса, время получения). Одинаковые подряд ответы
+    на один запрос хранятся одним телом. Ошибки хранилища не должны ломать
+    загрузку - вызывающий код логирует их и продолжает.
+    """
+
+    def __init__(self, backend,
+                 retention_days: int = RAW_RESPONSE_RETENTION_DAYS):
+        self.backend = backend
+        self.retention_days = retention_days
+
+    def put_compressed(self, store_id: int, endpoint: str, request: dict,
+                       compressed: bytes, content_hash: str,
+                       status_code: int) -> RawResponse:
+        response = RawResponse(store_id, endpoint, request,
+                               request_hash(request), content_hash, utc_now(),
+                               status_code, compressed)
+        self.backend.put(response)
+        return response
+
+    def save(self, store_id: int, endpoint: str, request: dict, body: bytes,
+             status_code: int = 200) -> RawResponse:
+        return self.put_compressed(store_id, endpoint, request,
+                                   compress(body),
+                                   hashlib.sha256(body).hexdigest(),
+                                   status_code)
+
+    def open_sink(self, store_id: int, endpoint: str, request: dict,
+                  status_code: int = 200) -> RawResponseSink:
+        return RawResponseSink(self, store_id, endpoint, request, status_code)
+
+    def lookup(self,
+               store_id: int,
+               endpoint: str,
+               request: dict,
+               max_age_seconds: Optional[float] = None) -> Optional[RawResponse]:
+        """Последний сохранённый ответ на такой же запрос (не старше max_age_seconds)"""
+        response = self.backend.latest(store_id, endpoint, request_hash(request))
+        if response is None:
+            return None
+        if max_age_seconds is not None and (
+                utc_now() - response.fetched_at).total_seconds() > max_age_seconds:
+            return None
+        return response
+
+    def get(self, store_id: int, endpoint: str,
+            request_hash: str) -> Optional[RawResponse]:
+        """Последний ответ по хешу запроса (из iter_responses)"""
+        return self.backend.latest(store_id, endpoint, request_hash)
+
+    def iter_responses(
+        self,
+        store_id: int,
+        endpoint: str,
+        since: Optional[datetime.datetime] = None,
+        until: Optional[datetime.datetime] = None,
+        with_body: bool = True,
+    ) -> Iterator[RawResponse]:
+        """
+        Последние ответы на каждый сохранённый запрос endpoint-а, по времени получения.
+        with_body=False - без тел (compressed=None), тело потом через get().
+        """
+        for response in self.backend.iter_latest(store_id, endpoint,
+                                                 with_body):
+            if since and response.fetched_at < since:
+                continue
+            if until and response.fetched_at > until:
+                continue
+            yield response
+
+    def purge(self) -> int:
+        """Удаляет ответы старше retention_days; возвращает количество удалённых"""
+        older_than = utc_now() - datetime.timedelta(days=self.retention_days)
+        return self.backend.purge(older_than)
+
+
+def make_raw_response_store(db_handler=None,
+                            kind: str = RAW_RESPONSE_STORE
+                            ) -> Optional[RawResponseStore]:
+    """Хранилище по RAW_RESPONSE_STORE; None - выключено"""
+    if kind == "disk":
+        return RawResponseStore(DiskRawResponseBackend())
+    if kind == "postgres":
+        return RawResponseStore(PostgresRawResponseBackend(db_handler))
+    if kind:
+        raise ValueError(f"Unknown RAW_RESPONSE_STORE: {kind}")
+    return None
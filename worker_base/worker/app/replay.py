@@ -0,0 +1,241 @@
+"""
+Переобработка сохранённых сырых ответов WB (raw_response_store) без запросов к API:
+ответы магазина за период прогоняются через те же разбор и BulkUpsert, что и
+в задачах (TaskBase.replay_raw_response), и перезаписывают таблицы wb_stg.
+Группы ответов (TaskBase.replay_group) обрабатываются параллельно в пуле процессов.
+
+Запуск из worker_base/worker:
+    python -m app.replay --store-id 12 --since 2025-06-01 --until 2025-06-30
+    python -m app.replay --store-id 12 --task taskAdvert --processes 8 --dry-run
+"""
+import argparse
+import datetime
+import multiprocessing as mp
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+
+from app.worker_db_handler import WorkerDBHandler
+from app.worker_logger import WorkerLogger
+from app.raw_response_store import RAW_RESPONSE_STORE, make_raw_response_store
+from app.tasks.task_base import TaskBase
+from app.tasks.task_cards_list import taskCardsList
+from app.tasks.task_nm_report_detail import taskNmReportDetail
+from app.tasks.task_fact_stock import taskFactStock
+from app.tasks.task_fact_sales import taskFactSales
+from app.tasks.task_advert_info import taskAdvertInfo
+from app.tasks.task_advert import taskAdvert
+
+REPLAY_TASK_CLASSES = (
+    taskCardsList,
+    taskNmReportDetail,
+    taskFactStock,
+    taskFactSales,
+    taskAdvertInfo,
+    taskAdvert,
+)
+REPLAY_PROCESSES = int(os.getenv("REPLAY_PROCESSES", os.cpu_count() or 1))
+REPLAY_WORKER_ID = "replay"
+
+
+class OfflineRequestError(RuntimeError):
+    pass
+
+
+class OfflineHttpSessions:
+    """Вместо WBHttpSessions: при переобработке любой запрос к WB - ошибка"""
+
+    def request(self, method: str, url: str, **kwargs):
+        raise OfflineRequestError(f"replay must not call WB API: {method} {url}")
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def get_stats(self) -> dict:
+        return {}
+
+    def close(self):
+        pass
+
+
+def make_replay_tasks(db_handler, logger, store_id: int,
+                      task_identifiers=None) -> Dict[str, TaskBase]:
+    """endpoint -> задача магазина; задачи без токена и без доступа к сети"""
+    tasks = {}
+    for task_class in REPLAY_TASK_CLASSES:
+        if task_identifiers and task_class.task_class_identifier not in task_identifiers:
+            continue
+        task = task_class(
+            db_handler=db_handler,
+            logger=logger,
+            store_id=store_id,
+            api_token="",
+            last_run_time=0,
+            http_sessions=OfflineHttpSessions(),
+        )
+        for endpoint in task_class.replay_endpoints:
+            tasks[endpoint] = task
+    return tasks
+
+
+def plan_replay(raw_store, tasks: Dict[str, TaskBase], store_id: int, since,
+                until) -> Dict[str, List[Tuple[str, str]]]:
+    """
+    Группа -> [(endpoint, request_hash)] в порядке получения; тела не читаются.
+    Группа может собираться из нескольких endpoint - порядок по fetched_at
+    восстанавливается после обхода всех endpoint.
+    """
+    groups = {}
+    for endpoint, task in tasks.items():
+        for response in raw_store.iter_responses(store_id,
+                                                 endpoint,
+                                                 since=since,
+                                                 until=until,
+                                                 with_body=False):
+            group = task.replay_group(response)
+            groups.setdefault(group, []).append(
+                (response.fetched_at, endpoint, response.request_hash))
+    return {
+        group: [(endpoint, request_hash)
+                for _, endpoint, request_hash in sorted(items)]
+        for group, items in groups.items()
+    }
+
+
+# состояние процесса пула: соединения и задачи создаются в каждом процессе свои
+_replay_process = {}
+
+
+def init_replay_process(store_kind: str, store_id: int, task_identifiers):
+    db_handler = WorkerDBHandler(max_connections=2)
+    logger = WorkerLogger(db_handler=db_handler, worker=REPLAY_WORKER_ID)
+    _replay_process["raw_store"] = make_raw_response_store(db_handler,
+                                                           kind=store_kind)
+    _replay_process["tasks"] = make_replay_tasks(db_handler, logger, store_id,
+                                                 task_identifiers)
+    _replay_process["store_id"] = store_id
+
+
+def replay_group(group: str, items: List[Tuple[str, str]]) -> dict:
+    """Ответы одной группы по порядку; ошибка ответа не останавливает группу"""
+    raw_store = _replay_process["raw_store"]
+    tasks = _replay_process["tasks"]
+    store_id = _replay_process["store_id"]
+
+    start = time.time()
+    result = {"group": group, "responses": 0, "rows": 0, "errors": []}
+    for endpoint, request_hash in items:
+        try:
+            response = raw_store.get(store_id, endpoint, request_hash)
+            if response is None:
+                raise LookupError("response is not found (purged?)")
+            result["rows"] += tasks[endpoint].replay_raw_response(response)
+            result["responses"] += 1
+        except Exception as e:
+            result["errors"].append(f"{endpoint} {request_hash[:12]}: {e}")
+    result["duration"] = time.time() - start
+    return result
+
+
+def run_replay(store_id: int,
+               since=None,
+               until=None,
+               task_identifiers=None,
+               processes: int = REPLAY_PROCESSES,
+               store_kind: str = RAW_RESPONSE_STORE,
+               dry_run: bool = False) -> dict:
+    db_handler = WorkerDBHandler(max_connections=1)
+    raw_store = make_raw_response_store(db_handler, kind=store_kind)
+    if raw_store is None:
+        raise ValueError("RAW_RESPONSE_STORE is not set: nothing to replay")
+
+    tasks = make_replay_tasks(db_handler, None, store_id, task_identifiers)
+    groups = plan_replay(raw_store, tasks, store_id, since, until)
+    db_handler.close()
+
+    responses_amount = sum(len(items) for items in groups.values())
+    print(f"-- replay plan: store_id={store_id}, {len(groups)} groups, "
+          f"{responses_amount} responses")
+    summary = {"groups": len(groups), "responses": 0, "rows": 0, "errors": 0}
+    if dry_run or not groups:
+        for group, items in sorted(groups.items()):
+            print(f"--- {group}: {len(items)} responses")
+        return summary
+
+    start = time.time()
+    # spawn: соединения psycopg2 основного процесса не должны попасть в дочерние
+    with ProcessPoolExecutor(
+            max_workers=max(1, min(processes, len(groups))),
+            mp_context=mp.get_context("spawn"),
+            initializer=init_replay_process,
+            initargs=(store_kind, store_id, task_identifiers),
+    ) as executor:
+        # большие группы - первыми, чтобы не остались в хвосте
+        futures = [
+            executor.submit(replay_group, group, items) for group, items in
+            sorted(groups.items(), key=lambda item: -len(item[1]))
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            summary["responses"] += result["responses"]
+            summary["rows"] += result["rows"]
+            summary["errors"] += len(result["errors"])
+            print(f"--- {result['group']}: {result['responses']} responses, "
+                  f"{result['rows']} rows in {result['duration']:.2f} seconds")
+            for error in result["errors"]:
+                print(f"---- replay error: {error}")
+
+    print(f"-- replay done in {time.time() - start:.2f} seconds: {summary}")
+    return summary
+
+
+def parse_day(value: str) -> datetime.datetime:
+    return datetime.datetime.combine(datetime.date.fromisoformat(value),
+                                     datetime.time(),
+                                     tzinfo=datetime.timezone.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebuild wb_stg tables from stored raw WB responses")
+    parser.add_argument("--store-id", type=int, required=True)
+    parser.add_argument("--since",
+                        type=parse_day,
+                        help="fetched from this day (UTC), YYYY-MM-DD")
+    parser.add_argument("--until",
+                        type=parse_day,
+                        help="fetched up to this day inclusive (UTC)")
+    parser.add_argument(
+        "--task",
+        action="append",
+        choices=[cls.task_class_identifier for cls in REPLAY_TASK_CLASSES],
+        help="only these tasks (repeatable)")
+    parser.add_argument("--processes", type=int, default=REPLAY_PROCESSES)
+    # без RAW_RESPONSE_STORE хранилище нужно указать явно
+    parser.add_argument("--store",
+                        default=RAW_RESPONSE_STORE or None,
+                        required=not RAW_RESPONSE_STORE,
+                        choices=["disk", "postgres"])
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    until = args.until + datetime.timedelta(days=1) if args.until else None
+    summary = run_replay(
+        store_id=args.store_id,
+        since=args.since,
+        until=until,
+        task_identifiers=args.task,
+        processes=args.processes,
+        store_kind=args.store,
+        dry_run=args.dry_run,
+    )
+    sys.exit(1 if summary["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
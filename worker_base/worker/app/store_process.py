@@ -1,4 +1,5 @@
 import time
+import asyncio
 from enum import Enum
 from typing import Dict, List, Optional
 import time
@@ -16,11 +17,14 @@ from app.tasks.task_fact_sales import taskFactSales
 from app.tasks.task_advert_info import taskAdvertInfo
 from app.tasks.task_advert import taskAdvert
 
+from app.task_scheduler import TaskScheduler
 from app.worker_db_handler import WorkerDBHandler
 from app.worker_logger import WorkerLogger
+from app.wb_http_sessions import WBHttpSessions
 
 MAX_STORE_PROCESS_ERROR_AMOUNT = 100
 MAX_STORE_PROCESS_LIVE_SECONDS = 5600
+MAX_TASK_WAIT_SECONDS = 5
 
 
 class StoreProcessStatus(Enum):
@@ -55,6 +59,8 @@ class StoreProcess:
         secret_key,
         db_handler,
         logger,
+        http_sessions=None,
+        raw_store=None,
     ):
 
         self.store_id = store_id
@@ -64,6 +70,8 @@ class StoreProcess:
         self.secret_key = secret_key
         self.db_handler: WorkerDBHandler = db_handler
         self.logger: WorkerLogger = logger
+        self.http_sessions: WBHttpSessions = http_sessions
+        self.raw_store = raw_store
         self.error_count = 0
         self.start_time = time.time()
 
@@ -73,6 +81,8 @@ class StoreProcess:
                 logger=logger,
                 store_id=store_id,
                 api_token=api_token,
+                http_sessions=http_sessions,
+                raw_store=raw_store,
                 last_run_time=0,
             ),
             taskNmReportDetail(
@@ -80,6 +90,8 @@ class StoreProcess:
                 logger=logger,
                 store_id=store_id,
                 api_token=api_token,
+                http_sessions=http_sessions,
+                raw_store=raw_store,
                 last_run_time=5,
             ),
             taskFactStock(
@@ -87,6 +99,8 @@ class StoreProcess:
                 logger=logger,
                 store_id=store_id,
                 api_token=api_token,
+                http_sessions=http_sessions,
+                raw_store=raw_store,
                 last_run_time=10,
             ),
             taskFactSales(
@@ -94,6 +108,8 @@ class StoreProcess:
                 logger=logger,
                 store_id=store_id,
                 api_token=api_token,
+                http_sessions=http_sessions,
+                raw_store=raw_store,
                 last_run_time=15,
             ),
             taskAdvertInfo(
@@ -101,6 +117,8 @@ class StoreProcess:
                 logger=logger,
                 store_id=store_id,
                 api_token=api_token,
+                http_sessions=http_sessions,
+                raw_store=raw_store,
                 last_run_time=30,
             ),
             taskAdvert(
@@ -108,27 +126,21 @@ class StoreProcess:
                 logger=logger,
                 store_id=store_id,
                 api_token=api_token,
+                http_sessions=http_sessions,
+                raw_store=raw_store,
                 last_run_time=40,
             ),
         ]
 
-    def get_earliest_task(self) -> Optional[TaskBase]:
-        if not self.tasks:
-            return None
-
-        earliest_task = None
-        earliest_time = float('inf')
-
+        self.scheduler = TaskScheduler()
         for task in self.tasks:
-            last_run_time = task.last_run_time
-            if last_run_time < earliest_time and task.status == TaskStatus.IN_PROGRESS:
-                earliest_task = task
-                earliest_time = last_run_time
-
-        if earliest_task:
-            earliest_task.last_run_time = time.time()
+            self.scheduler.push(task, store=self)
 
-        return earliest_task
+    def get_task_wait_seconds(self) -> float:
+        seconds_until_next = self.scheduler.seconds_until_next()
+        if seconds_until_next is None:
+            return 0
+        return min(seconds_until_next, MAX_TASK_WAIT_SECONDS)
 
     def check_tasks_ready(self):
         for task in self.tasks:
@@ -137,41 +149,29 @@ class StoreProcess:
 
         return True
 
-    def store_process_iter(self) -> StoreProcessResponse:
-        is_ready = self.check_tasks_ready()
-
-        if (is_ready):
-            return StoreProcessResponse(StoreProcessStatus.SUCCESS)
-
-        task = self.get_earliest_task()
-        print(
-            f"---- start task: {task.__class__.task_class_identifier} store_id: {self.store_id} "
-        )
-        task_resp = None
-        try:
-            task_resp = task.process()
-        except Exception as e:
-            if isinstance(e, TaskError):
-                self.logger.error(
-                    source=e.task_class_identifier,
-                    store_id=self.store_id,
-                    message=str(e),
-                )
-            else:
-                self.logger.error(
-                    source="store_process",
-                    store_id=self.store_id,
-                    message=f"error: {e}",
-                )
-            self.error_count += 1
+    def handle_task_error(self, e: Exception):
+        if isinstance(e, TaskError):
+            self.logger.error(
+                source=e.task_class_identifier,
+                store_id=self.store_id,
+                message=str(e),
+            )
+        else:
+            self.logger.error(
+                source="store_process",
+                store_id=self.store_id,
+                message=f"error: {e}",
+            )
+        self.error_count += 1
 
+    def finish_iteration(self, task: TaskBase) -> StoreProcessResponse:
         if self.error_count > MAX_STORE_PROCESS_ERROR_AMOUNT:
             self.logger.error(
                 source="store_process",
                 store_id=self.store_id,
-                message=f"error: {e}",
+                message=f"too many errors: {self.error_count}",
             )
-            StoreProcessResponse(StoreProcessStatus.ERROR)
+            return StoreProcessResponse(StoreProcessStatus.ERROR)
 
         current_time = time.time()
         if current_time - self.start_time > MAX_STORE_PROCESS_LIVE_SECONDS:
@@ -180,7 +180,7 @@ class StoreProcess:
                 store_id=self.store_id,
                 message=f"To long store process live",
             )
-            StoreProcessResponse(StoreProcessStatus.ERROR)
+            return StoreProcessResponse(StoreProcessStatus.ERROR)
 
         print(
             f"---- end task: {task.__class__.task_class_identifier} store_id: {self.store_id}, status: {task.status}"
@@ -188,6 +188,69 @@ class StoreProcess:
 
         return StoreProcessResponse(StoreProcessStatus.IN_PROGRESS)
 
+    def run_task(self, task: TaskBase) -> StoreProcessResponse:
+        task.last_run_time = time.time()
+        print(
+            f"---- start task: {task.__class__.task_class_identifier} store_id: {self.store_id} "
+        )
+        try:
+            task.process()
+        except Exception as e:
+            self.handle_task_error(e)
+
+        if self.check_tasks_ready():
+            return StoreProcessResponse(StoreProcessStatus.SUCCESS)
+
+        return self.finish_iteration(task)
+
+    async def run_task_async(self, task: TaskBase,
+                             http_client) -> StoreProcessResponse:
+        task.last_run_time = time.time()
+        print(
+            f"---- start async task: {task.__class__.task_class_identifier} store_id: {self.store_id} "
+        )
+        try:
+            await task.process_async(http_client)
+        except Exception as e:
+            self.handle_task_error(e)
+
+        if self.check_tasks_ready():
+            return StoreProcessResponse(StoreProcessStatus.SUCCESS)
+
+        return self.finish_iteration(task)
+
+    def store_process_iter(self) -> StoreProcessResponse:
+        if self.check_tasks_ready():
+            return StoreProcessResponse(StoreProcessStatus.SUCCESS)
+
+        entry = self.scheduler.pop_ready()
+        if entry is None:
+            time.sleep(self.get_task_wait_seconds())
+            return StoreProcessResponse(StoreProcessStatus.IN_PROGRESS,
+                                        "no ready tasks")
+
+        _, task = entry
+        store_process_response = self.run_task(task)
+        self.scheduler.push(task, store=self)
+        return store_process_response
+
+    async def store_process_iter_async(self,
+                                       http_client) -> StoreProcessResponse:
+        if self.check_tasks_ready():
+            return StoreProcessResponse(StoreProcessStatus.SUCCESS)
+
+        entry = self.scheduler.pop_ready()
+        if entry is None:
+            await asyncio.sleep(self.get_task_wait_seconds())
+            return StoreProcessResponse(StoreProcessStatus.IN_PROGRESS,
+                                        "no ready tasks")
+
+        _, task = entry
+        store_process_response = await self.run_task_async(
+            task, http_client)
+        self.scheduler.push(task, store=self)
+        return store_process_response
+
     def to_string(self):
         obj_str = f"""
         StoreProcess
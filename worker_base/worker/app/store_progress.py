@@ -0,0 +1,126 @@
+from enum import Enum
+
+from app.worker_public_config import (
+    STG_SCHEMA_NAME,
+    STG_STORE_PROGRESS_TABLE_NAME,
+    STORE_PROGRESS_CHECK_INTERVAL,
+    ADVERT_UPDATE_SCEDUAL,
+)
+
+STORE_PROGRESS_TABLE = f"{STG_SCHEMA_NAME}.{STG_STORE_PROGRESS_TABLE_NAME}"
+
+
+class ProgressSource(Enum):
+    ADVERT_LIST = "advert_list"  # total - кампаний, done - в актуальном списке
+    ADVERT_INFO = "advert_info"  # done - кампаний с актуальной информацией
+    ADVERT_STAT = "advert_stat"  # total / done - дней (advert, date) в окне fullstats
+
+
+class StoreProgress:
+    """
+    Счётчики прогресса (total, done) по магазину и источнику данных.
+    Обновляются в той же транзакции, что и загрузка (cursor=), читаются
+    по первичному ключу. Полные агрегаты по staging-таблицам нужны только
+    для периодической сверки (check_due), их результат записывается через set(checked=True).
+    """
+
+    def __init__(self, db_handler, store_id: int):
+        self.db_handler = db_handler
+        self.store_id = store_id
+
+    def _execute(self, query: str, params: dict, cursor=None):
+        if cursor is not None:
+            cursor.execute(query, params)
+            return
+        self.db_handler.execute_query(query, params)
+
+    def get(self, source: ProgressSource,
+            fresh_interval: str = ADVERT_UPDATE_SCEDUAL) -> dict | None:
+        """
+        Счётчики источника или None, если их ещё нет.
+        is_fresh - загрузка была не раньше fresh_interval назад,
+        check_due - пора сверить счётчики с полным агрегатом
+        (прошёл STORE_PROGRESS_CHECK_INTERVAL или сменились сутки).
+        """
+        query = f"""
+            SELECT
+                total,
+                done,
+                refreshed_at,
+                checked_at,
+                refreshed_at >= NOW() - %(fresh_interval)s::interval AS is_fresh,
+                (
+                    checked_at IS NULL
+                    OR checked_at < NOW() - INTERVAL '{STORE_PROGRESS_CHECK_INTERVAL}'
+                    OR checked_at::date < CURRENT_DATE
+                ) AS check_due
+            FROM {STORE_PROGRESS_TABLE}
+            WHERE store_id = %(store_id)s AND source = %(source)s;
+        """
+        return self.db_handler.execute_and_fetch_single_row(
+            query, {
+                "store_id": self.store_id,
+                "source": source.value,
+                "fresh_interval": fresh_interval,
+            })
+
+    def set(self,
+            source: ProgressSource,
+            total: int,
+            done: int,
+            refreshed_at=None,
+            checked: bool = False,
+            cursor=None):
+        """
+        Записывает абсолютные значения. refreshed_at по умолчанию - NOW();
+        checked=True - значения получены полным агрегатом (сверка).
+        """
+        query = f"""
+            INSERT INTO {STORE_PROGRESS_TABLE} AS progress (
+                store_id, source, total, done, refreshed_at, checked_at
+            )
+            VALUES (
+                %(store_id)s, %(source)s, %(total)s, %(done)s,
+                COALESCE(%(refreshed_at)s, NOW()),
+                CASE WHEN %(checked)s THEN NOW() END
+            )
+            ON CONFLICT (store_id, source)
+            DO UPDATE SET
+                total = EXCLUDED.total,
+                done = EXCLUDED.done,
+                refreshed_at = EXCLUDED.refreshed_at,
+                checked_at = COALESCE(EXCLUDED.checked_at, progress.checked_at);
+        """
+        self._execute(
+            query, {
+                "store_id": self.store_id,
+                "source": source.value,
+                "total": total,
+                "done": done,
+                "refreshed_at": refreshed_at,
+                "checked": checked,
+            }, cursor)
+
+    def add_done(self, source: ProgressSource, delta: int, cursor=None):
+        """Увеличивает done на delta (не больше total), refreshed_at = NOW()"""
+        query = f"""
+            UPDATE {STORE_PROGRESS_TABLE}
+            SET
+                done = LEAST(done + %(delta)s, total),
+                refreshed_at = NOW()
+            WHERE store_id = %(store_id)s AND source = %(source)s;
+        """
+        self._execute(query, {
+            "store_id": self.store_id,
+            "source": source.value,
+            "delta": delta,
+        }, cursor)
+
+
+def progress_is_complete(progress: dict | None,
+                         require_fresh: bool = False) -> bool:
+    if progress is None or progress["total"] == 0:
+        return False
+    if require_fresh and not progress["is_fresh"]:
+        return False
+    return progress["done"] == progress["total"]
@@ -0,0 +1,60 @@
+import heapq
+import itertools
+import time
+from typing import List, Optional, Tuple
+
+from app.tasks.task_base import TaskBase, TaskStatus
+
+
+class TaskScheduler:
+    """
+    Куча задач по времени, когда задача сможет сделать запрос
+    (лимитер, блокировка после 429, defer). При равном времени задачи
+    идут в порядке добавления, поэтому магазины обслуживаются по кругу.
+    """
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int, object, TaskBase]] = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, task: TaskBase, store=None):
+        if task.status != TaskStatus.IN_PROGRESS:
+            return
+        heapq.heappush(
+            self.heap,
+            (task.next_eligible_time(), next(self.counter), store, task),
+        )
+
+    def remove_store(self, store):
+        self.heap = [entry for entry in self.heap if entry[2] is not store]
+        heapq.heapify(self.heap)
+
+    def pop_ready(self) -> Optional[Tuple[object, TaskBase]]:
+        current_time = time.time()
+        while self.heap:
+            eligible_time, _, store, task = self.heap[0]
+            actual_eligible_time = task.next_eligible_time()
+
+            # лимитер мог сдвинуться (429) после постановки в очередь
+            if actual_eligible_time > eligible_time and actual_eligible_time > current_time:
+                heapq.heapreplace(
+                    self.heap,
+                    (actual_eligible_time, next(self.counter), store, task),
+                )
+                continue
+
+            if eligible_time > current_time:
+                return None
+
+            heapq.heappop(self.heap)
+            return store, task
+
+        return None
+
+    def seconds_until_next(self) -> Optional[float]:
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - time.time())
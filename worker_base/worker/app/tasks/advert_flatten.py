@@ -0,0 +1,146 @@
+from operator import itemgetter
+from typing import Iterable, Iterator, Tuple
+
+import numpy as np
+
+# колонки stg_advert_stat в порядке ADVERT_STAT_UPSERT
+ADVERT_STAT_INT_METRICS = ("views", "clicks", "atbs", "orders", "shks")
+ADVERT_STAT_FLOAT_METRICS = ("ctr", "cpc", "sum", "cr", "sum_price")
+ADVERT_STAT_METRICS = ("views", "clicks", "ctr", "cpc", "sum", "atbs",
+                       "orders", "cr", "shks", "sum_price")
+
+NM_VALUES_KEYS = ("nmId", ) + ADVERT_STAT_METRICS
+NM_VALUES_GETTER = itemgetter(*NM_VALUES_KEYS)
+
+ADVERT_FLATTEN_CHUNK_ADVERTS = 50
+
+PG_EPOCH = np.datetime64("2000-01-01", "D")
+
+# строка binary COPY: количество полей, затем (длина, значение) для каждого поля
+ADVERT_STAT_FIELDS = [("date", ">i4"), ("store_id", ">i4"),
+                      ("advert_id", ">i4"), ("app_type", ">i4"),
+                      ("nm_id", ">i4")] + [
+                          (name, ">f8" if name in ADVERT_STAT_FLOAT_METRICS
+                           else ">i4") for name in ADVERT_STAT_METRICS
+                      ]
+ADVERT_STAT_ROW_DTYPE = np.dtype([("field_count", ">i2")] + [
+    item for name, fmt in ADVERT_STAT_FIELDS
+    for item in ((f"{name}_len", ">i4"), (name, fmt))
+])
+
+
+class AdvertStatColumns:
+    """
+    Колонки статистики fullstats, собранные за один проход по
+    advert -> days -> apps -> nm. Значения приводятся к типам разом
+    для всей колонки (to_arrays), а не поштучно.
+    """
+
+    def __init__(self):
+        self.dates = []
+        self.advert_ids = []
+        self.app_types = []
+        self.nm_items = []
+
+    def __len__(self):
+        return len(self.nm_items)
+
+    def add_adverts(self, adverts: Iterable[dict]):
+        for single_advert in adverts:
+            advert_id = single_advert["advertId"]
+            for single_day in single_advert.get("days") or ():
+                date = single_day["date"][:10]
+                for single_app in single_day.get("apps") or ():
+                    nm = single_app.get("nm") or ()
+                    amount = len(nm)
+                    self.dates += [date] * amount
+                    self.advert_ids += [advert_id] * amount
+                    self.app_types += [single_app["appType"]] * amount
+                    self.nm_items += nm
+
+    def nm_values(self) -> list:
+        """(nmId, метрики...) по каждой строке; itemgetter, если все ключи на месте"""
+        try:
+            return list(map(NM_VALUES_GETTER, self.nm_items))
+        except KeyError:
+            return [
+                tuple(nm.get(key) for key in NM_VALUES_KEYS)
+                for nm in self.nm_items
+            ]
+
+    def to_arrays(self) -> dict:
+        """
+        Типизированные колонки. Пустые и нечисловые метрики -> 0 (как safe_int / safe_float).
+        Строки без nmId отбрасываются: в stg_advert_stat nm_id NOT NULL.
+        """
+        values = to_float_matrix(self.nm_values()).reshape(
+            -1, len(NM_VALUES_KEYS))
+        valid = ~np.isnan(values[:, 0])
+        values = values[valid]
+
+        arrays = {
+            "date": (np.array(self.dates, dtype="datetime64[D]") -
+                     PG_EPOCH).astype(np.int32)[valid],
+            "advert_id": np.array(self.advert_ids, dtype=np.int64)[valid],
+            "app_type": np.array(self.app_types, dtype=np.int64)[valid],
+            "nm_id": values[:, 0].astype(np.int64),
+        }
+        metrics = values[:, 1:]
+        metrics[np.isnan(metrics)] = 0
+        for index, name in enumerate(ADVERT_STAT_METRICS):
+            column = metrics[:, index]
+            if name in ADVERT_STAT_INT_METRICS:
+                column = np.trunc(column).astype(np.int64)
+            arrays[name] = column
+        return arrays
+
+    def to_binary_copy(self, store_id: int) -> Tuple[bytes, int]:
+        """Строки в формате binary COPY (без заголовка и трейлера) и их количество"""
+        arrays = self.to_arrays()
+        rows_count = len(arrays["nm_id"])
+        rows = np.empty(rows_count, dtype=ADVERT_STAT_ROW_DTYPE)
+        rows["field_count"] = len(ADVERT_STAT_FIELDS)
+        for name, fmt in ADVERT_STAT_FIELDS:
+            rows[f"{name}_len"] = np.dtype(fmt).itemsize
+            rows[name] = store_id if name == "store_id" else arrays[name]
+        return rows.tobytes(), rows_count
+
+
+def to_float_matrix(values: list) -> np.ndarray:
+    """Список строк -> 2D float64. None -> nan; "1.5" приводится, прочие нечисловые -> nan"""
+    try:
+        return np.array(values, dtype=np.float64)
+    except (ValueError, TypeError):
+        return np.array([[to_float_or_nan(v) for v in row] for row in values],
+                        dtype=np.float64)
+
+
+def to_float_or_nan(value) -> float:
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return np.nan
+
+
+def iter_advert_stat_copy_chunks(
+    adverts: Iterable[dict],
+    store_id: int,
+    chunk_adverts: int = ADVERT_FLATTEN_CHUNK_ADVERTS,
+) -> Iterator[Tuple[bytes, int]]:
+    """
+    Куски binary COPY для ADVERT_STAT_UPSERT по chunk_adverts кампаний:
+    память ограничена куском, даже если кампании читаются потоком.
+    """
+    adverts = iter(adverts)
+    while True:
+        columns = AdvertStatColumns()
+        chunk = []
+        for single_advert in adverts:
+            chunk.append(single_advert)
+            if len(chunk) >= chunk_adverts:
+                break
+        if not chunk:
+            return
+        columns.add_adverts(chunk)
+        if len(columns):
+            yield columns.to_binary_copy(store_id)
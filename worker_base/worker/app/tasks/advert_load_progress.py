@@ -0,0 +1,194 @@
+import datetime
+from typing import List, Sequence, Tuple
+
+from app.worker_public_config import (
+    STG_SCHEMA_NAME,
+    STG_ADVERT_INFO_TABLE_NAME,
+    STG_ADVERT_LOAD_PROGRESS_TABLE_NAME,
+    ADVERT_UPDATE_SCEDUAL,
+)
+
+ADVERT_DAYS_TO_LOAD = 90
+
+PROGRESS_TABLE = f"{STG_SCHEMA_NAME}.{STG_ADVERT_LOAD_PROGRESS_TABLE_NAME}"
+
+# окно загрузки: [CURRENT_DATE - ADVERT_DAYS_TO_LOAD, CURRENT_DATE]
+WINDOW_SQL = f"datemultirange(daterange(CURRENT_DATE - {ADVERT_DAYS_TO_LOAD}, CURRENT_DATE, '[]'))"
+
+# fresh - дни, загруженные до своего окончания (статистика неполная):
+# считаются загруженными, пока не истёк ADVERT_UPDATE_SCEDUAL
+FRESH_SQL = f"""CASE
+            WHEN p.fresh_loaded_at >= NOW() - INTERVAL '{ADVERT_UPDATE_SCEDUAL}' THEN p.fresh
+            ELSE '{{}}'::datemultirange
+        END"""
+
+PENDING_SQL = f"{WINDOW_SQL} - p.loaded - {FRESH_SQL}"
+
+
+def days_count_sql(multirange_sql: str) -> str:
+    """Количество дней в datemultirange (диапазоны ограничены окном)"""
+    return f"(SELECT COALESCE(SUM(upper(r) - lower(r)), 0) FROM unnest({multirange_sql}) r)"
+
+
+ACTIVE_ADVERTS_SQL = f"""
+    SELECT DISTINCT advert_id
+    FROM {STG_SCHEMA_NAME}.{STG_ADVERT_INFO_TABLE_NAME}
+    WHERE store_id = %(store_id)s
+    AND end_time >= (NOW() - INTERVAL '{ADVERT_DAYS_TO_LOAD} days')
+"""
+
+
+class AdvertLoadProgress:
+    """
+    Прогресс загрузки fullstats по магазину: одна строка на кампанию,
+    загруженные дни хранятся диапазонами (datemultirange), а не строкой
+    на каждую дату. Незагруженное = окно - loaded - fresh.
+    """
+
+    def __init__(self, db_handler, store_id: int):
+        self.db_handler = db_handler
+        self.store_id = store_id
+
+    def sync(self):
+        """
+        Приводит строки к списку активных кампаний: удаляет истёкшие,
+        добавляет новые с пустым loaded и обрезает loaded по окну.
+        """
+        query = f"""
+            DELETE FROM {PROGRESS_TABLE}
+            WHERE store_id = %(store_id)s
+            AND advert_id NOT IN ({ACTIVE_ADVERTS_SQL});
+
+            INSERT INTO {PROGRESS_TABLE} (store_id, advert_id)
+            SELECT %(store_id)s, advert_id
+            FROM ({ACTIVE_ADVERTS_SQL}) active
+            ON CONFLICT (store_id, advert_id) DO NOTHING;
+
+            UPDATE {PROGRESS_TABLE}
+            SET loaded = loaded * {WINDOW_SQL}
+            WHERE store_id = %(store_id)s
+            AND NOT loaded <@ {WINDOW_SQL};
+        """
+        self.db_handler.execute_query(query, {"store_id": self.store_id})
+
+    def next_unloaded(self,
+                      limit: int) -> List[Tuple[int, List[datetime.date]]]:
+        """До limit кампаний с наибольшим числом незагруженных дней: (advert_id, даты)"""
+        query = f"""
+            WITH pending AS (
+                SELECT p.advert_id, {PENDING_SQL} AS pending
+                FROM {PROGRESS_TABLE} p
+                WHERE p.store_id = %(store_id)s
+            )
+            SELECT
+                advert_id,
+                ARRAY(
+                    SELECT generate_series(lower(r), upper(r) - 1, INTERVAL '1 day')::date
+                    FROM unnest(pending) r
+                    ORDER BY 1
+                ) AS dates
+            FROM pending
+            WHERE NOT isempty(pending)
+            ORDER BY {days_count_sql("pending")} DESC, advert_id
+            LIMIT %(limit)s;
+        """
+        return self.db_handler.fetch_all(query, {
+            "store_id": self.store_id,
+            "limit": limit
+        })
+
+    def mark_loaded(self, covered: Sequence[dict],
+                    cursor=None) -> Tuple[int, int]:
+        """
+        covered - [{"id": advert_id, "dates": [...]}] из AdvertRequestPlan.
+        Завершившиеся дни добавляются в loaded, сегодняшние - в fresh.
+        Возвращает (кампаний обновлено, дней стало загружено) - для счётчиков
+        store_progress. Если передан cursor, выполняется во внешней транзакции.
+        """
+        advert_ids = []
+        dates = []
+        for item in covered:
+            for date in item["dates"]:
+                advert_ids.append(item["id"])
+                dates.append(date)
+        if not advert_ids:
+            return 0, 0
+
+        query = f"""
+            WITH marked AS (
+                SELECT
+                    advert_id,
+                    range_agg(daterange(d, d, '[]')) FILTER (WHERE d < CURRENT_DATE) AS complete,
+                    range_agg(daterange(d, d, '[]')) FILTER (WHERE d >= CURRENT_DATE) AS partial
+                FROM unnest(%(advert_ids)s::int[], %(dates)s::date[]) AS m(advert_id, d)
+                GROUP BY advert_id
+            ),
+            before AS (
+                SELECT p.advert_id, {days_count_sql(PENDING_SQL)} AS pending_days
+                FROM {PROGRESS_TABLE} p
+                JOIN marked m ON m.advert_id = p.advert_id
+                WHERE p.store_id = %(store_id)s
+            ),
+            updated AS (
+                UPDATE {PROGRESS_TABLE} p
+                SET
+                    loaded = p.loaded + COALESCE(m.complete, '{{}}'),
+                    fresh = COALESCE(m.partial, p.fresh - COALESCE(m.complete, '{{}}')),
+                    fresh_loaded_at = CASE
+                        WHEN m.partial IS NULL THEN p.fresh_loaded_at
+                        ELSE NOW()
+                    END,
+                    updated_at = NOW()
+                FROM marked m
+                WHERE p.store_id = %(store_id)s
+                AND p.advert_id = m.advert_id
+                RETURNING p.advert_id, {days_count_sql(PENDING_SQL)} AS pending_days
+            )
+            SELECT
+                COUNT(*) AS adverts,
+                COALESCE(SUM(b.pending_days - u.pending_days), 0) AS days
+            FROM updated u
+            JOIN before b ON b.advert_id = u.advert_id;
+        """
+        params = {
+            "store_id": self.store_id,
+            "advert_ids": advert_ids,
+            "dates": dates,
+        }
+        if cursor is not None:
+            cursor.execute(query, params)
+            return cursor.fetchone()
+
+        with self.db_handler.connection as connection:
+            with connection.cursor() as cur:
+                cur.execute(query, params)
+                return cur.fetchone()
+
+    def counts(self) -> dict:
+        """
+        adverts - строк прогресса, active_adverts - активных кампаний,
+        missing_adverts / stale_adverts - расхождение между ними,
+        days_total / days_loaded - дней в окне по всем кампаниям.
+        """
+        query = f"""
+            WITH progress AS (
+                SELECT
+                    p.advert_id,
+                    {days_count_sql(PENDING_SQL)} AS pending_days
+                FROM {PROGRESS_TABLE} p
+                WHERE p.store_id = %(store_id)s
+            ),
+            active AS ({ACTIVE_ADVERTS_SQL})
+            SELECT
+                (SELECT COUNT(*) FROM progress) AS adverts,
+                (SELECT COUNT(*) FROM active) AS active_adverts,
+                (SELECT COUNT(*) FROM active a
+                 WHERE NOT EXISTS (SELECT 1 FROM progress p WHERE p.advert_id = a.advert_id)) AS missing_adverts,
+                (SELECT COUNT(*) FROM progress p
+                 WHERE NOT EXISTS (SELECT 1 FROM active a WHERE a.advert_id = p.advert_id)) AS stale_adverts,
+                (SELECT COUNT(*) * ({ADVERT_DAYS_TO_LOAD} + 1) FROM progress) AS days_total,
+                (SELECT COUNT(*) * ({ADVERT_DAYS_TO_LOAD} + 1) - COALESCE(SUM(pending_days), 0)
+                 FROM progress) AS days_loaded;
+        """
+        return self.db_handler.execute_and_fetch_single_row(
+            query, {"store_id": self.store_id})
@@ -0,0 +1,68 @@
+import datetime
+from typing import Iterable, List, Sequence, Tuple
+
+# ограничения /adv/v2/fullstats
+ADVERT_IDS_PER_REQUEST = 100
+ADVERT_DATES_PER_ITEM = 31
+
+
+class AdvertRequestPlan:
+    """
+    payload - тело запроса fullstats,
+    covered - какие даты по каким кампаниям он покрывает (для mark_adverts_as_loaded).
+    """
+
+    def __init__(self):
+        self.payload: List[dict] = []
+        self.covered: List[dict] = []
+
+    def __len__(self):
+        return len(self.payload)
+
+    def pairs_amount(self) -> int:
+        return sum(len(item["dates"]) for item in self.covered)
+
+    def add(self, advert_id: int, dates: Sequence[datetime.date]):
+        dates = sorted(dates)
+        if is_contiguous(dates):
+            self.payload.append({
+                "id": advert_id,
+                "interval": {
+                    "begin": dates[0].isoformat(),
+                    "end": dates[-1].isoformat(),
+                },
+            })
+        else:
+            self.payload.append({
+                "id": advert_id,
+                "dates": [d.isoformat() for d in dates],
+            })
+        self.covered.append({
+            "id": advert_id,
+            "dates": [d.isoformat() for d in dates],
+        })
+
+
+def is_contiguous(dates: Sequence[datetime.date]) -> bool:
+    return len(dates) > 1 and (dates[-1] - dates[0]).days == len(dates) - 1
+
+
+def plan_advert_request(
+    missing: Iterable[Tuple[int, Sequence[datetime.date]]],
+    max_adverts: int = ADVERT_IDS_PER_REQUEST,
+    max_dates: int = ADVERT_DATES_PER_ITEM,
+) -> AdvertRequestPlan:
+    """
+    missing - (advert_id, незагруженные даты). В запрос попадают до max_adverts
+    кампаний, первыми - с наибольшим числом незагруженных дней; по каждой -
+    первые max_dates дат: сплошной отрезок отправляется как interval,
+    иначе - списком dates.
+    """
+    missing = [(advert_id, sorted(dates)) for advert_id, dates in missing
+               if dates]
+    missing.sort(key=lambda item: (-len(item[1]), item[0]))
+
+    plan = AdvertRequestPlan()
+    for advert_id, dates in missing[:max_adverts]:
+        plan.add(advert_id, dates[:max_dates])
+    return plan
@@ -0,0 +1,64 @@
+from app.worker_public_config import STG_SCHEMA_NAME, STG_ADVERT_INFO_TABLE_NAME, ADVERT_UPDATE_SCEDUAL
+from app.store_progress import ProgressSource, progress_is_complete
+
+
+class AdvertStatusMixin:
+    """
+    advert_list_is_ok / advert_info_is_ok для taskAdvertInfo и taskAdvert.
+    Читают счётчики store_progress; агрегат по stg_advert_info считается
+    только при сверке (check_due) и перезаписывает счётчики.
+    """
+
+    def recount_advert_list(self) -> dict:
+        query = f"""
+            SELECT
+                COUNT(CASE WHEN (al.created_at)::DATE >= (CURRENT_TIMESTAMP - INTERVAL '{ADVERT_UPDATE_SCEDUAL}')::DATE THEN 1 END) AS actual,
+                COUNT(*) AS count_all,
+                MIN(al.created_at) AS refreshed_at
+            FROM {STG_SCHEMA_NAME}.{STG_ADVERT_INFO_TABLE_NAME} al
+            WHERE al.store_id = %s;
+        """
+
+        status_report = self.db_handler.execute_and_fetch_single_row(
+            query, (self.store_id, ))
+        self.store_progress.set(
+            ProgressSource.ADVERT_LIST,
+            total=status_report["count_all"],
+            done=status_report["actual"],
+            refreshed_at=status_report["refreshed_at"],
+            checked=True,
+        )
+        return self.store_progress.get(ProgressSource.ADVERT_LIST)
+
+    def recount_advert_info(self) -> dict:
+        query = f"""
+            SELECT
+                COUNT(CASE WHEN last_info_update_time >= (CURRENT_TIMESTAMP - INTERVAL '{ADVERT_UPDATE_SCEDUAL}') THEN 1 END) AS actual_count,
+                COUNT(*) AS total_count,
+                MIN(last_info_update_time) AS refreshed_at
+            FROM {STG_SCHEMA_NAME}.{STG_ADVERT_INFO_TABLE_NAME}
+            WHERE store_id = %s;
+        """
+
+        status_report = self.db_handler.execute_and_fetch_single_row(
+            query, (self.store_id, ))
+        self.store_progress.set(
+            ProgressSource.ADVERT_INFO,
+            total=status_report["total_count"],
+            done=status_report["actual_count"],
+            refreshed_at=status_report["refreshed_at"],
+            checked=True,
+        )
+        return self.store_progress.get(ProgressSource.ADVERT_INFO)
+
+    def advert_list_is_ok(self) -> bool:
+        progress = self.store_progress.get(ProgressSource.ADVERT_LIST)
+        if progress is None or progress["check_due"]:
+            progress = self.recount_advert_list()
+        return progress_is_complete(progress, require_fresh=True)
+
+    def advert_info_is_ok(self) -> bool:
+        progress = self.store_progress.get(ProgressSource.ADVERT_INFO)
+        if progress is None or progress["check_due"]:
+            progress = self.recount_advert_info()
+        return progress_is_complete(progress, require_fresh=True)
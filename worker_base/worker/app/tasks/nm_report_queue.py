@@ -0,0 +1,338 @@
+import os
+from enum import Enum
+
+from app.worker_public_config import (
+    STG_SCHEMA_NAME,
+    STG_NM_REPORT_DETAIL_INFO_TABLE_NAME,
+    STG_NM_REPORT_QUEUE_TABLE_NAME,
+)
+
+NM_REPORT_DETAIL_TARGET_DATES_AMOUNT = 90
+NM_REPORT_SCHEDUAL = '6 hours 15 minutes'
+
+# сколько элемент очереди считается занятым воркером, потом его может забрать другой
+NM_REPORT_QUEUE_LEASE = '10 minutes'
+
+# даты старше горизонта после успешной загрузки окончательные и не перезапрашиваются,
+# последние NM_REPORT_SETTLED_HORIZON_DAYS дней окна обновляются раз в NM_REPORT_SCHEDUAL
+NM_REPORT_SETTLED_HORIZON_DAYS = int(
+    os.getenv("NM_REPORT_SETTLED_HORIZON_DAYS", 14))
+
+# /nm-report/detail/history отдаёт только последние дни
+NM_REPORT_HISTORY_DAYS = 7
+
+
+class NmReportStrategy(Enum):
+    DETAIL = "detail"  # день за запрос, page - страница карточек
+    HISTORY = "history"  # несколько дней за запрос, history_nm_id - последний загруженный nmID
+
+
+QUEUE_TABLE = f"{STG_SCHEMA_NAME}.{STG_NM_REPORT_QUEUE_TABLE_NAME}"
+INFO_TABLE = f"{STG_SCHEMA_NAME}.{STG_NM_REPORT_DETAIL_INFO_TABLE_NAME}"
+
+# последняя дата окна: окно сдвигается раз в сутки с задержкой NM_REPORT_SCHEDUAL
+WINDOW_END_SQL = f"((CURRENT_TIMESTAMP - INTERVAL '{NM_REPORT_SCHEDUAL}') - INTERVAL '1 day')::date"
+WINDOW_START_SQL = f"((CURRENT_TIMESTAMP - INTERVAL '{NM_REPORT_SCHEDUAL}') - INTERVAL '{NM_REPORT_DETAIL_TARGET_DATES_AMOUNT} days')::date"
+# первая неокончательная дата
+UNSETTLED_FROM_SQL = f"({WINDOW_END_SQL} - {NM_REPORT_SETTLED_HORIZON_DAYS} + 1)"
+# claimable - элемент свободен или аренда истекла
+CLAIMABLE_SQL = """(
+                    status = 'pending'
+                    OR (status = 'claimed' AND lease_until < NOW())
+                )"""
+HISTORY_RANGE_SQL = f"CURRENT_DATE - {NM_REPORT_HISTORY_DAYS}"
+# загруженные недавние даты, которые пора обновить
+STALE_RECENT_SQL = f"""status = 'done'
+                AND fact_date >= {UNSETTLED_FROM_SQL}
+                AND updated_at < NOW() - INTERVAL '{NM_REPORT_SCHEDUAL}'"""
+
+
+class NmReportQueue:
+    """
+    Очередь (date, page) для taskNmReportDetail: одна строка на дату окна,
+    page - следующая страница. Наполняется один раз на окно (seed), элементы
+    забираются через FOR UPDATE SKIP LOCKED с арендой NM_REPORT_QUEUE_LEASE,
+    поэтому одну очередь могут разбирать несколько воркеров.
+    status: pending - ждёт загрузки, claimed - занят, done - дата загружена.
+    strategy - каким запросом загружается дата (NmReportStrategy).
+    history_nm_id - последний загруженный nmID стратегии history (0 - не начата).
+    refresh_started_at - загруженная дата обновляется: её строки не удаляются
+    с первой страницей, а обновляются, и после последней страницы удаляются
+    только строки, не полученные с начала обновления.
+    """
+
+    def __init__(self, db_handler, store_id: int):
+        self.db_handler = db_handler
+        self.store_id = store_id
+        self.worker_id = os.getenv("WORKER", "worker_default")
+
+    def _execute(self, query: str, params: dict, cursor=None):
+        if cursor is not None:
+            cursor.execute(query, params)
+            return
+        self.db_handler.execute_query(query, params)
+
+    def is_seeded(self) -> bool:
+        """
+        Очередь наполнена для текущего окна (последняя дата окна на месте)
+        и недавние даты не требуют обновления.
+        """
+        query = f"""
+            SELECT
+                EXISTS (
+                    SELECT 1 FROM {QUEUE_TABLE}
+                    WHERE store_id = %(store_id)s AND fact_date = {WINDOW_END_SQL}
+                )
+                AND NOT EXISTS (
+                    SELECT 1 FROM {QUEUE_TABLE}
+                    WHERE store_id = %(store_id)s
+                    AND {STALE_RECENT_SQL}
+                ) AS seeded;
+        """
+        row = self.db_handler.execute_and_fetch_single_row(
+            query, {"store_id": self.store_id})
+        return bool(row and row["seeded"])
+
+    def seed(self):
+        """
+        Удаляет даты вне окна и добавляет новые. Уже загруженные даты
+        (по stg_nm_report_detail_info) сразу done, начатые - с их следующей страницы.
+        Недавние (моложе горизонта) загруженные даты возвращаются в очередь
+        с первой страницы, если загружены раньше, чем NM_REPORT_SCHEDUAL назад.
+        """
+        query = f"""
+            DELETE FROM {QUEUE_TABLE}
+            WHERE store_id = %(store_id)s
+            AND (fact_date < {WINDOW_START_SQL} OR fact_date > {WINDOW_END_SQL});
+
+            INSERT INTO {QUEUE_TABLE} (store_id, fact_date, page, status, updated_at)
+            SELECT
+                %(store_id)s,
+                td.target_date,
+                CASE WHEN si.is_next_page THEN si.page + 1 ELSE 1 END,
+                CASE WHEN si.is_next_page = false THEN 'done' ELSE 'pending' END,
+                COALESCE(si.created_at, NOW())
+            FROM generate_series({WINDOW_START_SQL}, {WINDOW_END_SQL}, INTERVAL '1 day') AS td(target_date)
+            LEFT JOIN {INFO_TABLE} si
+            ON si.store_id = %(store_id)s AND si.fact_date = td.target_date
+            ON CONFLICT (store_id, fact_date) DO NOTHING;
+
+            UPDATE {QUEUE_TABLE}
+            SET page = 1, status = 'pending', strategy = 'detail', history_nm_id = 0, refresh_started_at = NOW(),
+                claimed_by = NULL, lease_until = NULL, updated_at = NOW()
+            WHERE store_id = %(store_id)s
+            AND {STALE_RECENT_SQL};
+        """
+        self.db_handler.execute_query(query, {"store_id": self.store_id})
+
+    def claim(self,
+              limit: int = 1,
+              strategy: NmReportStrategy = NmReportStrategy.DETAIL
+              ) -> list[dict]:
+        """До limit следующих (fact_date, page) по порядку дат; пустой список - свободных нет"""
+        query = f"""
+            UPDATE {QUEUE_TABLE} q
+            SET
+                status = 'claimed',
+                claimed_by = %(worker_id)s,
+                lease_until = NOW() + INTERVAL '{NM_REPORT_QUEUE_LEASE}',
+                updated_at = NOW()
+            WHERE (q.store_id, q.fact_date) IN (
+                SELECT store_id, fact_date
+                FROM {QUEUE_TABLE}
+                WHERE store_id = %(store_id)s
+                AND strategy = %(strategy)s
+                AND {CLAIMABLE_SQL}
+                ORDER BY fact_date
+                LIMIT %(limit)s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING q.fact_date, q.page, q.refresh_started_at;
+        """
+        items = self.db_handler.execute_and_fetch_all(
+            query, {
+                "store_id": self.store_id,
+                "worker_id": self.worker_id,
+                "limit": limit,
+                "strategy": strategy.value,
+            })
+        return sorted(items or [], key=lambda item: item["fact_date"])
+
+    def claim_history(self) -> list[dict]:
+        """
+        Даты стратегии history с наименьшим последним nmID: один запрос history
+        покрывает их все, поэтому они забираются и продвигаются вместе.
+        """
+        query = f"""
+            UPDATE {QUEUE_TABLE} q
+            SET
+                status = 'claimed',
+                claimed_by = %(worker_id)s,
+                lease_until = NOW() + INTERVAL '{NM_REPORT_QUEUE_LEASE}',
+                updated_at = NOW()
+            WHERE (q.store_id, q.fact_date) IN (
+                SELECT store_id, fact_date
+                FROM {QUEUE_TABLE}
+                WHERE store_id = %(store_id)s
+                AND strategy = %(strategy)s
+                AND {CLAIMABLE_SQL}
+                AND history_nm_id = (
+                    SELECT MIN(history_nm_id) FROM {QUEUE_TABLE}
+                    WHERE store_id = %(store_id)s
+                    AND strategy = %(strategy)s
+                    AND {CLAIMABLE_SQL}
+                )
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING q.fact_date, q.history_nm_id;
+        """
+        items = self.db_handler.execute_and_fetch_all(
+            query, {
+                "store_id": self.store_id,
+                "worker_id": self.worker_id,
+                "strategy": NmReportStrategy.HISTORY.value,
+            })
+        return sorted(items or [], key=lambda item: item["fact_date"])
+
+    def get_history_candidates(self) -> dict:
+        """
+        Данные для выбора стратегии: dates - несделанные даты, которые может покрыть
+        history (ещё не начаты, в пределах NM_REPORT_HISTORY_DAYS и не обновления:
+        в history нет отмен и средней цены, обновление идёт через detail),
+        avg_pages - среднее число страниц detail на загруженную дату.
+        """
+        query = f"""
+            SELECT
+                (SELECT COUNT(*) FROM {QUEUE_TABLE}
+                 WHERE store_id = %(store_id)s
+                 AND status = 'pending' AND page = 1 AND history_nm_id = 0
+                 AND refresh_started_at IS NULL
+                 AND fact_date >= {HISTORY_RANGE_SQL}) AS dates,
+                (SELECT COALESCE(AVG(page), 1) FROM {INFO_TABLE}
+                 WHERE store_id = %(store_id)s
+                 AND is_next_page = false
+                 AND fact_date >= {WINDOW_START_SQL}) AS avg_pages;
+        """
+        return self.db_handler.execute_and_fetch_single_row(
+            query, {"store_id": self.store_id})
+
+    def set_strategy(self, strategy: NmReportStrategy):
+        """Стратегия для ещё не начатых и не обновляемых дат в пределах NM_REPORT_HISTORY_DAYS"""
+        query = f"""
+            UPDATE {QUEUE_TABLE}
+            SET strategy = %(strategy)s
+            WHERE store_id = %(store_id)s
+            AND status = 'pending' AND page = 1 AND history_nm_id = 0
+            AND refresh_started_at IS NULL
+            AND fact_date >= {HISTORY_RANGE_SQL};
+        """
+        self.db_handler.execute_query(query, {
+            "store_id": self.store_id,
+            "strategy": strategy.value,
+        })
+
+    def release(self, fact_date, cursor=None):
+        """Возвращает элемент в очередь без продвижения (ошибка запроса, лимит)"""
+        query = f"""
+            UPDATE {QUEUE_TABLE}
+            SET status = 'pending', claimed_by = NULL, lease_until = NULL, updated_at = NOW()
+            WHERE store_id = %(store_id)s AND fact_date = %(fact_date)s
+            AND status = 'claimed' AND claimed_by = %(worker_id)s;
+        """
+        self._execute(
+            query, {
+                "store_id": self.store_id,
+                "fact_date": fact_date,
+                "worker_id": self.worker_id,
+            }, cursor)
+
+    def complete_page(self,
+                      fact_date,
+                      page: int,
+                      is_next_page: bool,
+                      in_flight: bool = False,
+                      cursor=None):
+        """
+        Страница загружена: элемент переходит на следующую страницу или в done,
+        stg_nm_report_detail_info обновляется так же, как раньше.
+        in_flight - следующая страница уже запрошена: элемент остаётся занятым,
+        аренда продлевается. Вызывается в транзакции вставки страницы (cursor=).
+        """
+        query = f"""
+            UPDATE {QUEUE_TABLE}
+            SET
+                page = %(page)s + 1,
+                status = CASE
+                    WHEN NOT %(is_next_page)s THEN 'done'
+                    WHEN %(in_flight)s THEN 'claimed'
+                    ELSE 'pending'
+                END,
+                claimed_by = CASE WHEN %(is_next_page)s AND %(in_flight)s THEN %(worker_id)s END,
+                lease_until = CASE
+                    WHEN %(is_next_page)s AND %(in_flight)s THEN NOW() + INTERVAL '{NM_REPORT_QUEUE_LEASE}'
+                END,
+                refresh_started_at = CASE WHEN %(is_next_page)s THEN refresh_started_at END,
+                updated_at = NOW()
+            WHERE store_id = %(store_id)s AND fact_date = %(fact_date)s;
+
+            INSERT INTO {INFO_TABLE} (store_id, page, is_next_page, cant_be_load, fact_date, created_at)
+            VALUES (%(store_id)s, %(page)s, %(is_next_page)s, FALSE, %(fact_date)s, CURRENT_TIMESTAMP)
+            ON CONFLICT (store_id, fact_date)
+            DO UPDATE SET
+                page = EXCLUDED.page,
+                is_next_page = EXCLUDED.is_next_page,
+                cant_be_load = FALSE,
+                created_at = CURRENT_TIMESTAMP;
+        """
+        self._execute(
+            query, {
+                "store_id": self.store_id,
+                "fact_date": fact_date,
+                "page": page,
+                "is_next_page": is_next_page,
+                "in_flight": in_flight,
+                "worker_id": self.worker_id,
+            }, cursor)
+
+    def complete_history_batch(self,
+                               fact_date,
+                               last_nm_id: int,
+                               is_next_page: bool,
+                               cursor=None):
+        """
+        Пачка nmID history сохранена: продвигается только очередь (history_nm_id),
+        stg_nm_report_detail_info не меняется (там page - страницы detail).
+        Пока есть следующая пачка, элемент остаётся занятым с продлённой арендой.
+        """
+        query = f"""
+            UPDATE {QUEUE_TABLE}
+            SET
+                history_nm_id = %(last_nm_id)s,
+                status = CASE WHEN %(is_next_page)s THEN 'claimed' ELSE 'done' END,
+                claimed_by = CASE WHEN %(is_next_page)s THEN %(worker_id)s END,
+                lease_until = CASE
+                    WHEN %(is_next_page)s THEN NOW() + INTERVAL '{NM_REPORT_QUEUE_LEASE}'
+                END,
+                updated_at = NOW()
+            WHERE store_id = %(store_id)s AND fact_date = %(fact_date)s;
+        """
+        self._execute(
+            query, {
+                "store_id": self.store_id,
+                "fact_date": fact_date,
+                "last_nm_id": last_nm_id,
+                "is_next_page": is_next_page,
+                "worker_id": self.worker_id,
+            }, cursor)
+
+    def has_unfinished(self) -> bool:
+        """Есть незагруженные даты (в том числе занятые другими воркерами)"""
+        query = f"""
+            SELECT EXISTS (
+                SELECT 1 FROM {QUEUE_TABLE}
+                WHERE store_id = %(store_id)s AND status <> 'done'
+            ) AS unfinished;
+        """
+        row = self.db_handler.execute_and_fetch_single_row(
+            query, {"store_id": self.store_id})
+        return bool(row and row["unfinished"])
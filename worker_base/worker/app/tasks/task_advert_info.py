@@ -8,9 +8,6 @@ import json
 import warnings
 from urllib3.exceptions import InsecureRequestWarning
 
-from io import StringIO
-import csv
-
 warnings.simplefilter('ignore', InsecureRequestWarning)
 
 from .task_base import (
@@ -19,26 +16,68 @@ from .task_base import (
 )
 
 from app.worker_public_config import STG_SCHEMA_NAME, STG_ADVERT_INFO_TABLE_NAME, ADVERT_UPDATE_SCEDUAL
+from app.bulk_loader import BulkUpsert, UpsertPolicy
+from app.store_progress import StoreProgress, ProgressSource
+from .advert_status import AdvertStatusMixin
+
+ADVERT_LIST_UPSERT = BulkUpsert(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_ADVERT_INFO_TABLE_NAME,
+    columns=[
+        ("store_id", "int4"),
+        ("advert_id", "int4"),
+        ("advert_type", "int4"),
+    ],
+    key_columns=("store_id", "advert_id"),
+    policy=UpsertPolicy.UPDATE,
+)
 
+ADVERT_INFO_UPDATE = BulkUpsert(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_ADVERT_INFO_TABLE_NAME,
+    columns=[
+        ("store_id", "int4"),
+        ("advert_id", "int4"),
+        ("start_time", "timestamptz"),
+        ("end_time", "timestamptz"),
+        ("create_time", "timestamptz"),
+        ("change_time", "timestamptz"),
+    ],
+    key_columns=("store_id", "advert_id"),
+    policy=UpsertPolicy.UPDATE_EXISTING,
+    extra_updates={"last_info_update_time": "CURRENT_TIMESTAMP"},
+)
 
-class taskAdvertInfo(TaskBase):
-    task_class_identifier = "taskAdvertInfo"
 
-    def __init__(self, db_handler, logger, store_id, api_token, last_run_time):
+class taskAdvertInfo(AdvertStatusMixin, TaskBase):
+    task_class_identifier = "taskAdvertInfo"
+    replay_endpoints = ("/adv/v1/promotion/count", "/adv/v1/promotion/adverts")
+
+    def __init__(self,
+                 db_handler,
+                 logger,
+                 store_id,
+                 api_token,
+                 last_run_time,
+                 http_sessions=None,
+                 raw_store=None):
         super().__init__(
             db_handler,
             logger,
             store_id,
             api_token,
             last_run_time,
+            http_sessions,
+            raw_store,
         )
+        self.store_progress = StoreProgress(db_handler, store_id)
 
     def get_advert_list_data(self):
         url = "https://advert-api.wildberries.ru/adv/v1/promotion/count"
 
         headers = {"Authorization": self.api_token}
         try:
-            response = requests.get(f"{url}", headers=headers, verify=False)
+            response = self.fetch_raw("GET", url, headers=headers, verify=False)
 
             if response.status_code == 200:
                 data = response.json()
@@ -65,68 +104,6 @@ class taskAdvertInfo(TaskBase):
 
         return advert_list_mapping
 
-    def advert_list_is_ok(self):
-        query = f"""
-            SELECT
-                COUNT(CASE WHEN (al.created_at)::DATE >= (CURRENT_TIMESTAMP - INTERVAL '{ADVERT_UPDATE_SCEDUAL}')::DATE THEN 1 END) AS actual,
-                COUNT(*) AS count_all
-            FROM {STG_SCHEMA_NAME}.{STG_ADVERT_INFO_TABLE_NAME} al
-            WHERE al.store_id = {self.store_id};
-        """
-
-        status_report = self.db_handler.execute_and_fetch_single_row(query)
-
-        actual = status_report["actual"]
-        count_all = status_report["count_all"]
-
-        if count_all == 0 or actual < count_all:
-            return False
-        elif actual == count_all:
-            return True
-        else:
-            self.logger.error(
-                source="advert_list_is_ok",
-                message=f"unknown status_report",
-                store_id=self.store_id,
-            )
-            return False
-
-    def advert_info_is_ok(self):
-        query = f"""
-            SELECT
-                COUNT(CASE WHEN last_info_update_time IS NULL THEN 1 END) AS null_count,
-                COUNT(CASE WHEN last_info_update_time >= (CURRENT_TIMESTAMP - INTERVAL '{ADVERT_UPDATE_SCEDUAL}') THEN 1 END) AS actual_count,
-                COUNT(*) AS total_count
-            FROM {STG_SCHEMA_NAME}.{STG_ADVERT_INFO_TABLE_NAME}
-            WHERE store_id = {self.store_id};
-        """
-
-        status_report = self.db_handler.execute_and_fetch_single_row(query)
-
-        null_count = status_report["null_count"]
-        actual_count = status_report["actual_count"]
-        total_count = status_report["total_count"]
-
-        if total_count == 0:
-            return False
-
-        if null_count > 0:
-            return False
-
-        if actual_count < total_count:
-            return False
-
-        if actual_count == total_count:
-            return True
-
-        self.logger.error(
-            source="advert_info_is_ok",
-            message=f"unknown status_report",
-            store_id=self.store_id,
-        )
-
-        return False
-
     def get_advert_ids_by_store(self) -> list[int]:
         query = f"""
             SELECT advert_id 
@@ -168,10 +145,10 @@ class taskAdvertInfo(TaskBase):
             time.sleep(0.25)
             payload = parts[i]
             try:
-                response = requests.post(url,
-                                         headers=headers,
-                                         json=payload,
-                                         verify=False)
+                response = self.fetch_raw("POST", url,
+                                          headers=headers,
+                                          json=payload,
+                                          verify=False)
                 if response.status_code == 200:
                     adverts = response.json()
                     result.extend(adverts)
@@ -222,71 +199,37 @@ class taskAdvertInfo(TaskBase):
             )
             return None
 
-    def insert_advert_info(self, advert_data: list[dict]) -> bool:
+    def advert_info_rows(self, advert_data: list[dict]):
+        return ((self.store_id, item['advert_id'], item['start_time'],
+                 item['end_time'], item['create_time'], item['change_time'])
+                for item in advert_data)
+
+    def advert_list_rows(self, advert_data: list[dict]):
+        return ((self.store_id, item["advert_id"], item["advert_type"])
+                for item in advert_data)
+
+    def insert_advert_info(self, advert_data: list[dict], total: int) -> bool:
+        """total - кампаний в списке; счётчик advert_info обновляется в той же транзакции"""
         if not advert_data:
             return False
 
+        rows = self.advert_info_rows(advert_data)
+
         try:
-            start_time = time.time()
-
-            temp_table_name = f"temp_{STG_ADVERT_INFO_TABLE_NAME}_info"
-            create_temp_table_query = f"""
-            CREATE TEMP TABLE {temp_table_name} (
-                store_id INTEGER,
-                advert_id INTEGER,
-                start_time TIMESTAMP,
-                end_time TIMESTAMP,
-                create_time TIMESTAMP,
-                change_time TIMESTAMP
-            ) ON COMMIT DROP;
-            """
-            buf = StringIO()
-            writer = csv.writer(buf, delimiter='\t')
-
-            for item in advert_data:
-                row = (self.store_id, item['advert_id'], item['start_time'],
-                       item['end_time'], item['create_time'],
-                       item['change_time'])
-                writer.writerow(row)
-
-            buf.seek(0)
-
-            with self.db_handler.connection:
-                with self.db_handler.connection.cursor() as cur:
-                    cur.execute(create_temp_table_query)
-                    cur.copy_from(buf,
-                                  temp_table_name,
-                                  sep='\t',
-                                  columns=('store_id', 'advert_id',
-                                           'start_time', 'end_time',
-                                           'create_time', 'change_time'))
-
-                    update_query = f"""
-                    UPDATE {STG_SCHEMA_NAME}.{STG_ADVERT_INFO_TABLE_NAME} AS target
-                    SET
-                        start_time = temp.start_time,
-                        end_time = temp.end_time,
-                        create_time = temp.create_time,
-                        change_time = temp.change_time,
-                        last_info_update_time = CURRENT_TIMESTAMP
-                    FROM {temp_table_name} AS temp
-                    WHERE target.store_id = temp.store_id
-                    AND target.advert_id = temp.advert_id;
-                    """
-                    cur.execute(update_query)
-                    cur.execute(f"SELECT COUNT(*) FROM {temp_table_name}")
-                    updated_count = cur.fetchone()[0]
-
-            duration = time.time() - start_time
-            print(
-                f"-- insert_advert_info -- \nUpdated {updated_count} records in {duration:.2f} seconds"
-            )
+            with self.db_handler.connection as connection:
+                with connection.cursor() as cur:
+                    result = ADVERT_INFO_UPDATE.load(self.db_handler,
+                                                     rows,
+                                                     cursor=cur)
+                    self.store_progress.set(ProgressSource.ADVERT_INFO,
+                                            total=total,
+                                            done=result.updated,
+                                            cursor=cur)
+            print(f"-- insert_advert_info -- \n{result}")
 
             return True
 
         except Exception as e:
-            if self.db_handler.connection:
-                self.db_handler.connection.rollback()
             self.logger.error(
                 source="process_all_advert_info_data",
                 message=f"Error in bulk update via temp table: {str(e)}",
@@ -294,77 +237,63 @@ class taskAdvertInfo(TaskBase):
             )
             return False
 
-    def delete_advert_list_by_store_id(self):
-        query = f"""
-            DELETE FROM {STG_SCHEMA_NAME}.{STG_ADVERT_INFO_TABLE_NAME}
-            WHERE store_id = {self.store_id};
-        """
-        try:
-            self.db_handler.execute_query(query)
-            return f"Deleted advert list entries for store_id={self.store_id}"
-        except Exception as e:
-            return f"Error while deleting advert list entries for store_id={self.store_id}: {str(e)}"
-
     def insert_advert_list(self, advert_data: list) -> str:
+        """
+        Заменяет список кампаний магазина и обнуляет счётчик advert_info
+        (информацию по новому списку нужно загрузить заново) - одной транзакцией.
+        """
         if not advert_data:
             return "No advert data to insert"
 
-        try:
-            start_time = time.time()
-
-            temp_table_name = f"temp_{STG_ADVERT_INFO_TABLE_NAME}"
-            create_temp_table_query = f"""
-            CREATE TEMP TABLE {temp_table_name} (
-                store_id INTEGER,
-                advert_id INTEGER,
-                advert_type INTEGER
-            ) ON COMMIT DROP;
-            """
-
-            buf = StringIO()
-            writer = csv.writer(buf, delimiter='\t')
-
-            for item in advert_data:
-                row = (self.store_id, item["advert_id"], item["advert_type"])
-                writer.writerow(row)
-
-            buf.seek(0)
-
-            with self.db_handler.connection:
-                with self.db_handler.connection.cursor() as cur:
-                    cur.execute(create_temp_table_query)
-                    cur.copy_from(buf,
-                                  temp_table_name,
-                                  sep='\t',
-                                  columns=('store_id', 'advert_id',
-                                           'advert_type'))
-                    insert_query = f"""
-                        INSERT INTO {STG_SCHEMA_NAME}.{STG_ADVERT_INFO_TABLE_NAME} AS target
-                            (store_id, advert_id, advert_type)
-                        SELECT 
-                            store_id, advert_id, advert_type
-                        FROM {temp_table_name}
-                        ON CONFLICT (store_id, advert_id)
-                        DO UPDATE SET
-                            advert_type = EXCLUDED.advert_type;
-                        """
-                    cur.execute(insert_query)
-                    cur.execute(f"SELECT COUNT(*) FROM {temp_table_name}")
-                    processed_count = cur.fetchone()[0]
-
-            duration = time.time() - start_time
-            print(
-                f"-- insert_advert_list -- \nProcessed {processed_count} records in {duration:.2f} seconds"
-            )
+        rows = self.advert_list_rows(advert_data)
+        delete_query = f"""
+            DELETE FROM {STG_SCHEMA_NAME}.{STG_ADVERT_INFO_TABLE_NAME}
+            WHERE store_id = %s;
+        """
 
-            return f"Successfully processed {processed_count} advert records into {STG_SCHEMA_NAME}.{STG_ADVERT_INFO_TABLE_NAME}"
+        try:
+            with self.db_handler.connection as connection:
+                with connection.cursor() as cur:
+                    cur.execute(delete_query, (self.store_id, ))
+                    result = ADVERT_LIST_UPSERT.load(self.db_handler,
+                                                     rows,
+                                                     cursor=cur)
+                    self.store_progress.set(ProgressSource.ADVERT_LIST,
+                                            total=result.inserted,
+                                            done=result.inserted,
+                                            cursor=cur)
+                    self.store_progress.set(ProgressSource.ADVERT_INFO,
+                                            total=result.inserted,
+                                            done=0,
+                                            cursor=cur)
+            print(f"-- insert_advert_list -- \n{result}")
+
+            return f"Successfully processed {result.processed} advert records into {STG_SCHEMA_NAME}.{STG_ADVERT_INFO_TABLE_NAME}"
 
         except Exception as e:
-            if self.db_handler.connection:
-                self.db_handler.connection.rollback()
             print(f"Error during advert insert operation: {str(e)}")
             raise
 
+    def replay_group(self, response) -> str:
+        # список и информация пишут в одни строки stg_advert_info - по порядку
+        return self.task_class_identifier
+
+    def replay_raw_response(self, response) -> int:
+        """
+        Список кампаний - upsert без удаления старых (иначе стёрлась бы информация
+        из ответов /promotion/adverts), информация - обновление существующих.
+        Счётчики store_progress не меняются.
+        """
+        if response.endpoint == "/adv/v1/promotion/count":
+            advert_data = self.process_advert_list_data(response.json())
+            upsert, rows = ADVERT_LIST_UPSERT, self.advert_list_rows(advert_data)
+        else:
+            advert_data = self.process_all_advert_info_data(response.json())
+            if advert_data is None:
+                raise ValueError("advert info response can't be processed")
+            upsert, rows = ADVERT_INFO_UPDATE, self.advert_info_rows(advert_data)
+        return upsert.load(self.db_handler, rows).processed
+
     def process(self):
 
         if self.advert_list_is_ok() and self.advert_info_is_ok():
@@ -372,7 +301,6 @@ class taskAdvertInfo(TaskBase):
             return self._make_response()
 
         if not self.advert_list_is_ok():
-            self.delete_advert_list_by_store_id()
             ald = self.get_advert_list_data()
             if ald:
                 processed_ald = self.process_advert_list_data(ald)
@@ -409,7 +337,9 @@ class taskAdvertInfo(TaskBase):
                 return self._make_response()
 
             advert_info_insert_result = self.insert_advert_info(
-                processed_all_advert_info_data, )
+                processed_all_advert_info_data,
+                total=len(advert_ids),
+            )
 
             if not advert_info_insert_result:
                 self.status = TaskStatus.IN_PROGRESS
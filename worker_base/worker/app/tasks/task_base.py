@@ -1,10 +1,18 @@
 from abc import ABC, abstractmethod
 from enum import Enum
+import asyncio
 import time
 from collections import deque
+from urllib.parse import urlparse
 
 from app.worker_db_handler import WorkerDBHandler
 from app.worker_logger import WorkerLogger
+from app.wb_http_sessions import WBHttpSessions
+from app.raw_response_store import RawResponse, RawResponseStore, RAW_RESPONSE_REUSE_SECONDS
+
+
+# минимальная пауза между запусками задачи без лимитера запросов
+TASK_MIN_RERUN_SECONDS = 30
 
 
 class TaskStatus(Enum):
@@ -58,9 +66,34 @@ class RequestLimiter:
         else:
             return False
 
+    def available_requests(self) -> int:
+        """Сколько запросов можно сделать прямо сейчас, не превышая лимит"""
+        current_time = time.time()
+        if current_time < self.block_until:
+            return 0
+
+        while self.request_timestamps and self.request_timestamps[
+                0] <= current_time - self.per_seconds:
+            self.request_timestamps.popleft()
+
+        return self.max_requests - len(self.request_timestamps)
+
     def block_for_60_seconds(self):
         self.block_until = time.time() + 60
 
+    def next_allowed_time(self) -> float:
+        """Время, с которого is_request_allowed вернёт True (с учётом блокировки после 429)"""
+        current_time = time.time()
+        while self.request_timestamps and self.request_timestamps[
+                0] <= current_time - self.per_seconds:
+            self.request_timestamps.popleft()
+
+        next_time = 0
+        if len(self.request_timestamps) >= self.max_requests:
+            next_time = self.request_timestamps[0] + self.per_seconds
+
+        return max(next_time, self.block_until)
+
     # def __repr__(self):
     #     return f"""
     #     TaskResponse(status={self.status};
@@ -87,6 +120,8 @@ class TaskResponse:
 
 class TaskBase(ABC):
     task_class_identifier: str = None
+    # endpoint-ы (путь url), ответы которых задача умеет переобработать (app.replay)
+    replay_endpoints: tuple = ()
 
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
@@ -94,14 +129,126 @@ class TaskBase(ABC):
             raise TypeError(
                 f"Class {cls.__name__} must define 'task_class_identifier'")
 
-    def __init__(self, db_handler: WorkerDBHandler, logger: WorkerLogger,
-                 store_id: int, api_token: str, last_run_time: int):
+    def __init__(self,
+                 db_handler: WorkerDBHandler,
+                 logger: WorkerLogger,
+                 store_id: int,
+                 api_token: str,
+                 last_run_time: int,
+                 http_sessions: WBHttpSessions = None,
+                 raw_store: RawResponseStore = None):
         self.status: TaskStatus = TaskStatus.IN_PROGRESS
         self.db_handler = db_handler
         self.logger = logger
         self.store_id = store_id
         self.api_token = api_token
         self.last_run_time = last_run_time
+        self.http = http_sessions if http_sessions else WBHttpSessions()
+        self.raw_store = raw_store
+        self.request_limiter: RequestLimiter | None = None
+        self.not_before = 0
+
+    def defer(self, seconds: float):
+        """Не запускать задачу раньше чем через seconds (например, пока не готовы данные другой задачи)"""
+        self.not_before = time.time() + seconds
+
+    def next_eligible_time(self) -> float:
+        """Время, раньше которого запуск задачи бесполезен; 0 - можно запускать сразу"""
+        eligible_time = self.not_before
+        if self.request_limiter:
+            eligible_time = max(eligible_time,
+                                self.request_limiter.next_allowed_time())
+        else:
+            # иначе незавершённая задача перезапускалась бы без паузы
+            eligible_time = max(eligible_time,
+                                self.last_run_time + TASK_MIN_RERUN_SECONDS)
+        return eligible_time
+
+    def raw_request(self, method: str, url: str, **kwargs) -> tuple:
+        """(endpoint, запрос) - ключ ответа в raw_store; заголовки (токен) не входят"""
+        return urlparse(url).path, {
+            "method": method,
+            "url": url,
+            "params": kwargs.get("params"),
+            "json": kwargs.get("json"),
+            "data": kwargs.get("data"),
+        }
+
+    def lookup_raw_response(self,
+                            method: str,
+                            url: str,
+                            max_age_seconds: float = RAW_RESPONSE_REUSE_SECONDS,
+                            **kwargs):
+        """Сохранённый ответ на такой же запрос не старше max_age_seconds или None"""
+        if self.raw_store is None or not max_age_seconds:
+            return None
+        endpoint, request = self.raw_request(method, url, **kwargs)
+        try:
+            cached = self.raw_store.lookup(self.store_id, endpoint, request,
+                                           max_age_seconds)
+            if cached is not None:
+                print(f"-- raw response reused: {cached}")
+            return cached
+        except Exception as e:
+            print(f"-- raw response lookup error: {e}")
+            return None
+
+    def save_raw_response(self, method: str, url: str, response, **kwargs):
+        """
+        Сохраняет тело успешного ответа в raw_store (при stream=True - по мере чтения).
+        Вызывается в потоке задачи: хранилище postgres пишет через соединение потока.
+        """
+        if (self.raw_store is None or response.status_code != 200
+                or isinstance(response, RawResponse)):
+            return
+        endpoint, request = self.raw_request(method, url, **kwargs)
+        try:
+            if kwargs.get("stream"):
+                response.raw_sink = self.raw_store.open_sink(
+                    self.store_id, endpoint, request, response.status_code)
+            else:
+                self.raw_store.save(self.store_id, endpoint, request,
+                                    response.content, response.status_code)
+        except Exception as e:
+            print(f"-- raw response save error: {e}")
+
+    def fetch_raw(self,
+                  method: str,
+                  url: str,
+                  max_age_seconds: float = RAW_RESPONSE_REUSE_SECONDS,
+                  **kwargs):
+        """
+        Запрос к WB API через self.http с сохранением тела успешного ответа
+        в raw_store (если хранилище включено). Если в хранилище есть ответ
+        на такой же запрос не старше max_age_seconds, он возвращается без запроса.
+        Из потоков пула не вызывается: запрос там - self.http.request,
+        lookup_raw_response и save_raw_response - в потоке задачи.
+        """
+        cached = self.lookup_raw_response(method, url, max_age_seconds,
+                                          **kwargs)
+        if cached is not None:
+            return cached
+
+        response = self.http.request(method, url, **kwargs)
+        self.save_raw_response(method, url, response, **kwargs)
+        return response
+
+    def replay_group(self, response) -> str:
+        """
+        Ключ группы для app.replay: ответы одной группы переобрабатываются
+        последовательно в порядке получения, разные группы - параллельно.
+        По умолчанию - endpoint (строки разных ответов пересекаются).
+        """
+        return response.endpoint
+
+    @abstractmethod
+    def replay_raw_response(self, response) -> int:
+        """
+        Переобработка сохранённого ответа (RawResponse) без запросов к WB:
+        те же разбор и BulkUpsert, что в process(), но без отметок прогресса.
+        Возвращает количество обработанных строк.
+        """
+        pass
 
     def _make_response(self, additional_info: str = None) -> TaskResponse:
         return TaskResponse(
@@ -114,6 +261,14 @@ class TaskBase(ABC):
     def process(self) -> TaskResponse:
         pass
 
+    async def process_async(self, http_client) -> TaskResponse:
+        """
+        Прослойка для задач без нативной async-реализации:
+        синхронный process() выполняется в executor-е event loop-а.
+        """
+        return await asyncio.to_thread(self.db_handler.run_and_release,
+                                       self.process)
+
     def raise_error(
         self,
         message,
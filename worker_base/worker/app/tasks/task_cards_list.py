@@ -11,15 +11,37 @@ from .task_base import (
     TaskBase,
     TaskStatus,
     TaskResponse,
+    RequestLimiter,
 )
 
-from app.worker_public_config import STG_SCHEMA_NAME, STG_CARDS_LIST_TABLE_NAME
+from app.worker_public_config import STG_SCHEMA_NAME, STG_CARDS_LIST_TABLE_NAME, STG_CARDS_SYNC_CURSOR_TABLE_NAME
+from app.bulk_loader import BulkUpsert, UpsertPolicy
 
 CARDS_LIST_UPDATE_SCEDUAL = '6 hours 15 minutes'
+# полный проход с начала списка: карточки, не полученные с его начала, удалены на WB
+CARDS_LIST_FULL_SYNC_SCEDUAL = '1 day'
 CARDS_LIST_API_URL = "https://content-api.wildberries.ru/content/v2/get/cards/list"
 CARDS_LIST_API_LIMIT = 100
+CARDS_LIST_UPSERT = BulkUpsert(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_CARDS_LIST_TABLE_NAME,
+    columns=[
+        ("nm_id", "int4"),
+        ("store_id", "int4"),
+        ("vendor_code", "text"),
+        ("title", "text"),
+    ],
+    key_columns=("store_id", "nm_id"),
+    policy=UpsertPolicy.UPDATE,
+    extra_updates={"created_at": "CURRENT_TIMESTAMP"},
+)
+# по возрастанию updatedAt: сохранённый курсор указывает на последнюю
+# полученную карточку, и следующая синхронизация получает только изменённые
 CARDS_LIST_API_PAYLOAD = {
     "settings": {
+        "sort": {
+            "ascending": True
+        },
         "cursor": {
             "limit": CARDS_LIST_API_LIMIT
         },
@@ -32,138 +54,204 @@ CARDS_LIST_API_PAYLOAD = {
 
 class taskCardsList(TaskBase):
     task_class_identifier = "taskCardsList"
+    replay_endpoints = ("/content/v2/get/cards/list", )
 
-    def __init__(self, db_handler, logger, store_id, api_token, last_run_time):
+    def __init__(self,
+                 db_handler,
+                 logger,
+                 store_id,
+                 api_token,
+                 last_run_time,
+                 http_sessions=None,
+                 raw_store=None):
         super().__init__(
             db_handler,
             logger,
             store_id,
             api_token,
             last_run_time,
+            http_sessions,
+            raw_store,
         )
+        self.request_limiter = RequestLimiter(max_requests=100,
+                                              per_seconds=60)
 
-    def get_cards_list_data(self):
+    def get_cards_list_page(self, cursor_updated_at=None, cursor_nm_id=None):
         headers = {
             "Authorization": f"Bearer {self.api_token}",
             "Content-Type": "application/json"
         }
 
         payload = deepcopy(CARDS_LIST_API_PAYLOAD)
-        cards_list_data = []
-        while True:
-            try:
-                response = requests.post(
-                    CARDS_LIST_API_URL,
-                    headers=headers,
-                    data=json.dumps(payload),
-                    verify=False,
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    updatedAt = data.get("cursor", {}).get("updatedAt")
-                    nmID = data.get("cursor", {}).get("nmID")
-                    payload["settings"]["cursor"]["nmID"] = nmID
-                    payload["settings"]["cursor"]["updatedAt"] = updatedAt
-                    total = data.get("cursor", {}).get("total", 0)
-                    if data.get("cards") and len(data.get("cards")) > 0:
-                        cards_list_data.extend(data["cards"])
-                    if total < CARDS_LIST_API_LIMIT:
-                        break
-
-                else:
-                    self.raise_error(
-                        f"request error: {response.status_code}: {response.text}",
-                    )
-
-            except Exception as e:
-                self.raise_error(f"error: {e}", )
-        return cards_list_data
-
-    def get_cards_list_status_report(self):
+        if cursor_updated_at and cursor_nm_id:
+            payload["settings"]["cursor"]["updatedAt"] = cursor_updated_at
+            payload["settings"]["cursor"]["nmID"] = cursor_nm_id
+
+        if not self.request_limiter.is_request_allowed():
+            print("request is not allowed")
+            return None
+
+        try:
+            response = self.fetch_raw(
+                "POST",
+                CARDS_LIST_API_URL,
+                headers=headers,
+                data=json.dumps(payload),
+                verify=False,
+            )
+        except Exception as e:
+            self.raise_error(f"error: {e}", )
+
+        if response.status_code == 200:
+            return response.json()
+        elif response.status_code == 429:
+            self.request_limiter.block_for_60_seconds()
+            print("request is blocked")
+            return None
+        self.raise_error(
+            f"request error: {response.status_code}: {response.text}", )
+
+    def get_cards_sync_cursor(self):
         query = f"""
-            select
-                count(case when (cl.created_at)::DATE >= (CURRENT_TIMESTAMP - INTERVAL '{CARDS_LIST_UPDATE_SCEDUAL}')::DATE then 1 end) as actual,
-                count(*) as count_all
-            FROM {STG_SCHEMA_NAME}.{STG_CARDS_LIST_TABLE_NAME} cl
-            WHERE cl.store_id = {self.store_id};
+            SELECT
+                updated_at,
+                nm_id,
+                synced_at,
+                full_sync_started_at,
+                COALESCE(synced_at >= CURRENT_TIMESTAMP - INTERVAL '{CARDS_LIST_UPDATE_SCEDUAL}', FALSE) AS is_actual,
+                COALESCE(full_synced_at >= CURRENT_TIMESTAMP - INTERVAL '{CARDS_LIST_FULL_SYNC_SCEDUAL}', FALSE) AS is_full_actual
+            FROM {STG_SCHEMA_NAME}.{STG_CARDS_SYNC_CURSOR_TABLE_NAME}
+            WHERE store_id = %s;
         """
         try:
-            return self.db_handler.execute_and_fetch_single_row(query)
+            return self.db_handler.execute_and_fetch_single_row(
+                query, (self.store_id, ))
         except Exception as e:
             self.raise_error(f"error: {e}")
 
-    def process_cards_list_data(self, cards_list_data):
-        cards = []
-        for card in cards_list_data:
-            cards.append({
-                "nm_id": card.get("nmID"),
-                "store_id": self.store_id,
-                "vendor_code": card.get("vendorCode"),
-                "title": card.get("title"),
-            })
-        return cards
-
-    # Возвращать статусы
-    def insert_cards(self, cards) -> str:
+    def start_full_cards_sync(self):
+        """Начало полного прохода: курсор сбрасывается, время начала запоминается"""
         query = f"""
-            INSERT INTO {STG_SCHEMA_NAME}.{STG_CARDS_LIST_TABLE_NAME} (nm_id, store_id, vendor_code, title)
-            VALUES (%s, %s, %s, %s);
+            INSERT INTO {STG_SCHEMA_NAME}.{STG_CARDS_SYNC_CURSOR_TABLE_NAME} (
+                store_id, updated_at, nm_id, full_sync_started_at
+            )
+            VALUES (%s, NULL, NULL, NOW())
+            ON CONFLICT (store_id)
+            DO UPDATE SET
+                updated_at = NULL,
+                nm_id = NULL,
+                full_sync_started_at = EXCLUDED.full_sync_started_at
+            RETURNING full_sync_started_at;
         """
         try:
-            data = [(
-                product["nm_id"],
-                product["store_id"],
-                product["vendor_code"],
-                product["title"],
-            ) for product in cards]
+            row = self.db_handler.execute_and_fetch_single_row(
+                query, (self.store_id, ))
+            return row["full_sync_started_at"]
+        except Exception as e:
+            self.raise_error(f"error: {e}")
+
+    def card_rows(self, cards):
+        for card in cards:
+            yield (
+                card.get("nmID"),
+                self.store_id,
+                card.get("vendorCode"),
+                card.get("title"),
+            )
+
+    def save_cards_page(self,
+                        cards,
+                        cursor: dict,
+                        finished: bool,
+                        full_sync_started_at=None) -> str:
+        """
+        Upsert страницы карточек и сохранение курсора в одной транзакции.
+        synced_at обновляется, когда дошли до последней страницы.
+        В конце полного прохода (full_sync_started_at) удаляются карточки,
+        не полученные с его начала: upsert обновляет created_at.
+        """
+        cursor_query = f"""
+            INSERT INTO {STG_SCHEMA_NAME}.{STG_CARDS_SYNC_CURSOR_TABLE_NAME} AS target (
+                store_id, updated_at, nm_id, synced_at
+            )
+            VALUES (%s, %s, %s, CASE WHEN %s THEN NOW() END)
+            ON CONFLICT (store_id)
+            DO UPDATE SET
+                updated_at = COALESCE(EXCLUDED.updated_at, target.updated_at),
+                nm_id = COALESCE(EXCLUDED.nm_id, target.nm_id),
+                synced_at = COALESCE(EXCLUDED.synced_at, target.synced_at);
+        """
+        full_sync_query = f"""
+            DELETE FROM {STG_SCHEMA_NAME}.{STG_CARDS_LIST_TABLE_NAME}
+            WHERE store_id = %(store_id)s
+            AND (created_at IS NULL OR created_at < %(started_at)s);
 
-            self.db_handler.execute_many(query, data)
+            UPDATE {STG_SCHEMA_NAME}.{STG_CARDS_SYNC_CURSOR_TABLE_NAME}
+            SET full_sync_started_at = NULL, full_synced_at = NOW()
+            WHERE store_id = %(store_id)s;
+        """
+        try:
+            with self.db_handler.connection as connection:
+                with connection.cursor() as cur:
+                    result = CARDS_LIST_UPSERT.load(self.db_handler,
+                                                    self.card_rows(cards),
+                                                    cursor=cur)
+                    cur.execute(cursor_query, (
+                        self.store_id,
+                        cursor.get("updatedAt") if cards else None,
+                        cursor.get("nmID") if cards else None,
+                        finished,
+                    ))
+                    if finished and full_sync_started_at:
+                        cur.execute(
+                            full_sync_query, {
+                                "store_id": self.store_id,
+                                "started_at": full_sync_started_at,
+                            })
 
-            return f"Successfully inserted/updated {len(cards)} cards in {STG_SCHEMA_NAME}.{STG_CARDS_LIST_TABLE_NAME}"
+            return f"Successfully inserted/updated {result.processed} cards in {STG_SCHEMA_NAME}.{STG_CARDS_LIST_TABLE_NAME}: {result}"
         except Exception as e:
             self.raise_error(f"Error while inserting cards: {str(e)}")
 
+    def replay_raw_response(self, response) -> int:
+        """Карточки из сохранённой страницы; курсор синхронизации не меняется"""
+        cards = response.json().get("cards") or []
+        result = CARDS_LIST_UPSERT.load(self.db_handler, self.card_rows(cards))
+        return result.processed
+
     def process(self) -> TaskResponse:
-        cards_list_status_report = self.get_cards_list_status_report()
-
-        if cards_list_status_report:
-            actual = cards_list_status_report.get("actual")
-            count_all = cards_list_status_report.get("count_all")
-
-            if count_all == 0:
-                print(f"No data for store {self.store_id} -> load")
-            elif count_all != actual:
-                self.logger.info(
-                    "taskCardsList",
-                    f"Not actual data found -> delete and load",
-                    store_id=self.store_id,
-                )
-                delete_query = f"""
-                    DELETE FROM {STG_SCHEMA_NAME}.{STG_CARDS_LIST_TABLE_NAME}
-                    WHERE store_id = {self.store_id};
-                    """
-                try:
-                    self.db_handler.execute_query(delete_query)
-                except Exception as e:
-                    self.raise_error(f"store delete error: {e}")
-            else:
-                self.status = TaskStatus.SUCCESS
-                return self._make_response(
-                    f"Cards list loaded already: {cards_list_status_report}")
-
-        else:
-            self.status = TaskStatus.ERROR
-            self._make_response(f"cards_list_status_report error")
-            return
-
-        # TODO try exept
-        cards_list_data = self.get_cards_list_data()
-        if cards_list_data:
-            cards = self.process_cards_list_data(
-                cards_list_data=cards_list_data)
-            insert_result = self.insert_cards(cards)
+        sync_cursor = self.get_cards_sync_cursor()
+
+        full_sync_started_at = sync_cursor.get(
+            "full_sync_started_at") if sync_cursor else None
+        if not full_sync_started_at and not (
+                sync_cursor and sync_cursor.get("is_full_actual")):
+            full_sync_started_at = self.start_full_cards_sync()
+            sync_cursor = None
+        elif not full_sync_started_at and sync_cursor.get("is_actual"):
             self.status = TaskStatus.SUCCESS
-        else:
-            self.raise_error(f"cards_list_data is null")
+            return self._make_response(
+                f"Cards list synced already: {sync_cursor.get('synced_at')}")
+
+        # одна страница за вызов; курсор хранится в БД, поэтому
+        # прерванная синхронизация продолжается с последней сохранённой страницы
+        data = self.get_cards_list_page(
+            cursor_updated_at=sync_cursor.get("updated_at")
+            if sync_cursor else None,
+            cursor_nm_id=sync_cursor.get("nm_id") if sync_cursor else None,
+        )
+        if data is None:
             self.status = TaskStatus.IN_PROGRESS
+            return self._make_response("cards list request is not allowed yet")
+
+        cards = data.get("cards") or []
+        finished = len(cards) < CARDS_LIST_API_LIMIT
+        insert_result = self.save_cards_page(
+            cards,
+            cursor=data.get("cursor") or {},
+            finished=finished,
+            full_sync_started_at=full_sync_started_at,
+        )
+
+        self.status = TaskStatus.SUCCESS if finished else TaskStatus.IN_PROGRESS
         return self._make_response(f"insert_result: {insert_result}")
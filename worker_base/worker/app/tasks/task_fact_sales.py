@@ -4,53 +4,89 @@ import requests
 import warnings
 from urllib3.exceptions import InsecureRequestWarning
 
-from io import StringIO
-import csv
-
 warnings.simplefilter('ignore', InsecureRequestWarning)
 
 from .task_base import (
     TaskBase,
     TaskStatus,
+    RequestLimiter,
 )
 
 from app.worker_public_config import STG_SCHEMA_NAME, STG_FACT_SALES_INFO_TABLE_NAME, STG_FACT_SALES_TABLE_NAME
+from app.bulk_loader import BulkUpsert, UpsertPolicy
+from app.wb_json_stream import iter_json_items
+
+FACT_SALES_UPSERT = BulkUpsert(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_FACT_SALES_TABLE_NAME,
+    columns=[
+        ("store_id", "int4"),
+        ("sale_id", "text"),
+        ("nm_id", "int4"),
+        ("sale_type", "text"),
+        ("date", "date"),
+        ("last_change_date", "text"),
+        ("price_with_disc", "numeric"),
+    ],
+    key_columns=("sale_id", ),
+    policy=UpsertPolicy.UPDATE,
+)
 
 
 class taskFactSales(TaskBase):
     task_class_identifier = "taskFactSales"
-
-    def __init__(self, db_handler, logger, store_id, api_token, last_run_time):
+    replay_endpoints = ("/api/v1/supplier/sales", )
+
+    def __init__(self,
+                 db_handler,
+                 logger,
+                 store_id,
+                 api_token,
+                 last_run_time,
+                 http_sessions=None,
+                 raw_store=None):
         super().__init__(
             db_handler,
             logger,
             store_id,
             api_token,
             last_run_time,
+            http_sessions,
+            raw_store,
         )
+        # statistics-api: один запрос продаж в минуту
+        self.request_limiter = RequestLimiter(max_requests=1, per_seconds=60)
 
     def get_wb_sales(self, date_from):
+        """
+        Продажи, изменённые начиная с date_from, потоком: записи читаются
+        из тела ответа по одной. None - если запрос не удался.
+        """
         url = "https://statistics-api.wildberries.ru/api/v1/supplier/sales"
         flag = 0
         params = {"dateFrom": date_from, "flag": flag}
 
         headers = {"Authorization": self.api_token}
         try:
-            response = requests.get(f"{url}",
-                                    headers=headers,
-                                    params=params,
-                                    verify=False)
+            response = self.fetch_raw("GET", url,
+                                      headers=headers,
+                                      params=params,
+                                      verify=False,
+                                      stream=True)
 
             if response.status_code == 200:
-                data = response.json()
-            else:
+                return iter_json_items(response)
+
+            with response:
+                if response.status_code == 429:
+                    self.request_limiter.block_for_60_seconds()
                 print(f"Ошибка при запросе: {response.status_code}")
                 print(response.text)
 
         except Exception as e:
             print(f"Произошла ошибка: {e}")
 
-        return data
+        return None
 
     def get_status(self):
         SALES_SCEDUAL = "6 hours 15 minutes"
@@ -69,98 +105,42 @@ class taskFactSales(TaskBase):
         """
         return self.db_handler.execute_and_fetch_single_row(query=status_query)
 
-    def process_fact_sales_data(self, data):
-        processed_data = []
-        for ell in data:
-            processed_data.append({
-                "nmId": ell["nmId"],
-                "last_change_date": ell["lastChangeDate"],
-                "date": ell["date"][:10],
-                "sale_id": ell["saleID"],
-                "sale_type": ell["saleID"][0],
-                "price_with_disc": ell["priceWithDisc"]
-            })
-
-        return processed_data
-
-    def insert_sales_data(self, sales_data: list) -> str:
+    def sales_rows(self, records, state: dict):
+        """Запись API -> строка staging; в state - количество и lastChangeDate последней"""
+        for ell in records:
+            state["count"] += 1
+            state["last_change_date"] = ell["lastChangeDate"]
+            yield (
+                self.store_id,
+                ell["saleID"],
+                ell["nmId"],
+                ell["saleID"][0],
+                ell["date"][:10],
+                ell["lastChangeDate"],
+                ell["priceWithDisc"],
+            )
+
+    def insert_sales_data(self, records) -> dict:
         """
-        Вставляет данные о продажах через временную таблицу с использованием COPY.
-        Обновляет существующие записи при конфликте по sale_id.
+        Вставляет продажи через BulkUpsert (COPY во временную таблицу) прямо
+        из потока записей. Обновляет существующие записи при конфликте по sale_id.
         Вся операция выполняется в рамках одной транзакции.
         """
-        if not sales_data:
-            return "No sales data to insert"
-
+        state = {"count": 0, "last_change_date": None}
         try:
-            start_time = time.time()
-
-            temp_table_name = f"temp_{STG_FACT_SALES_TABLE_NAME}"
-            create_temp_table_query = f"""
-            CREATE TEMP TABLE {temp_table_name} (
-                LIKE {STG_SCHEMA_NAME}.{STG_FACT_SALES_TABLE_NAME} 
-                INCLUDING DEFAULTS
-            ) ON COMMIT DROP;
-            """
-
-            buf = StringIO()
-            writer = csv.writer(buf, delimiter='\t')
-
-            for item in sales_data:
-                row = (
-                    self.store_id,
-                    item["sale_id"],
-                    item["nmId"],
-                    item["sale_type"],
-                    item["date"],
-                    item["last_change_date"],
-                    item["price_with_disc"],
-                )
-                writer.writerow(row)
-
-            buf.seek(0)
-
-            with self.db_handler.connection:
-                with self.db_handler.connection.cursor() as cur:
-                    cur.execute(create_temp_table_query)
-
-                    cur.copy_from(buf,
-                                  temp_table_name,
-                                  sep='\t',
-                                  columns=('store_id', 'sale_id', 'nm_id',
-                                           'sale_type', 'date',
-                                           'last_change_date',
-                                           'price_with_disc'))
-
-                    insert_query = f"""
-                    INSERT INTO {STG_SCHEMA_NAME}.{STG_FACT_SALES_TABLE_NAME} AS target
-                    SELECT * FROM {temp_table_name}
-                    ON CONFLICT (sale_id) DO UPDATE SET
-                        store_id = EXCLUDED.store_id,
-                        nm_id = EXCLUDED.nm_id,
-                        sale_type = EXCLUDED.sale_type,
-                        date = EXCLUDED.date,
-                        last_change_date = EXCLUDED.last_change_date,
-                        price_with_disc = EXCLUDED.price_with_disc;
-                    """
-                    cur.execute(insert_query)
-
-                    cur.execute(f"SELECT COUNT(*) FROM {temp_table_name}")
-                    processed_count = cur.fetchone()[0]
-
-            duration = time.time() - start_time
-            print(
-                f"-- insert_sales_data -- \nProcessed {processed_count} records in {duration:.2f} seconds"
-            )
-
-            return f"Successfully processed {processed_count} records into {STG_SCHEMA_NAME}.{STG_FACT_SALES_TABLE_NAME}"
+            result = FACT_SALES_UPSERT.load(self.db_handler,
+                                            self.sales_rows(records, state))
+            print(f"-- insert_sales_data -- \n{result}")
+            return state
 
         except Exception as e:
-            if self.db_handler.connection:
-                self.db_handler.connection.rollback()
             print(f"Error during sales data insert operation: {str(e)}")
             raise
 
+    def replay_raw_response(self, response) -> int:
+        """Продажи из сохранённого ответа; stg_fact_sales_info не меняется"""
+        return self.insert_sales_data(iter_json_items(response))["count"]
+
     def insert_or_update_sales_status(self, last_change_date, is_final):
         query = f"""
             INSERT INTO {STG_SCHEMA_NAME}.{STG_FACT_SALES_INFO_TABLE_NAME} (store_id, last_change_date, is_final)
@@ -188,28 +168,26 @@ class taskFactSales(TaskBase):
             if last_change_date:
                 date_from = last_change_date
 
-            data = self.get_wb_sales(date_from=date_from)
-            if len(data) == 0:
+            if not self.request_limiter.is_request_allowed():
+                print("request is not allowed")
+                return self._make_response()
+
+            records = self.get_wb_sales(date_from=date_from)
+            if records is None:
+                # повтор в следующем цикле (после паузы лимитера)
+                self.status = TaskStatus.IN_PROGRESS
+                return self._make_response(
+                    f"sales request error, date_from: {date_from}")
+
+            insert_res = self.insert_sales_data(records)
+            if insert_res["count"] == 0:
                 self.insert_or_update_sales_status(last_change_date=date_from,
                                                    is_final=True)
                 self.status = TaskStatus.SUCCESS
             else:
-                processed_data = self.process_fact_sales_data(data=data)
-                insert_res = self.insert_sales_data(sales_data=processed_data)
-                if insert_res:
-                    last_change_date = processed_data[len(processed_data) -
-                                                      1]["last_change_date"]
-                    self.insert_or_update_sales_status(
-                        last_change_date=last_change_date, is_final=False)
-                else:
-                    self.logger.error(
-                        source="taskFactSales",
-                        message=f"insert_res: {insert_res}",
-                        store_id=self.store_id,
-                    )
-                    self.status = TaskStatus.ERROR
-                    return self._make_response(
-                        f"unknown status, status_info: {status_info}")
+                self.insert_or_update_sales_status(
+                    last_change_date=insert_res["last_change_date"],
+                    is_final=False)
                 print(f"insert_res: {insert_res}")
         elif status == "ok":
             print("data is loaded already")
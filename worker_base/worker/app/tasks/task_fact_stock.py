@@ -1,4 +1,5 @@
 import time
+import asyncio
 from enum import Enum
 from copy import deepcopy
 
@@ -12,26 +13,68 @@ warnings.simplefilter('ignore', InsecureRequestWarning)
 
 from .task_base import (TaskBase, TaskStatus, TaskResponse, RequestLimiter)
 
-from app.worker_public_config import STG_SCHEMA_NAME, STG_CARDS_LIST_TABLE_NAME, STG_FACT_STOCK_TABLE_NAME
+from app.worker_public_config import STG_SCHEMA_NAME, STG_CARDS_LIST_TABLE_NAME, STG_FACT_STOCK_TABLE_NAME, STG_FACT_STOCK_LOAD_INFO_TABLE_NAME
+from app.wb_async_client import WBAsyncClientError
+from app.bulk_loader import BulkUpsert, UpsertPolicy
+
+STOCKS_REPORT_API_URL = "https://seller-analytics-api.wildberries.ru/api/v2/stocks-report/products/products"
+STOCKS_REPORT_PAGE_LIMIT = 1000
+# окно, за которое догружаются остатки (DM-запрос берёт последние 90 дней)
+FACT_STOCK_BACKFILL_DAYS = 90
+
+FACT_STOCK_UPSERT = BulkUpsert(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_FACT_STOCK_TABLE_NAME,
+    columns=[
+        ("date", "date"),
+        ("store_id", "int4"),
+        ("nm_id", "int4"),
+        ("stock_count", "int4"),
+        ("to_client_count", "int4"),
+        ("from_client_count", "int4"),
+    ],
+    key_columns=("date", "store_id", "nm_id"),
+    policy=UpsertPolicy.UPDATE,
+    extra_updates={"created_at": "CURRENT_TIMESTAMP"},
+)
 
 
 class taskFactStock(TaskBase):
 
-    def __init__(self, db_handler, logger, store_id, api_token, last_run_time):
+    def __init__(self,
+                 db_handler,
+                 logger,
+                 store_id,
+                 api_token,
+                 last_run_time,
+                 http_sessions=None,
+                 raw_store=None):
         super().__init__(
             db_handler,
             logger,
             store_id,
             api_token,
             last_run_time,
+            http_sessions,
+            raw_store,
         )
         self.request_limiter = RequestLimiter(max_requests=3, per_seconds=60)
 
+        # текущая выгрузка: дата и смещение следующей страницы
+        self.stock_date = None
+        self.stock_offset = 0
+        self.stock_rows_loaded = 0
+
     task_class_identifier = "taskFactStock"
+    replay_endpoints = ("/api/v2/stocks-report/products/products", )
 
-    def get_fact_stock_data(self, date):
-        api_url = "https://seller-analytics-api.wildberries.ru/api/v2/stocks-report/products/products"
+    def get_fact_stock_headers(self):
+        return {
+            "Authorization": f"Bearer {self.api_token}",
+            "Content-Type": "application/json"
+        }
 
+    def get_fact_stock_payload(self, date, offset=0):
         end_date = date
         start_date = date
 
@@ -47,13 +90,7 @@ class taskFactStock(TaskBase):
         subjectID = None
         brandName = None
         tagID = None
-        limit = 1000
-        offset = 0
-
-        headers = {
-            "Authorization": f"Bearer {self.api_token}",
-            "Content-Type": "application/json"
-        }
+        limit = STOCKS_REPORT_PAGE_LIMIT
 
         payload = {
             "nmIDs": nmIDs,
@@ -74,7 +111,26 @@ class taskFactStock(TaskBase):
             "limit": limit,
             "offset": offset
         }
-        payload = {k: v for k, v in payload.items() if v is not None}
+        return {k: v for k, v in payload.items() if v is not None}
+
+    def handle_fact_stock_response(self, response):
+        if response.status_code == 200:
+            return response.json()
+        elif response.status_code == 429:
+            self.request_limiter.block_for_60_seconds()
+            print("request is blocked")
+            return None
+        else:
+            self.logger.error(
+                source="taskFactStock",
+                message=
+                f"request error: {response.status_code}: {response.text}",
+                store_id=self.store_id,
+            )
+            return None
+
+    def get_fact_stock_data(self, date, offset=0):
+        payload = self.get_fact_stock_payload(date, offset)
 
         request_is_available = self.request_limiter.is_request_allowed()
 
@@ -83,23 +139,11 @@ class taskFactStock(TaskBase):
             return None
 
         try:
-            response = requests.post(api_url,
-                                     headers=headers,
-                                     data=json.dumps(payload),
-                                     verify=False)
-            if response.status_code == 200:
-                return response.json()
-            elif response.status_code == 429:
-                self.request_limiter.block_for_60_seconds()
-                print("request is blocked")
-            else:
-                self.logger.error(
-                    source="taskFactStock",
-                    message=
-                    f"request error: {response.status_code}: {response.text}",
-                    store_id=self.store_id,
-                )
-                return None
+            response = self.fetch_raw("POST", STOCKS_REPORT_API_URL,
+                                      headers=self.get_fact_stock_headers(),
+                                      data=json.dumps(payload),
+                                      verify=False)
+            return self.handle_fact_stock_response(response)
 
         except requests.exceptions.RequestException as e:
             self.logger.error(
@@ -109,34 +153,83 @@ class taskFactStock(TaskBase):
             )
             return None
 
-    def process_stock_data(self, data, date):
-        items = data['data']['items']
-        res_data = [{
-            "date": date,
-            "nmID": d["nmID"],
-            "store_count": d["metrics"]["stockCount"],
-            "to_client_count": d["metrics"]["toClientCount"],
-            "from_client_count": d["metrics"]["fromClientCount"],
-        } for d in items]
-        return res_data
-
-    def insert_stock_data(self, stock_data: list) -> str:
-        query = f"""
-            INSERT INTO {STG_SCHEMA_NAME}.{STG_FACT_STOCK_TABLE_NAME} (date, store_id, nm_id, stock_count, to_client_count, from_client_count)
-            VALUES (%s, %s, %s, %s, %s, %s);
-        """
+    async def get_fact_stock_data_async(self, http_client, date, offset=0):
+        payload = self.get_fact_stock_payload(date, offset)
+
+        request_is_available = self.request_limiter.is_request_allowed()
+
+        if not request_is_available:
+            print("request is not available")
+            return None
+
+        # ключ raw_store - как у синхронного fetch_raw (data=), ответы общие для обоих путей;
+        # raw_store работает с БД - в потоке через run_and_release
+        raw_request = {"data": json.dumps(payload)}
+        cached = await asyncio.to_thread(self.db_handler.run_and_release,
+                                         self.lookup_raw_response, "POST",
+                                         STOCKS_REPORT_API_URL,
+                                         **raw_request)
+        if cached is not None:
+            return self.handle_fact_stock_response(cached)
+
         try:
-            data = [(
-                item["date"],
+            response = await http_client.post(
+                STOCKS_REPORT_API_URL,
+                headers=self.get_fact_stock_headers(),
+                json_payload=payload,
+            )
+            await asyncio.to_thread(self.db_handler.run_and_release,
+                                    self.save_raw_response, "POST",
+                                    STOCKS_REPORT_API_URL, response,
+                                    **raw_request)
+            return self.handle_fact_stock_response(response)
+
+        except WBAsyncClientError as e:
+            self.logger.error(
+                source="taskFactStock",
+                message=f"request error: {e}",
+                store_id=self.store_id,
+            )
+            return None
+
+    def stock_rows(self, items, date):
+        for d in items:
+            metrics = d["metrics"]
+            yield (
+                date,
                 self.store_id,
-                item["nmID"],
-                item["store_count"],
-                item["to_client_count"],
-                item["from_client_count"],
-            ) for item in stock_data]
-
-            self.db_handler.execute_many(query, data)
-            return f"Successfully inserted {len(stock_data)} rows into {STG_SCHEMA_NAME}.{STG_FACT_STOCK_TABLE_NAME}"
+                d["nmID"],
+                metrics["stockCount"],
+                metrics["toClientCount"],
+                metrics["fromClientCount"],
+            )
+
+    def insert_stock_page(self, items, date, next_offset, loaded):
+        """
+        Upsert страницы и отметка прогресса по дате в одной транзакции,
+        чтобы прерванная выгрузка продолжилась с next_offset.
+        """
+        progress_query = f"""
+            INSERT INTO {STG_SCHEMA_NAME}.{STG_FACT_STOCK_LOAD_INFO_TABLE_NAME} (
+                store_id, date, page_offset, loaded, updated_at
+            )
+            VALUES (%s, %s, %s, %s, NOW())
+            ON CONFLICT (store_id, date)
+            DO UPDATE SET
+                page_offset = EXCLUDED.page_offset,
+                loaded = EXCLUDED.loaded,
+                updated_at = NOW();
+        """
+        try:
+            with self.db_handler.connection as connection:
+                with connection.cursor() as cur:
+                    result = FACT_STOCK_UPSERT.load(self.db_handler,
+                                                    self.stock_rows(
+                                                        items, date),
+                                                    cursor=cur)
+                    cur.execute(progress_query,
+                                (self.store_id, date, next_offset, loaded))
+            return result
         except Exception as e:
             self.logger.error(
                 source="taskFactStock",
@@ -145,38 +238,65 @@ class taskFactStock(TaskBase):
             )
             return None
 
+    def replay_group(self, response) -> str:
+        # строки разных дат не пересекаются
+        return f"{response.endpoint}:{response.payload['currentPeriod']['start']}"
+
+    def replay_raw_response(self, response) -> int:
+        """Страница остатков из сохранённого ответа; stg_fact_stock_load_info не меняется"""
+        date = response.payload["currentPeriod"]["start"]
+        items = response.json()["data"]["items"]
+        result = FACT_STOCK_UPSERT.load(self.db_handler,
+                                        self.stock_rows(items, date))
+        return result.processed
+
     def get_fact_stock_status_info(self):
-        q = f""" 
-            SELECT
-                CASE
-                    WHEN EXISTS (
-                        SELECT 1
-                        FROM {STG_SCHEMA_NAME}.{STG_FACT_STOCK_TABLE_NAME} sfs
-                        WHERE sfs.date = CURRENT_DATE - INTERVAL '1 day' AND store_id = {self.store_id}
+        """
+        Самая поздняя незагруженная дата окна FACT_STOCK_BACKFILL_DAYS
+        и смещение, с которого продолжать (если выгрузка прерывалась).
+        Даты без строки load_info, но с данными в stg_fact_stock (загружены
+        до появления load_info), считаются загруженными.
+        """
+        q = f"""
+            WITH target_dates AS (
+                SELECT generate_series(
+                    CURRENT_DATE - INTERVAL '{FACT_STOCK_BACKFILL_DAYS} days',
+                    CURRENT_DATE - INTERVAL '1 day',
+                    INTERVAL '1 day'
+                )::date AS target_date
+            ),
+            next_date AS (
+                SELECT
+                    td.target_date,
+                    COALESCE(li.page_offset, 0) AS page_offset
+                FROM target_dates td
+                LEFT JOIN {STG_SCHEMA_NAME}.{STG_FACT_STOCK_LOAD_INFO_TABLE_NAME} li
+                    ON li.store_id = %s
+                    AND li.date = td.target_date
+                WHERE li.loaded IS NOT TRUE
+                AND NOT (
+                    li.store_id IS NULL
+                    AND EXISTS (
+                        SELECT 1 FROM {STG_SCHEMA_NAME}.{STG_FACT_STOCK_TABLE_NAME} fs
+                        WHERE fs.date = td.target_date AND fs.store_id = %s
                     )
-                    THEN 'ok'
-                    ELSE 'need_load'
-                END AS status,
-                TO_CHAR(CURRENT_DATE - INTERVAL '1 day', 'YYYY-MM-DD') AS target_date;
+                )
+                ORDER BY td.target_date DESC
+                LIMIT 1
+            )
+            SELECT
+                CASE WHEN EXISTS (SELECT 1 FROM next_date) THEN 'need_load' ELSE 'ok' END AS status,
+                (SELECT TO_CHAR(target_date, 'YYYY-MM-DD') FROM next_date) AS target_date,
+                (SELECT page_offset FROM next_date) AS page_offset;
             """
-        return self.db_handler.execute_and_fetch_single_row(query=q)
-
-    def process(self):
+        return self.db_handler.execute_and_fetch_single_row(
+            query=q, params=(self.store_id, self.store_id))
 
-        status_info = self.get_fact_stock_status_info()
+    def check_fact_stock_status_info(self, status_info):
         status = status_info["status"]
-        target_date = status_info['target_date']
 
         if status == "need_load":
-            data = self.get_fact_stock_data(target_date)
-            processed_data = self.process_stock_data(data, target_date)
-            insert_result = self.insert_stock_data(processed_data)
-            if insert_result:
-                self.status = TaskStatus.SUCCESS
-                return self._make_response(f"insert_result: {insert_result}")
-            else:
-                self.status = TaskStatus.ERROR
-                return self._make_response(f"insert_result: {insert_result}")
+            return None
         elif status == "ok":
             self.status = TaskStatus.SUCCESS
             return self._make_response(f"data already inserted")
@@ -190,4 +310,76 @@ class taskFactStock(TaskBase):
             return self._make_response(
                 f"unknown status, status_info: {status_info}")
 
-        print()
+    def start_fact_stock_load(self):
+        """
+        Проверяет, нужна ли выгрузка, и начинает её с первой страницы.
+        Возвращает ответ, если грузить нечего.
+        """
+        status_info = self.get_fact_stock_status_info()
+        status_response = self.check_fact_stock_status_info(status_info)
+        if status_response:
+            return status_response
+
+        self.stock_date = status_info['target_date']
+        self.stock_offset = status_info['page_offset'] or 0
+        self.stock_rows_loaded = 0
+        return None
+
+    def load_fact_stock_page(self, data):
+        target_date = self.stock_date
+        if data is None:
+            self.status = TaskStatus.IN_PROGRESS
+            return self._make_response(
+                f"no data for {target_date} offset {self.stock_offset} yet")
+
+        items = data['data']['items']
+        is_last_page = len(items) < STOCKS_REPORT_PAGE_LIMIT
+        insert_result = self.insert_stock_page(
+            items,
+            target_date,
+            next_offset=self.stock_offset + len(items),
+            loaded=is_last_page,
+        )
+        if insert_result is None:
+            self.stock_date = None
+            self.status = TaskStatus.ERROR
+            return self._make_response(
+                f"insert error for {target_date} offset {self.stock_offset}")
+
+        self.stock_offset += len(items)
+        self.stock_rows_loaded += insert_result.processed
+
+        if is_last_page:
+            # дата загружена, следующая - при следующем вызове
+            self.stock_date = None
+            self.status = TaskStatus.IN_PROGRESS
+            return self._make_response(
+                f"loaded {self.stock_rows_loaded} rows for {target_date}")
+
+        # следующая страница - после ожидания лимитера, через планировщик
+        self.status = TaskStatus.IN_PROGRESS
+        return self._make_response(
+            f"page loaded for {target_date}: {insert_result}, next offset {self.stock_offset}"
+        )
+
+    def process(self):
+        if self.stock_date is None:
+            status_response = self.start_fact_stock_load()
+            if status_response:
+                return status_response
+
+        data = self.get_fact_stock_data(self.stock_date, self.stock_offset)
+        return self.load_fact_stock_page(data)
+
+    async def process_async(self, http_client):
+        if self.stock_date is None:
+            status_response = await asyncio.to_thread(
+                self.db_handler.run_and_release, self.start_fact_stock_load)
+            if status_response:
+                return status_response
+
+        data = await self.get_fact_stock_data_async(http_client,
+                                                    self.stock_date,
+                                                    self.stock_offset)
+        return await asyncio.to_thread(self.db_handler.run_and_release,
+                                       self.load_fact_stock_page, data)
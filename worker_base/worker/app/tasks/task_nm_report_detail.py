@@ -1,112 +1,126 @@
+import datetime
+import math
 import time
-from enum import Enum
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import requests
 import json
 import warnings
 from urllib3.exceptions import InsecureRequestWarning
-from io import StringIO
-import csv
 
 warnings.simplefilter('ignore', InsecureRequestWarning)
 
 from .task_base import (TaskBase, TaskStatus, TaskResponse, RequestLimiter)
 
-from app.worker_public_config import CORE_SCHEMA_NAME, STG_SCHEMA_NAME, STG_NM_REPORT_DETAIL_INFO_TABLE_NAME, STG_NM_REPORT_DETAIL_TABLE_NAME
-
-NM_REPORT_DETAIL_TARGET_DATES_AMOUNT = 90
-
-
-class NmReportDetailStatus(Enum):
-    SUCCESS = 200
-    ERROR = 500
-    IN_PROGRESS = 102
-
-    def __repr__(self):
-        return f"Status.{self.name}"
-
-
-NM_REPORT_SCHEDUAL = '6 hours 15 minutes'
+from app.worker_public_config import CORE_SCHEMA_NAME, STG_SCHEMA_NAME, STG_NM_REPORT_DETAIL_INFO_TABLE_NAME, STG_NM_REPORT_DETAIL_TABLE_NAME, STG_CARDS_LIST_TABLE_NAME
+
+from app.bulk_loader import BulkUpsert, UpsertPolicy
+from .nm_report_queue import NmReportQueue, NmReportStrategy, NM_REPORT_DETAIL_TARGET_DATES_AMOUNT, NM_REPORT_SCHEDUAL
+
+NM_REPORT_DETAIL_URL = "https://seller-analytics-api.wildberries.ru/api/v2/nm-report/detail"
+
+# сколько дат загружается параллельно (не больше, чем позволяет лимит запросов)
+NM_REPORT_MAX_DATES_IN_FLIGHT = 3
+# сколько загруженных страниц коммитится одной транзакцией
+NM_REPORT_PROGRESS_BATCH_PAGES = 5
+# nmID в одном запросе /nm-report/detail/history
+NM_REPORT_HISTORY_NM_BATCH = 20
+
+# метрики history; отмен и средней цены там нет
+NM_REPORT_HISTORY_KEYS = [
+    'openCardCount', 'addToCartCount', 'ordersCount', 'ordersSumRub',
+    'buyoutsCount', 'buyoutsSumRub'
+]
+
+NM_REPORT_DETAIL_UPSERT = BulkUpsert(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_NM_REPORT_DETAIL_TABLE_NAME,
+    columns=[
+        ("date", "date"),
+        ("store_id", "int4"),
+        ("nm_id", "int4"),
+        ("open_card_count", "int4"),
+        ("add_to_cart_count", "int4"),
+        ("orders_count", "int4"),
+        ("orders_sum_rub", "int4"),
+        ("buyouts_count", "int4"),
+        ("buyouts_sum_rub", "int4"),
+        ("cancel_count", "int4"),
+        ("cancel_sum_rub", "int4"),
+        ("avg_price_rub", "int4"),
+    ],
+    key_columns=("date", "store_id", "nm_id"),
+    policy=UpsertPolicy.NOTHING,
+)
+
+# обновление загруженной даты: строки не удаляются, а обновляются; created_at -
+# отметка о получении при этом обновлении (неполученные потом удаляются)
+NM_REPORT_DETAIL_REFRESH_UPSERT = BulkUpsert(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_NM_REPORT_DETAIL_TABLE_NAME,
+    columns=NM_REPORT_DETAIL_UPSERT.columns,
+    key_columns=("date", "store_id", "nm_id"),
+    policy=UpsertPolicy.UPDATE,
+    extra_updates={"created_at": "CURRENT_TIMESTAMP"},
+)
+
+# history не удаляет строки даты: добавляет недостающие (отмены и средняя цена - 0,
+# как в detail без этих полей) и обновляет только свои метрики
+NM_REPORT_HISTORY_UPSERT = BulkUpsert(
+    schema_name=STG_SCHEMA_NAME,
+    table_name=STG_NM_REPORT_DETAIL_TABLE_NAME,
+    columns=[
+        ("date", "date"),
+        ("store_id", "int4"),
+        ("nm_id", "int4"),
+        ("open_card_count", "int4"),
+        ("add_to_cart_count", "int4"),
+        ("orders_count", "int4"),
+        ("orders_sum_rub", "int4"),
+        ("buyouts_count", "int4"),
+        ("buyouts_sum_rub", "int4"),
+        ("cancel_count", "int4"),
+        ("cancel_sum_rub", "int4"),
+        ("avg_price_rub", "int4"),
+    ],
+    key_columns=("date", "store_id", "nm_id"),
+    policy=UpsertPolicy.UPDATE,
+    update_columns=[
+        "open_card_count", "add_to_cart_count", "orders_count",
+        "orders_sum_rub", "buyouts_count", "buyouts_sum_rub"
+    ],
+)
 
 
 class taskNmReportDetail(TaskBase):
     task_class_identifier = "taskNmReportDetail"
-
-    def __init__(self, db_handler, logger, store_id, api_token, last_run_time):
+    replay_endpoints = ("/api/v2/nm-report/detail",
+                        "/api/v2/nm-report/detail/history")
+
+    def __init__(self,
+                 db_handler,
+                 logger,
+                 store_id,
+                 api_token,
+                 last_run_time,
+                 http_sessions=None,
+                 raw_store=None):
         super().__init__(
             db_handler,
             logger,
             store_id,
             api_token,
             last_run_time,
+            http_sessions,
+            raw_store,
         )
         self.request_limiter = RequestLimiter(max_requests=3, per_seconds=60)
+        self.queue = NmReportQueue(db_handler, store_id)
 
     def loading_simulation(self, date, page):
         return
 
-    def get_next_to_load(self):
-        query = f"""
-            select * from 
-            (WITH target_dates AS (
-                SELECT
-                    (DATE_TRUNC('day', generate_series(
-                        ((CURRENT_TIMESTAMP - interval '{NM_REPORT_SCHEDUAL}') - INTERVAL '{NM_REPORT_DETAIL_TARGET_DATES_AMOUNT} days')::date,
-                        ((CURRENT_TIMESTAMP - interval '{NM_REPORT_SCHEDUAL}') - INTERVAL '1 days')::date,
-                        INTERVAL '1 day'
-                    )))::date AS target_date
-            ),
-            store_info AS (
-                SELECT
-                    id,
-                    fact_date,
-                    page,
-                    is_next_page,
-                    cant_be_load
-                FROM
-                    {STG_SCHEMA_NAME}.{STG_NM_REPORT_DETAIL_INFO_TABLE_NAME}
-                WHERE
-                    store_id = {self.store_id}
-            )
-            SELECT
-                td.target_date,
-                si.id,
-                si.page,
-                si.is_next_page,
-                si.cant_be_load
-            FROM
-                target_dates td
-            LEFT JOIN
-                store_info si
-            ON
-                td.target_date = si.fact_date) m
-            where m.is_next_page = true or m.is_next_page isnull
-            limit 1
-            """
-
-        try:
-            next_to_load_info = self.db_handler.execute_and_fetch_single_row(
-                query)
-            if next_to_load_info:
-                return {
-                    "status": NmReportDetailStatus.IN_PROGRESS,
-                    "target_date": str(next_to_load_info.get("target_date")),
-                    "target_id": next_to_load_info.get("id"),
-                    "page": next_to_load_info.get("page"),
-                    "is_next_page": next_to_load_info.get("is_next_page"),
-                    "cant_be_load": next_to_load_info.get("cant_be_load"),
-                }
-            else:
-                return {"status": NmReportDetailStatus.SUCCESS}
-        except Exception as e:
-            return {"status": NmReportDetailStatus.ERROR, "error": f"{e}"}
-
-    def get_nm_report_detail_data(
-        self,
-        date,
-        page,
-    ):
-        api_url = "https://seller-analytics-api.wildberries.ru/api/v2/nm-report/detail"
-
+    def nm_report_detail_request(self, date, page) -> dict:
+        """Аргументы запроса страницы detail (для http.request и raw_store)"""
         headers = {
             "Authorization": f"Bearer {self.api_token}",
             "Content-Type": "application/json"
@@ -123,105 +137,485 @@ class taskNmReportDetail(TaskBase):
             },
             "page": page,
         }
+
+        return {
+            "headers": headers,
+            "data": json.dumps(payload),
+            "verify": False,
+        }
+
+    def read_nm_report_detail_response(self, response):
+        """(data | None, status_code) из ответа страницы detail"""
+        if response.status_code == 200:
+            return response.json(), response.status_code
+        elif response.status_code != 429:
+            self.logger.error(
+                source="taskNmReportDetail",
+                message=
+                f"request error: {response.status_code}: {response.text}",
+                store_id=self.store_id,
+            )
+        return None, response.status_code
+
+    def fetch_nm_report_detail_page(self, date, page):
+        """
+        Запрос страницы без проверки лимита (лимит проверяет вызывающий).
+        Возвращает (data | None, status_code).
+        """
+        try:
+            response = self.fetch_raw(
+                "POST", NM_REPORT_DETAIL_URL,
+                **self.nm_report_detail_request(date, page))
+            return self.read_nm_report_detail_response(response)
+
+        except Exception as e:
+            self.logger.error(
+                source="taskNmReportDetail",
+                message=f"request error: {e}",
+                store_id=self.store_id,
+            )
+            return None, None
+
+    def submit_nm_report_detail_page(self, executor, date, page) -> Future:
+        """
+        Запрос страницы в пуле: в потоке пула только HTTP, raw_store и логгер
+        (соединения БД) - в потоке задачи. Ответ из raw_store - сразу готовый Future.
+        """
+        request = self.nm_report_detail_request(date, page)
+        cached = self.lookup_raw_response("POST", NM_REPORT_DETAIL_URL,
+                                          **request)
+        if cached is not None:
+            future = Future()
+            future.set_result(cached)
+            return future
+        return executor.submit(self.http.request, "POST", NM_REPORT_DETAIL_URL,
+                               **request)
+
+    def receive_nm_report_detail_page(self, future, date, page):
+        """Результат submit_nm_report_detail_page в потоке задачи: (data | None, status_code)"""
+        try:
+            response = future.result()
+            self.save_raw_response("POST", NM_REPORT_DETAIL_URL, response,
+                                   **self.nm_report_detail_request(date, page))
+            return self.read_nm_report_detail_response(response)
+
+        except Exception as e:
+            self.logger.error(
+                source="taskNmReportDetail",
+                message=f"request error: {e}",
+                store_id=self.store_id,
+            )
+            return None, None
+
+    def get_nm_report_detail_data(
+        self,
+        date,
+        page,
+    ):
         request_is_allowed = self.request_limiter.is_request_allowed()
         if not request_is_allowed:
             print("request is not allowed")
             return None
 
+        data, status_code = self.fetch_nm_report_detail_page(date, page)
+        if status_code == 429:
+            self.request_limiter.block_for_60_seconds()
+            print("block_for_60_seconds")
+        return data
+
+    def fetch_nm_report_history(self, nm_ids: list[int], begin: str,
+                                end: str):
+        """История по дням для пачки nmID за период (не длиннее недели): (data | None, status_code)"""
+        api_url = "https://seller-analytics-api.wildberries.ru/api/v2/nm-report/detail/history"
+
+        headers = {
+            "Authorization": f"Bearer {self.api_token}",
+            "Content-Type": "application/json"
+        }
+
+        payload = {
+            "nmIDs": nm_ids,
+            "period": {
+                "begin": begin,
+                "end": end,
+            },
+            "timezone": "Europe/Moscow",
+            "aggregationLevel": "day",
+        }
+
         try:
-            response = requests.post(api_url,
-                                     headers=headers,
-                                     data=json.dumps(payload),
-                                     verify=False)
+            response = self.fetch_raw("POST", api_url,
+                                      headers=headers,
+                                      data=json.dumps(payload),
+                                      verify=False)
 
             if response.status_code == 200:
-                return response.json()
-            elif response.status_code == 429:
-                self.request_limiter.block_for_60_seconds()
-                print("block_for_60_seconds")
-                return None
-            else:
+                return response.json(), response.status_code
+            elif response.status_code != 429:
                 self.logger.error(
                     source="taskNmReportDetail",
                     message=
-                    f"request error: {response.status_code}: {response.text}",
+                    f"history request error: {response.status_code}: {response.text}",
                     store_id=self.store_id,
                 )
-                return None
+            return None, response.status_code
 
         except Exception as e:
             self.logger.error(
                 source="taskNmReportDetail",
-                message=f"request error: {e}",
+                message=f"history request error: {e}",
                 store_id=self.store_id,
             )
+            return None, None
+
+    def process_nm_report_history_data(self, data,
+                                       dates: list[str]) -> dict | None:
+        """Ответ history -> {date: карточки} в формате process_nm_report_detail_data"""
+        if not data or data.get("error"):
             return None
 
-    def insert_nm_report_detail_data(self, data_list: list[dict]) -> str:
+        cards_by_date = {date: [] for date in dates}
+        try:
+            for item in data.get("data") or []:
+                mnID = item["nmID"]
+                for day in item.get("history") or []:
+                    date = day["dt"][:10]
+                    if date not in cards_by_date:
+                        continue
+                    statistic = {
+                        "date": date,
+                        "mnID": mnID,
+                    }
+                    statistic.update({
+                        key: day[key]
+                        for key in NM_REPORT_HISTORY_KEYS if key in day
+                    })
+                    cards_by_date[date].append(statistic)
+            return cards_by_date
+        except Exception:
+            return None
+
+    def get_store_nm_ids(self, after_nm_id: int = 0, limit=None) -> list[int]:
+        """
+        nmID магазина по возрастанию после after_nm_id: history продолжает
+        с последнего загруженного nmID, поэтому изменения списка карточек
+        между вызовами не сдвигают пачки.
+        """
+        query = f"""
+            SELECT nm_id
+            FROM {STG_SCHEMA_NAME}.{STG_CARDS_LIST_TABLE_NAME}
+            WHERE store_id = %s AND nm_id > %s
+            ORDER BY nm_id
+            LIMIT %s;
+        """
+        result = self.db_handler.fetch_all(query,
+                                           (self.store_id, after_nm_id, limit))
+        return [row[0] for row in result] if result else []
+
+    def choose_strategy(self) -> NmReportStrategy:
+        """
+        Для ещё не начатых последних дней выбирает стратегию с меньшим числом запросов:
+        detail - дней * страниц на день, history - пачек по NM_REPORT_HISTORY_NM_BATCH nmID.
+        """
+        candidates = self.queue.get_history_candidates()
+        nm_count = len(self.get_store_nm_ids())
+
+        strategy = NmReportStrategy.DETAIL
+        if candidates["dates"] and nm_count:
+            detail_requests = candidates["dates"] * math.ceil(
+                candidates["avg_pages"])
+            history_requests = math.ceil(nm_count / NM_REPORT_HISTORY_NM_BATCH)
+            if history_requests < detail_requests:
+                strategy = NmReportStrategy.HISTORY
+            print(
+                f"-- nm report strategy: {strategy.value} (detail: {detail_requests}, history: {history_requests} requests)"
+            )
+
+        self.queue.set_strategy(strategy)
+        return strategy
+
+    def load_nm_report_history(self) -> int:
+        """
+        Загружает даты стратегии history пачками nmID, пока позволяет лимит.
+        Каждая пачка сохраняется одной транзакцией для всех дат сразу.
+        Возвращает количество сделанных запросов.
+        """
+        if self.request_limiter.available_requests() == 0:
+            return 0
+
+        items = self.queue.claim_history()
+        if not items:
+            return 0
+
+        dates = [str(item["fact_date"]) for item in items]
+        last_nm_id = items[0]["history_nm_id"]
+
+        requests_made = 0
+        while self.request_limiter.is_request_allowed():
+            nm_batch = self.get_store_nm_ids(
+                after_nm_id=last_nm_id, limit=NM_REPORT_HISTORY_NM_BATCH + 1)
+            is_next_page = len(nm_batch) > NM_REPORT_HISTORY_NM_BATCH
+            nm_batch = nm_batch[:NM_REPORT_HISTORY_NM_BATCH]
+            if not nm_batch:
+                # карточек после last_nm_id не осталось (удалены) - даты загружены
+                if last_nm_id:
+                    self.flush_nm_report_history({date: []
+                                                  for date in dates},
+                                                 last_nm_id, False)
+                break
+
+            data, status_code = self.fetch_nm_report_history(
+                nm_batch, dates[0], dates[-1])
+            requests_made += 1
+            if status_code == 429:
+                self.request_limiter.block_for_60_seconds()
+                print("block_for_60_seconds")
+
+            cards_by_date = self.process_nm_report_history_data(data, dates)
+            if cards_by_date is None:
+                break
+
+            last_nm_id = nm_batch[-1]
+            if not self.flush_nm_report_history(cards_by_date, last_nm_id,
+                                                is_next_page) or not is_next_page:
+                break
+
+        # не продвинутые и оставшиеся занятыми даты - обратно в очередь
+        for date in dates:
+            self.queue.release(date)
+
+        return requests_made
+
+    def insert_nm_report_detail_data(self,
+                                     data_list: list[dict],
+                                     cursor=None,
+                                     upsert=NM_REPORT_DETAIL_UPSERT) -> str:
         if not data_list:
             return "No data to insert"
 
+        rows = ((item["date"], self.store_id, item["mnID"],
+                 item.get("openCardCount", 0), item.get("addToCartCount", 0),
+                 item.get("ordersCount", 0), item.get("ordersSumRub", 0),
+                 item.get("buyoutsCount", 0), item.get("buyoutsSumRub", 0),
+                 item.get("cancelCount", 0), item.get("cancelSumRub", 0),
+                 item.get("avgPriceRub", 0)) for item in data_list)
+
         try:
-            start_time = time.time()
-            temp_table_name = f"temp_{STG_NM_REPORT_DETAIL_TABLE_NAME}"
-            create_temp_table_query = f"""
-            CREATE TEMP TABLE {temp_table_name} (
-                LIKE {STG_SCHEMA_NAME}.{STG_NM_REPORT_DETAIL_TABLE_NAME} 
-                INCLUDING DEFAULTS
-            ) ON COMMIT DROP;
-            """
-            buf = StringIO()
-            writer = csv.writer(buf, delimiter='\t')
-
-            for item in data_list:
-                row = (item["date"], self.store_id, item["mnID"],
-                       item.get("openCardCount",
-                                0), item.get("addToCartCount", 0),
-                       item.get("ordersCount", 0), item.get("ordersSumRub", 0),
-                       item.get("buyoutsCount",
-                                0), item.get("buyoutsSumRub",
-                                             0), item.get("cancelCount", 0),
-                       item.get("cancelSumRub", 0), item.get("avgPriceRub", 0))
-                writer.writerow(row)
-
-            buf.seek(0)
-
-            with self.db_handler.connection:
-                with self.db_handler.connection.cursor() as cur:
-                    cur.execute(create_temp_table_query)
-                    cur.copy_from(buf,
-                                  temp_table_name,
-                                  sep='\t',
-                                  columns=('date', 'store_id', 'nm_id',
-                                           'open_card_count',
-                                           'add_to_cart_count', 'orders_count',
-                                           'orders_sum_rub', 'buyouts_count',
-                                           'buyouts_sum_rub', 'cancel_count',
-                                           'cancel_sum_rub', 'avg_price_rub'))
-
-                    insert_query = f"""
-                    INSERT INTO {STG_SCHEMA_NAME}.{STG_NM_REPORT_DETAIL_TABLE_NAME}
-                    SELECT * FROM {temp_table_name}
-                    ON CONFLICT (date, store_id, nm_id) DO NOTHING;
-                    """
-                    cur.execute(insert_query)
-
-                    cur.execute(f"SELECT COUNT(*) FROM {temp_table_name}")
-                    inserted_count = cur.fetchone()[0]
-
-            duration = time.time() - start_time
-            print(
-                f"-- insert_nm_report_detail_data -- \nInserted {inserted_count} records in {duration:.2f} seconds"
-            )
+            result = upsert.load(self.db_handler, rows, cursor=cursor)
+            print(f"-- insert_nm_report_detail_data -- \n{result}")
 
-            return f"Successfully inserted {inserted_count} records into {STG_SCHEMA_NAME}.{STG_NM_REPORT_DETAIL_TABLE_NAME}"
+            return f"Successfully inserted {result.inserted} records into {STG_SCHEMA_NAME}.{STG_NM_REPORT_DETAIL_TABLE_NAME}"
 
         except Exception as e:
-            if self.db_handler.connection:
-                self.db_handler.connection.rollback()
             print(f"Error during insert operation: {str(e)}")
             raise
 
+    def insert_nm_report_history_data(self,
+                                      data_list: list[dict],
+                                      cursor=None) -> str:
+        if not data_list:
+            return "No data to insert"
+
+        rows = ((item["date"], self.store_id, item["mnID"],
+                 item.get("openCardCount", 0), item.get("addToCartCount", 0),
+                 item.get("ordersCount", 0), item.get("ordersSumRub", 0),
+                 item.get("buyoutsCount", 0), item.get("buyoutsSumRub", 0), 0,
+                 0, 0) for item in data_list)
+
+        result = NM_REPORT_HISTORY_UPSERT.load(self.db_handler,
+                                               rows,
+                                               cursor=cursor)
+        print(f"-- insert_nm_report_history_data -- \n{result}")
+
+        return f"Successfully inserted {result.inserted} and updated {result.updated} records into {STG_SCHEMA_NAME}.{STG_NM_REPORT_DETAIL_TABLE_NAME}"
+
+    def flush_nm_report_history(self, cards_by_date: dict, last_nm_id: int,
+                                is_next_page: bool) -> bool:
+        """
+        Пачка history для всех дат и продвижение очереди - одной транзакцией.
+        Строки detail не удаляются. При ошибке даты возвращаются в очередь.
+        """
+        try:
+            with self.db_handler.connection as connection:
+                with connection.cursor() as cur:
+                    self.insert_nm_report_history_data(
+                        data_list=[
+                            card for cards in cards_by_date.values()
+                            for card in cards
+                        ],
+                        cursor=cur,
+                    )
+                    for target_date in cards_by_date:
+                        self.queue.complete_history_batch(target_date,
+                                                          last_nm_id,
+                                                          is_next_page,
+                                                          cursor=cur)
+            return True
+        except Exception as e:
+            self.logger.error(
+                source="taskNmReportDetail",
+                message=f"history save error: {e}",
+                store_id=self.store_id,
+            )
+            for target_date in cards_by_date:
+                self.queue.release(target_date)
+            return False
+
+    def save_nm_report_pages(self,
+                             pages: list[tuple],
+                             in_flight_dates=(),
+                             refresh_dates=None):
+        """
+        Пачка страниц (date, page, cards, is_next_page) и продвижение очереди -
+        одной транзакцией. Перед первой страницей даты её старые строки
+        удаляются (дата загружается заново). Даты из in_flight_dates
+        (следующая страница уже запрошена) остаются занятыми.
+        refresh_dates - {date: refresh_started_at} обновляемых загруженных дат:
+        их строки обновляются на месте, а после последней страницы удаляются
+        строки, не полученные с начала обновления, - витрина не видит неполный день.
+        """
+        refresh_dates = refresh_dates or {}
+        delete_query = f"""
+            DELETE FROM {STG_SCHEMA_NAME}.{STG_NM_REPORT_DETAIL_TABLE_NAME}
+            WHERE store_id = %s AND date = %s;
+        """
+        delete_unseen_query = f"""
+            DELETE FROM {STG_SCHEMA_NAME}.{STG_NM_REPORT_DETAIL_TABLE_NAME}
+            WHERE store_id = %s AND date = %s
+            AND (created_at IS NULL OR created_at < %s);
+        """
+        with self.db_handler.connection as connection:
+            with connection.cursor() as cur:
+                for target_date, page, _, _ in pages:
+                    if page == 1 and target_date not in refresh_dates:
+                        cur.execute(delete_query, (self.store_id, target_date))
+                self.insert_nm_report_detail_data(
+                    data_list=[
+                        card for target_date, _, cards, _ in pages
+                        if target_date not in refresh_dates for card in cards
+                    ],
+                    cursor=cur,
+                )
+                self.insert_nm_report_detail_data(
+                    data_list=[
+                        card for target_date, _, cards, _ in pages
+                        if target_date in refresh_dates for card in cards
+                    ],
+                    cursor=cur,
+                    upsert=NM_REPORT_DETAIL_REFRESH_UPSERT,
+                )
+                for target_date, _, _, is_next_page in pages:
+                    if target_date in refresh_dates and not is_next_page:
+                        cur.execute(delete_unseen_query,
+                                    (self.store_id, target_date,
+                                     refresh_dates[target_date]))
+                for target_date, page, _, is_next_page in pages:
+                    self.queue.complete_page(
+                        target_date,
+                        page,
+                        is_next_page,
+                        in_flight=target_date in in_flight_dates,
+                        cursor=cur)
+
+    def flush_nm_report_pages(self,
+                              pages: list[tuple],
+                              in_flight_dates=(),
+                              refresh_dates=None) -> int:
+        """Сохраняет пачку; при ошибке даты возвращаются в очередь"""
+        if not pages:
+            return 0
+        try:
+            self.save_nm_report_pages(pages, in_flight_dates, refresh_dates)
+            return len(pages)
+        except Exception as e:
+            self.logger.error(
+                source="taskNmReportDetail",
+                message=f"pages save error: {e}",
+                store_id=self.store_id,
+            )
+            for target_date in {target_date for target_date, _, _, _ in pages}:
+                self.queue.release(target_date)
+            return 0
+
+    def load_nm_report_pages(self, items: list[dict]) -> int:
+        """
+        Загружает взятые из очереди даты параллельно, в пределах лимита запросов:
+        как только страница получена, следующая страница той же даты
+        запрашивается сразу, пока текущая разбирается и вставляется.
+        Прогресс коммитится пачками по NM_REPORT_PROGRESS_BATCH_PAGES страниц.
+        Если пачка не сохранилась, запрошенные страницы её дат отбрасываются:
+        дата продолжится со страницы, записанной в очереди.
+        Возвращает количество сохранённых страниц.
+        """
+        saved = 0
+        batch = []
+        failed_dates = set()
+        refresh_dates = {
+            str(item["fact_date"]): item["refresh_started_at"]
+            for item in items if item.get("refresh_started_at")
+        }
+
+        with ThreadPoolExecutor(max_workers=len(items)) as executor:
+            futures = {}
+            for item in items:
+                target_date = str(item["fact_date"])
+                if not self.request_limiter.is_request_allowed():
+                    self.queue.release(target_date)
+                    continue
+                future = self.submit_nm_report_detail_page(
+                    executor, target_date, item["page"])
+                futures[future] = (target_date, item["page"])
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    target_date, page = futures.pop(future)
+                    data, status_code = self.receive_nm_report_detail_page(
+                        future, target_date, page)
+                    if status_code == 429:
+                        self.request_limiter.block_for_60_seconds()
+                        print("block_for_60_seconds")
+                    if target_date in failed_dates:
+                        continue
+
+                    processed_data = self.process_nm_report_detail_data(
+                        data=data,
+                        date=target_date,
+                    )
+                    if not processed_data:
+                        failed_dates.add(target_date)
+                        continue
+
+                    is_next_page = bool(processed_data.get("is_next_page"))
+                    if is_next_page and self.request_limiter.is_request_allowed(
+                    ):
+                        next_future = self.submit_nm_report_detail_page(
+                            executor, target_date, page + 1)
+                        futures[next_future] = (target_date, page + 1)
+
+                    batch.append((target_date, page,
+                                  processed_data.get("cards"), is_next_page))
+                    if len(batch) >= NM_REPORT_PROGRESS_BATCH_PAGES:
+                        in_flight_dates = {
+                            date for date, _ in futures.values()
+                        }
+                        flushed = self.flush_nm_report_pages(
+                            batch, in_flight_dates, refresh_dates)
+                        if not flushed:
+                            failed_dates.update(date
+                                                for date, _, _, _ in batch)
+                        saved += flushed
+                        batch = []
+
+        saved += self.flush_nm_report_pages(batch,
+                                            refresh_dates=refresh_dates)
+
+        # даты с ошибкой запроса или сохранения (release не трогает чужие и готовые)
+        for target_date in failed_dates:
+            self.queue.release(target_date)
+
+        return saved
+
     def process_nm_report_detail_data(
         self,
         data,
@@ -266,89 +660,80 @@ class taskNmReportDetail(TaskBase):
         except:
             return None
 
-    def process(self) -> TaskResponse:
-        next_to_load_info = self.get_next_to_load()
-        status = next_to_load_info.get("status")
-        if status == NmReportDetailStatus.SUCCESS:
-            self.status = TaskStatus.SUCCESS
-
-        elif status == NmReportDetailStatus.IN_PROGRESS:
-            target_date = next_to_load_info.get("target_date")
-            target_id = next_to_load_info.get("target_id")
-            page = next_to_load_info.get("page")
-            is_next_page = next_to_load_info.get("is_next_page")
-            cant_be_load = next_to_load_info.get("cant_be_load")
-
-            if is_next_page == None:
-                page = 1
-
-                delete_query = f"""
-                    DELETE FROM {STG_SCHEMA_NAME}.{STG_NM_REPORT_DETAIL_TABLE_NAME}
-                    WHERE store_id = {self.store_id} AND date = '{target_date}';
-                """
-                self.db_handler.execute_query(delete_query)
-                data = self.get_nm_report_detail_data(
-                    date=target_date,
-                    page=page,
-                )
-                processed_data = self.process_nm_report_detail_data(
-                    data=data,
-                    date=target_date,
-                )
-                if processed_data:
-                    is_next_page = processed_data.get("is_next_page")
-                    cards = processed_data.get("cards")
-                    self.insert_nm_report_detail_data(data_list=cards)
-                    q = f"""
-                        INSERT INTO {STG_SCHEMA_NAME}.{STG_NM_REPORT_DETAIL_INFO_TABLE_NAME}  (store_id, page, is_next_page, cant_be_load, fact_date, created_at)
-                        VALUES ({self.store_id}, {page}, {is_next_page}, FALSE, '{target_date}', CURRENT_TIMESTAMP);
-                    """
-                    self.db_handler.execute_query(q)
-            elif is_next_page == True:
-                page += 1
-                data = self.get_nm_report_detail_data(
-                    date=target_date,
-                    page=page,
-                )
-                processed_data = self.process_nm_report_detail_data(
-                    data=data,
-                    date=target_date,
-                )
-                is_next_page = processed_data.get("is_next_page")
-                cards = processed_data.get("cards")
-                self.insert_nm_report_detail_data(data_list=cards)
-
-                q = f"""
-                    UPDATE {STG_SCHEMA_NAME}.{STG_NM_REPORT_DETAIL_INFO_TABLE_NAME}
-                    SET 
-                        store_id = {self.store_id},
-                        page = {page},
-                        is_next_page = {is_next_page},
-                        cant_be_load = FALSE,
-                        fact_date = '{target_date}',
-                        created_at = CURRENT_TIMESTAMP
-                    WHERE id = {target_id};
-                """
-                self.db_handler.execute_query(q)
-
-            else:
-                self.logger.error(
-                    source="taskNmReportDetail",
-                    message=f"is_next_page has wrong value: {is_next_page}",
-                    store_id=self.store_id,
-                )
+    def replay_group(self, response) -> str:
+        # detail и history пишут одни и те же даты (первая страница detail удаляет
+        # строки даты) - одна группа, чтобы ответы шли в порядке получения
+        return "/api/v2/nm-report"
+
+    def replay_raw_response(self, response) -> int:
+        """
+        detail: первая страница даты заменяет её строки, остальные дописываются.
+        history: как при загрузке - добавляет недостающие строки и обновляет
+        только свои метрики, отмены и средняя цена из detail остаются.
+        Очередь не меняется.
+        """
+        payload = response.payload
+        if response.endpoint == "/api/v2/nm-report/detail":
+            date = payload["period"]["begin"][:10]
+            processed_data = self.process_nm_report_detail_data(
+                data=response.json(), date=date)
+            if processed_data is None:
+                raise ValueError(f"nm report page can't be processed: {date}")
+            cards = processed_data["cards"]
+            delete_query = f"""
+                DELETE FROM {STG_SCHEMA_NAME}.{STG_NM_REPORT_DETAIL_TABLE_NAME}
+                WHERE store_id = %s AND date = %s;
+            """
+            with self.db_handler.connection as connection:
+                with connection.cursor() as cur:
+                    if payload["page"] == 1:
+                        cur.execute(delete_query, (self.store_id, date))
+                    self.insert_nm_report_detail_data(cards, cursor=cur)
+            return len(cards)
+
+        begin = datetime.date.fromisoformat(payload["period"]["begin"][:10])
+        end = datetime.date.fromisoformat(payload["period"]["end"][:10])
+        dates = [
+            str(begin + datetime.timedelta(days=i))
+            for i in range((end - begin).days + 1)
+        ]
+        cards_by_date = self.process_nm_report_history_data(
+            response.json(), dates)
+        if cards_by_date is None:
+            raise ValueError(
+                f"nm report history can't be processed: {begin} - {end}")
+        cards = [card for cards in cards_by_date.values() for card in cards]
+        self.insert_nm_report_history_data(cards)
+        return len(cards)
 
-        elif status == NmReportDetailStatus.ERROR:
-            self.logger.error(
-                source="taskNmReportDetail",
-                message=f"get_next_to_load error: ERROR",
-                store_id=self.store_id,
-            )
-        else:
+    def process(self) -> TaskResponse:
+        try:
+            if not self.queue.is_seeded():
+                self.queue.seed()
+                self.choose_strategy()
+
+            history_requests = self.load_nm_report_history()
+
+            budget = min(self.request_limiter.available_requests(),
+                         NM_REPORT_MAX_DATES_IN_FLIGHT)
+            items = self.queue.claim(limit=budget) if budget else []
+            if not items:
+                # остальное, если есть, разбирают другие воркеры
+                if not history_requests and budget and not self.queue.has_unfinished(
+                ):
+                    self.status = TaskStatus.SUCCESS
+                return self._make_response(f"")
+        except Exception as e:
             self.logger.error(
                 source="taskNmReportDetail",
-                message=f"unknown status from get_next_to_load: {status}",
+                message=f"queue error: {e}",
                 store_id=self.store_id,
             )
+            return self._make_response(f"")
+
+        saved = self.load_nm_report_pages(items)
+        print(
+            f"-- nm report detail: {saved} pages saved, {len(items)} dates claimed"
+        )
 
         return self._make_response(f"")
@@ -0,0 +1,94 @@
+import json
+import os
+from typing import Optional
+
+import aiohttp
+
+ASYNC_HTTP_LIMIT = int(os.getenv("ASYNC_HTTP_LIMIT", 200))
+ASYNC_HTTP_LIMIT_PER_HOST = int(os.getenv("ASYNC_HTTP_LIMIT_PER_HOST", 50))
+ASYNC_HTTP_TIMEOUT_SECONDS = 300
+
+
+class WBAsyncClientError(Exception):
+    pass
+
+
+class WBAsyncResponse:
+    """
+    Ответ с тем же интерфейсом, что и requests.Response (status_code, content,
+    text, json()), чтобы обработчики ответов в задачах и raw_store были общими
+    для sync и async путей.
+    """
+
+    def __init__(self, status_code: int, text: str, content: bytes = None):
+        self.status_code = status_code
+        self.text = text
+        self.content = content if content is not None else text.encode("utf-8")
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class WBAsyncClient:
+
+    def __init__(
+        self,
+        limit: int = ASYNC_HTTP_LIMIT,
+        limit_per_host: int = ASYNC_HTTP_LIMIT_PER_HOST,
+        timeout_seconds: int = ASYNC_HTTP_TIMEOUT_SECONDS,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout_seconds = timeout_seconds
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self):
+        # ssl=False - так же, как verify=False в синхронных запросах
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ssl=False,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout_seconds),
+        )
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        headers: dict = None,
+        json_payload=None,
+        params: dict = None,
+    ) -> WBAsyncResponse:
+        if not self.session:
+            raise WBAsyncClientError("Client session is not started")
+
+        try:
+            async with self.session.request(
+                    method,
+                    url,
+                    headers=headers,
+                    json=json_payload,
+                    params=params,
+            ) as response:
+                text = await response.text()
+                content = await response.read()
+                return WBAsyncResponse(response.status, text, content)
+        except aiohttp.ClientError as e:
+            raise WBAsyncClientError(f"{method} {url}: {e}") from e
+
+    async def post(self, url: str, headers: dict = None, json_payload=None):
+        return await self.request("POST",
+                                  url,
+                                  headers=headers,
+                                  json_payload=json_payload)
+
+    async def get(self, url: str, headers: dict = None, params: dict = None):
+        return await self.request("GET", url, headers=headers, params=params)
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
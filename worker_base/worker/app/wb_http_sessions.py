@@ -0,0 +1,93 @@
+import os
+import threading
+from typing import Dict
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", 4))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 20))
+
+
+class WBHttpSessions:
+    """
+    Отдельная requests.Session с keep-alive пулом соединений на каждый хост WB API
+    (content-api, seller-analytics-api, statistics-api, advert-api).
+    Создаётся воркером и передаётся во все задачи всех магазинов.
+    """
+
+    def __init__(
+        self,
+        pool_connections: int = HTTP_POOL_CONNECTIONS,
+        pool_maxsize: int = HTTP_POOL_MAXSIZE,
+    ):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.sessions: Dict[str, requests.Session] = {}
+        self.adapters: Dict[str, HTTPAdapter] = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, url: str) -> requests.Session:
+        host = urlparse(url).netloc
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                adapter = HTTPAdapter(
+                    pool_connections=self.pool_connections,
+                    pool_maxsize=self.pool_maxsize,
+                )
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[host] = session
+                self.adapters[host] = adapter
+            return session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("verify", False)
+        return self.get_session(url).request(method, url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def get_stats(self) -> dict:
+        """
+        handshakes - количество открытых соединений (TCP + TLS) в пулах urllib3,
+        reuse_ratio - доля запросов, выполненных по уже открытому соединению.
+        """
+        stats = {}
+        with self.lock:
+            adapters = list(self.adapters.items())
+
+        for host, adapter in adapters:
+            pools = adapter.poolmanager.pools
+            requests_count = 0
+            handshakes = 0
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_count += pool.num_requests
+                handshakes += pool.num_connections
+
+            reuse_ratio = 0.0
+            if requests_count:
+                reuse_ratio = max(0.0, 1 - handshakes / requests_count)
+
+            stats[host] = {
+                "requests": requests_count,
+                "handshakes": handshakes,
+                "reuse_ratio": round(reuse_ratio, 3),
+            }
+        return stats
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+            self.adapters = {}
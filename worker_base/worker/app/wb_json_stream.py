@@ -0,0 +1,57 @@
+from typing import Any, Iterator
+
+import ijson
+
+
+class CountingReader:
+    """
+    Обёртка над response.raw, считает прочитанные байты и передаёт их
+    в sink (приёмник raw_response_store), если он задан.
+    """
+
+    def __init__(self, raw, sink=None):
+        self.raw = raw
+        self.sink = sink
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.raw.read(size)
+        self.bytes_read += len(data)
+        if self.sink is not None:
+            self.sink.write(data)
+        return data
+
+
+def iter_json_items(response, prefix: str = "item") -> Iterator[Any]:
+    """
+    Элементы JSON из тела ответа (requests, stream=True) по мере чтения сокета,
+    без загрузки всего тела в память. prefix - путь ijson ("item" - элементы
+    массива верхнего уровня). Пустое тело и null считаются пустым массивом.
+    Соединение возвращается в пул, когда итератор исчерпан или закрыт.
+    Если у ответа есть raw_sink (TaskBase.save_raw_response), тело сохраняется
+    только когда прочитано полностью.
+    """
+    sink = getattr(response, "raw_sink", None)
+    with response:
+        response.raw.decode_content = True
+        reader = CountingReader(response.raw, sink)
+        try:
+            yield from ijson.items(reader, prefix, use_float=True)
+            if sink is not None:
+                # ijson может не дочитать хвост после последнего элемента
+                while reader.read(65536):
+                    pass
+        except ijson.IncompleteJSONError:
+            if reader.bytes_read:
+                if sink is not None:
+                    sink.discard()
+                raise
+        except BaseException:
+            if sink is not None:
+                sink.discard()
+            raise
+        if sink is not None:
+            try:
+                sink.close()
+            except Exception as e:
+                print(f"-- raw response save error: {e}")
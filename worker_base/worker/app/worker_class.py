@@ -1,24 +1,47 @@
 import random
 import os
-from typing import List
+from typing import Dict, List
 import time
 from enum import Enum
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 
-from app.worker_db_handler import WorkerDBHandler
+from app.worker_db_handler import WorkerDBHandler, DB_POOL_MAX_CONNECTIONS
 from app.worker_logger import WorkerLogger
+from wb_shared.log_buffer import BufferedLogWriter
 from app.store_process import StoreProcess, StoreProcessStatus
+from app.async_runtime import AsyncTaskRuntime
+from app.wb_http_sessions import WBHttpSessions
+from app.raw_response_store import make_raw_response_store
+from app.task_scheduler import TaskScheduler
+from app.worker_heartbeat import WorkerHeartbeat
 
 from app.worker_public_config import (
     CORE_SCHEMA_NAME,
     STORE_TABLE_NAME,
     STORE_PROCESS_TABLE_NAME,
-    SERVICE_HEALTH_TABLE_NAME,
+    LOG_TABLE_NAME,
 )
 
 SECONDS_TO_DO_HEALTH_CHECK = 60
 SECONDS_FOR_NOT_VALID_STORE = 3600
 SECONDS_FOR_NOT_VALID_HEALTH_CHECK = 1200
 MAX_STORES_AMOUNT = 15
+CONCURRENT_WAIT_SECONDS = 1
+SCHEDULER_MAX_SLEEP_SECONDS = 5
+SECONDS_BETWEEN_STORE_CLAIMS = 30
+RAW_RESPONSE_PURGE_SECONDS = 3600
+
+
+class WorkerExecutionMode(Enum):
+    SEQUENTIAL = "sequential"
+    THREADS = "threads"
+    ASYNCIO = "asyncio"
+
+
+WORKER_EXECUTION_MODE = WorkerExecutionMode(
+    os.getenv("WORKER_EXECUTION_MODE", WorkerExecutionMode.SEQUENTIAL.value))
+MAX_CONCURRENT_STORES = int(
+    os.getenv("MAX_CONCURRENT_STORES", MAX_STORES_AMOUNT))
 
 
 class Worker:
@@ -26,16 +49,53 @@ class Worker:
     def __init__(self):
         self.worker_id = os.getenv("WORKER", "worker_default")
         self.version = os.getenv("VERSION", "version_default")
-        self.last_health_check = None
-        self.db_handler = WorkerDBHandler()
+        self.last_stats_print = None
+        # соединения закрепляются за потоками: основной цикл + потоки магазинов
+        self.db_handler = WorkerDBHandler(
+            max_connections=max(DB_POOL_MAX_CONNECTIONS,
+                                MAX_CONCURRENT_STORES + 2))
+        self.log_writer = BufferedLogWriter(
+            db_handler_factory=WorkerDBHandler,
+            schema_name=CORE_SCHEMA_NAME,
+            table_name=LOG_TABLE_NAME,
+        )
         self.logger = WorkerLogger(
             db_handler=self.db_handler,
             worker=self.worker_id,
+            log_writer=self.log_writer,
+        )
+        self.http_sessions = WBHttpSessions()
+        self.raw_store = make_raw_response_store(self.db_handler)
+        self.last_raw_store_purge = 0
+        self.heartbeat = WorkerHeartbeat(
+            worker_id=self.worker_id,
+            version=self.version,
+            interval_seconds=SECONDS_TO_DO_HEALTH_CHECK,
         )
+        self.heartbeat.start()
         self.stores: List[StoreProcess] = []
-        self.current_store_index = 0
+        self.scheduler = TaskScheduler()
+        self.last_store_claim = 0
+        self.store_claim_needed = True
+
+        self.execution_mode = WORKER_EXECUTION_MODE
+        self.executor: ThreadPoolExecutor | None = None
+        self.async_runtime: AsyncTaskRuntime | None = None
+        self.store_futures: Dict[int, Future] = {}
+        if self.execution_mode == WorkerExecutionMode.THREADS:
+            self.executor = ThreadPoolExecutor(
+                max_workers=MAX_CONCURRENT_STORES,
+                thread_name_prefix="store_process",
+            )
+        elif self.execution_mode == WorkerExecutionMode.ASYNCIO:
+            self.async_runtime = AsyncTaskRuntime(
+                max_blocking_threads=MAX_CONCURRENT_STORES)
 
-    def get_and_update_user_info_from_db(self) -> dict | None:
+    def claim_stores_from_db(self, limit: int) -> list[dict]:
+        """
+        Одним запросом блокирует до limit свободных store_process,
+        помечает их занятыми этим воркером и возвращает вместе с данными магазина.
+        """
         query = f"""
             WITH blocked_store AS (
                 SELECT sp.store_process_id
@@ -58,27 +118,42 @@ class Worker:
                     )
                 )
                 FOR UPDATE SKIP LOCKED
-                LIMIT 1
-            ) UPDATE {CORE_SCHEMA_NAME}.{STORE_PROCESS_TABLE_NAME} sp
-            SET
-                running = true,
-                process_health_check = NOW(),
-                last_worker_start = NOW(),
-                service = '{self.worker_id}'
-            FROM blocked_store
-            WHERE sp.store_process_id = blocked_store.store_process_id
-            RETURNING sp.*;
+                LIMIT %s
+            ),
+            claimed_store AS (
+                UPDATE {CORE_SCHEMA_NAME}.{STORE_PROCESS_TABLE_NAME} sp
+                SET
+                    running = true,
+                    process_health_check = NOW(),
+                    last_worker_start = NOW(),
+                    service = %s
+                FROM blocked_store
+                WHERE sp.store_process_id = blocked_store.store_process_id
+                RETURNING sp.store_process_id, sp.store_id
+            )
+            SELECT
+                cs.store_process_id,
+                cs.store_id,
+                s.store_id IS NOT NULL AS store_exists,
+                s.store_name,
+                s.api_token,
+                s.token_is_valid,
+                s.secret_key
+            FROM claimed_store cs
+            LEFT JOIN {CORE_SCHEMA_NAME}.{STORE_TABLE_NAME} s
+                ON s.store_id = cs.store_id;
         """
         try:
-            result = self.db_handler.execute_and_fetch_single_row(query)
+            result = self.db_handler.execute_and_fetch_all(
+                query, (limit, self.worker_id))
         except Exception as e:
             self.logger.error(
-                "get_and_update_user_info_from_db",
+                "claim_stores_from_db",
                 f"Ошибка при выполнении запроса: {str(e)}",
             )
-            return None
+            return []
 
-        return result
+        return result if result else []
 
     def mark_process_completed(self,
                                store_process_id: int,
@@ -106,199 +181,228 @@ class Worker:
             self.db_handler.connection.rollback()
             raise e
 
-    def get_store(self):
-        store_info = self.get_and_update_user_info_from_db()
-        if not store_info:
+    def get_stores(self, limit: int) -> List[StoreProcess]:
+        stores_info = self.claim_stores_from_db(limit)
+        if not stores_info:
             print("-- no stores are available")
-            return None
+            return []
 
-        store_id = store_info.get("store_id")
-        store_process_id = store_info.get("store_process_id")
+        stores = []
+        for store_info in stores_info:
+            store_id = store_info.get("store_id")
+            store_process_id = store_info.get("store_process_id")
 
-        if not store_id or not store_process_id:
-            self.logger.error(
-                "get_store",
-                "None store_id or store_process_id",
-                {"store_info": store_info},
-            )
-            return None
-
-        store_data_query = f"""
-            SELECT store_name, api_token, token_is_valid, secret_key
-            FROM {CORE_SCHEMA_NAME}.{STORE_TABLE_NAME}
-            WHERE store_id = %s
-            LIMIT 1;
-        """
-        try:
-            store_data = self.db_handler.execute_and_fetch_single_row(
-                store_data_query,
-                (store_id, ),
-            )
-
-            if not store_data:
+            if not store_info.get("store_exists"):
                 self.logger.error(
-                    "get_store",
+                    "get_stores",
                     f"Магазин с ID {store_id} не найден",
                     {"store_id": store_id},
                 )
-                return None
-
-            token_is_valid = store_data.get("token_is_valid")
+                continue
 
-            if not token_is_valid:
-                self.mark_process_completed(
-                    store_process_id,
-                    data_loaded=True,
-                )
+            if not store_info.get("token_is_valid"):
+                try:
+                    self.mark_process_completed(
+                        store_process_id,
+                        data_loaded=True,
+                    )
+                except Exception as e:
+                    self.logger.error(
+                        "get_stores",
+                        f"Error while releasing store process: {str(e)}",
+                        {"store_id": store_id},
+                    )
                 self.logger.error(
-                    source="get_store",
+                    source="get_stores",
                     message=f"TOKEN IS NOT VALID",
                     store_id=store_id,
                 )
-                return None
-
-            return StoreProcess(
-                store_id=store_id,
-                store_process_id=store_process_id,
-                store_name=store_data.get("store_name"),
-                api_token=store_data.get("api_token"),
-                secret_key=store_data.get("secret_key"),
-                db_handler=self.db_handler,
-                logger=self.logger,
-            )
+                continue
 
-        except Exception as e:
-            self.logger.error(
-                "get_store",
-                f"Error while getting store data: {str(e)}",
-                {"store_id": store_id},
-            )
-            return None
+            stores.append(
+                StoreProcess(
+                    store_id=store_id,
+                    store_process_id=store_process_id,
+                    store_name=store_info.get("store_name"),
+                    api_token=store_info.get("api_token"),
+                    secret_key=store_info.get("secret_key"),
+                    db_handler=self.db_handler,
+                    logger=self.logger,
+                    http_sessions=self.http_sessions,
+                    raw_store=self.raw_store,
+                ))
+
+        return stores
 
     def update_stores(self):
-        if len(self.stores) < MAX_STORES_AMOUNT:
-            print("-- update_stores")
-            store_object = self.get_store()
-            if store_object:
-                self.logger.info(
-                    "update_stores",
-                    f"add_store",
-                    store_id=store_object.store_id,
-                )
-                self.stores.append(store_object)
-        return False
+        free_slots = MAX_STORES_AMOUNT - len(self.stores)
+        if free_slots <= 0:
+            return False
 
-    def update_worker_health_check(self) -> bool:
-        query = f"""
-            INSERT INTO {CORE_SCHEMA_NAME}.{SERVICE_HEALTH_TABLE_NAME} (
-                service_type, service_name, version, last_health_check, updated_at
+        current_time = time.time()
+        if self.stores and not self.store_claim_needed and current_time - self.last_store_claim < SECONDS_BETWEEN_STORE_CLAIMS:
+            return False
+
+        print("-- update_stores")
+        self.last_store_claim = current_time
+        self.store_claim_needed = False
+
+        store_objects = self.get_stores(free_slots)
+        for store_object in store_objects:
+            self.logger.info(
+                "update_stores",
+                f"add_store",
+                store_id=store_object.store_id,
             )
-            VALUES (%s, %s, %s, NOW(), NOW())
-            ON CONFLICT (service_type, service_name)
-            DO UPDATE SET
-                last_health_check = NOW(),
-                updated_at = NOW(),
-                version = COALESCE(EXCLUDED.version, {SERVICE_HEALTH_TABLE_NAME}.version)
-            RETURNING id;
-        """
-        try:
-            result = self.db_handler.execute_and_fetch_single_row(
-                query, ("worker", self.worker_id, self.version))
-            updated = bool(result)
-            return updated
+            self.stores.append(store_object)
+            for task in store_object.tasks:
+                self.scheduler.push(task, store=store_object)
 
-        except Exception as e:
-            self.logger.error(
-                source="worker",
-                message=f"[health_check] Error while upserting: {str(e)}")
-            return False
+        self.update_heartbeat_process_ids()
+        return len(store_objects) > 0
 
-    def update_store_health_check(self) -> bool:
-        if not self.stores:
-            print("-- None available process for health_check")
-            return True
+    def update_heartbeat_process_ids(self):
+        self.heartbeat.set_process_ids(
+            store.store_process_id for store in self.stores)
 
-        process_ids = [str(store.store_process_id) for store in self.stores]
-        process_ids_str = ",".join(process_ids)
+    def print_stats(self):
+        current_time = time.time()
 
-        query = f"""
-            UPDATE {CORE_SCHEMA_NAME}.{STORE_PROCESS_TABLE_NAME}
-            SET 
-                process_health_check = NOW()
-            WHERE 
-                store_process_id IN ({process_ids_str})
-                AND service = %s
-            RETURNING store_process_id;
-        """
+        if not self.last_stats_print or current_time - self.last_stats_print > SECONDS_TO_DO_HEALTH_CHECK:
+            print(f"-- http sessions stats: {self.http_sessions.get_stats()}")
+            print(f"-- db pool stats: {self.db_handler.get_metrics()}")
+            self.last_stats_print = current_time
 
+    def purge_raw_store(self):
+        """Удаление сырых ответов старше RAW_RESPONSE_RETENTION_DAYS, раз в RAW_RESPONSE_PURGE_SECONDS"""
+        current_time = time.time()
+        if self.raw_store is None or current_time - self.last_raw_store_purge < RAW_RESPONSE_PURGE_SECONDS:
+            return
+        self.last_raw_store_purge = current_time
         try:
-            result = self.db_handler.execute_and_fetch_single_row(
-                query,
-                (self.worker_id, ),
-            )
-            updated_count = len(result) if result else 0
-            print(
-                f"Updated health_check for {updated_count} processes: {process_ids}"
+            removed = self.raw_store.purge()
+            print(f"-- raw responses purged: {removed}")
+        except Exception as e:
+            self.logger.error(
+                source="purge_raw_store",
+                message=f"error: {e}",
             )
-            return True
 
+    def complete_store(self, store: StoreProcess):
+        self.stores.remove(store)
+        self.scheduler.remove_store(store)
+        self.store_claim_needed = True
+        self.update_heartbeat_process_ids()
+        try:
+            self.mark_process_completed(
+                store.store_process_id,
+                data_loaded=True,
+            )
         except Exception as e:
             self.logger.error(
-                "health_check",
-                f"Error while health_check: {str(e)}",
-                {"process_ids": process_ids},
+                source="run_iteration",
+                message=f"error: {e}",
             )
-            return False
-
-    def scedualed_health_check(self):
-        current_time = time.time()
-
-        if not self.last_health_check or current_time - self.last_health_check > SECONDS_TO_DO_HEALTH_CHECK:
-            self.update_store_health_check()
-            self.update_worker_health_check()
-            self.last_health_check = current_time
 
-    # возвращать статусы нормально
-    def run_iteration(self):
-        print("- worker iter start")
-        self.scedualed_health_check()
-        self.update_stores()
+        self.logger.info(
+            "run_iteration",
+            f"delete_store",
+            store_id=store.store_id,
+        )
 
-        stores_lengt = len(self.stores)
-        if stores_lengt == 0:
-            time.sleep(7.5)
-            return "- stores_lengt is 0"
+    def run_sequential_iteration(self):
+        entry = self.scheduler.pop_ready()
+        if entry is None:
+            seconds_until_next = self.scheduler.seconds_until_next()
+            if seconds_until_next is None:
+                seconds_until_next = SCHEDULER_MAX_SLEEP_SECONDS
+            time.sleep(min(seconds_until_next, SCHEDULER_MAX_SLEEP_SECONDS))
+            return "- no ready tasks"
 
-        store_index = self.current_store_index % stores_lengt
-        self.current_store_index += 1
-        store = self.stores[store_index]
+        store, task = entry
 
         try:
-            store_process_response = store.store_process_iter()
+            store_process_response = store.run_task(task)
         except Exception as e:
             self.logger.error(
                 source="run_iteration",
                 store_id=store.store_id,
                 message=f"error: {e}",
             )
+            self.scheduler.push(task, store=store)
             return f"Error: {e}"
 
         if store_process_response.status == StoreProcessStatus.SUCCESS or store_process_response.status == StoreProcessStatus.ERROR:
-            del self.stores[store_index]
+            self.complete_store(store)
+        else:
+            self.scheduler.push(task, store=store)
+        return "- worker iter end"
+
+    def submit_store_iteration(self, store: StoreProcess) -> Future:
+        if self.async_runtime:
+            return self.async_runtime.submit(
+                store.store_process_iter_async(
+                    self.async_runtime.http_client))
+        return self.executor.submit(store.store_process_iter)
+
+    def run_concurrent_iteration(self):
+        for store in self.stores:
+            if store.store_process_id not in self.store_futures:
+                self.store_futures[
+                    store.store_process_id] = self.submit_store_iteration(
+                        store)
+
+        done, _ = wait(
+            list(self.store_futures.values()),
+            timeout=CONCURRENT_WAIT_SECONDS,
+            return_when=FIRST_COMPLETED,
+        )
+
+        for store in list(self.stores):
+            future = self.store_futures.get(store.store_process_id)
+            if future is None or future not in done:
+                continue
+            del self.store_futures[store.store_process_id]
+
             try:
-                self.mark_process_completed(
-                    store.store_process_id,
-                    data_loaded=True,
-                )
+                store_process_response = future.result()
             except Exception as e:
                 self.logger.error(
                     source="run_iteration",
+                    store_id=store.store_id,
                     message=f"error: {e}",
                 )
+                continue
 
-            self.logger.info(
-                "run_iteration",
-                f"delete_store",
-                store_id=store.store_id,
-            )
-        return "- worker iter end"
+            if store_process_response.status == StoreProcessStatus.SUCCESS or store_process_response.status == StoreProcessStatus.ERROR:
+                self.complete_store(store)
+
+        return f"- worker iter end, stores in progress: {len(self.store_futures)}"
+
+    def close(self):
+        # после остановки магазины не должны продлеваться, иначе их не заберёт другой воркер
+        self.heartbeat.stop()
+        if self.executor:
+            self.executor.shutdown(wait=True)
+        if self.async_runtime:
+            self.async_runtime.close()
+        self.http_sessions.close()
+        self.log_writer.close()
+        self.db_handler.close()
+
+    # возвращать статусы нормально
+    def run_iteration(self):
+        print("- worker iter start")
+        self.print_stats()
+        self.purge_raw_store()
+        self.update_stores()
+
+        stores_lengt = len(self.stores)
+        if stores_lengt == 0:
+            time.sleep(7.5)
+            return "- stores_lengt is 0"
+
+        if self.executor or self.async_runtime:
+            return self.run_concurrent_iteration()
+
+        return self.run_sequential_iteration()
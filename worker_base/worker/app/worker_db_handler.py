@@ -1,11 +1,20 @@
+import os
+import threading
+
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from app.worker_private_config import DB_CONFIG
-from psycopg2.extensions import connection as pg_connection, cursor as pg_cursor
+from psycopg2.extensions import connection as pg_connection, cursor as pg_cursor, TRANSACTION_STATUS_IDLE
 from typing import Optional
 
 import time
 from functools import wraps
 
+DB_POOL_MIN_CONNECTIONS = int(os.getenv("DB_POOL_MIN_CONNECTIONS", 1))
+DB_POOL_MAX_CONNECTIONS = int(os.getenv("DB_POOL_MAX_CONNECTIONS", 20))
+DB_POOL_CHECKOUT_TIMEOUT_SECONDS = 30
+DB_POOL_CHECKOUT_RETRY_SECONDS = 0.05
+
 
 def log_duration(method):
 
@@ -21,120 +30,249 @@ def log_duration(method):
 
 
 class WorkerDBHandler:
+    """
+    Пул соединений psycopg2. Каждый поток получает своё соединение и курсор
+    (self.connection / self.cursor), поэтому один обработчик можно использовать
+    из нескольких потоков. Короткоживущие и общие потоки (executor-ы) вызывают
+    код через run_and_release, чтобы соединение не оставалось за потоком.
+    Разорванные соединения выбрасываются из пула, запрос до commit повторяется один раз.
+    """
 
-    def __init__(self):
+    def __init__(
+        self,
+        min_connections: int = DB_POOL_MIN_CONNECTIONS,
+        max_connections: int = DB_POOL_MAX_CONNECTIONS,
+    ):
         self.db_config = DB_CONFIG
-        self.connection: Optional[pg_connection] = None
-        self.cursor: Optional[pg_cursor] = None
+        self.min_connections = min_connections
+        self.max_connections = max(min_connections, max_connections)
+        self.pool: Optional[ThreadedConnectionPool] = None
+        self.local = threading.local()
+        self.metrics_lock = threading.Lock()
+        self.metrics = {
+            "checkouts": 0,
+            "returns": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "reconnects": 0,
+        }
         self.connect()
 
     def connect(self):
         print(f"DB_CONFIG: {self.db_config}")
-        self.connection = psycopg2.connect(**self.db_config)
-        self.cursor = self.connection.cursor()
-        self.cursor.execute("SET timezone = 'Europe/Moscow';")
-        self.connection.commit()
+        self.pool = ThreadedConnectionPool(
+            self.min_connections,
+            self.max_connections,
+            options="-c timezone=Europe/Moscow",
+            **self.db_config,
+        )
+
+    def _add_metric(self, name, value=1):
+        with self.metrics_lock:
+            self.metrics[name] += value
+
+    def get_metrics(self) -> dict:
+        with self.metrics_lock:
+            metrics = dict(self.metrics)
+        if self.pool and not self.pool.closed:
+            metrics["in_use"] = len(self.pool._used)
+            metrics["idle"] = len(self.pool._pool)
+        metrics["max_connections"] = self.max_connections
+        return metrics
+
+    def getconn(self) -> pg_connection:
+        start = time.time()
+        waited = False
+        while True:
+            try:
+                connection = self.pool.getconn()
+                break
+            except PoolError:
+                if self.pool.closed or time.time(
+                ) - start > DB_POOL_CHECKOUT_TIMEOUT_SECONDS:
+                    raise
+                waited = True
+                time.sleep(DB_POOL_CHECKOUT_RETRY_SECONDS)
+
+        if waited:
+            self._add_metric("waits")
+            self._add_metric("wait_seconds", time.time() - start)
+        self._add_metric("checkouts")
+        return connection
+
+    def putconn(self, connection: pg_connection, close: bool = False):
+        if self.pool.closed:
+            return
+        # незавершённую транзакцию пул откатывает сам
+        self.pool.putconn(connection, close=close or connection.closed != 0)
+        self._add_metric("returns")
+
+    @property
+    def connection(self) -> pg_connection:
+        """Соединение, закреплённое за текущим потоком"""
+        connection = getattr(self.local, "connection", None)
+        if connection is None or connection.closed:
+            if connection is not None:
+                self.putconn(connection, close=True)
+                self._add_metric("reconnects")
+            connection = self.getconn()
+            self.local.connection = connection
+            self.local.cursor = None
+        return connection
+
+    @property
+    def cursor(self) -> pg_cursor:
+        connection = self.connection
+        cursor = getattr(self.local, "cursor", None)
+        if cursor is None or cursor.closed:
+            cursor = connection.cursor()
+            self.local.cursor = cursor
+        return cursor
+
+    def release_thread_connection(self):
+        """Вернуть в пул соединение текущего потока (при завершении потока)"""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            return
+        self.local.connection = None
+        self.local.cursor = None
+        self.putconn(connection)
+
+    def run_and_release(self, func, *args, **kwargs):
+        """func в потоке executor-а: после вызова соединение потока возвращается в пул"""
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.release_thread_connection()
+
+    def _discard_thread_connection(self):
+        connection = getattr(self.local, "connection", None)
+        self.local.connection = None
+        self.local.cursor = None
+        if connection is not None:
+            self.putconn(connection, close=True)
+        self._add_metric("reconnects")
+
+    def _run(self, action, commit: bool = True):
+        """
+        Выполняет action(cursor) на соединении потока и коммитит (commit=True).
+        Чтение (commit=False) завершает начатую им транзакцию откатом, чтобы
+        закреплённое за потоком соединение не оставалось "idle in transaction"
+        с блокировками; транзакцию вызывающего кода чтение не трогает.
+        Если соединение оказалось разорванным до commit - берёт новое и повторяет
+        один раз. Ошибка самого commit не повторяется: транзакция могла примениться.
+        """
+        for attempt in range(2):
+            connection = self.connection
+            cursor = self.cursor
+            outer_transaction = connection.get_transaction_status(
+            ) != TRANSACTION_STATUS_IDLE
+            try:
+                result = action(cursor)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                if connection.closed and attempt == 0:
+                    self._discard_thread_connection()
+                    continue
+                if not connection.closed:
+                    connection.rollback()
+                raise
+            except Exception:
+                if not connection.closed:
+                    connection.rollback()
+                raise
+
+            if commit:
+                try:
+                    connection.commit()
+                except Exception:
+                    if connection.closed:
+                        self._discard_thread_connection()
+                    else:
+                        connection.rollback()
+                    raise
+            elif not outer_transaction:
+                try:
+                    connection.rollback()
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    # результат уже прочитан, соединение просто выбрасываем
+                    self._discard_thread_connection()
+            return result
 
     # @log_duration
     def execute_query(self, query, params=None):
         """Выполнение SQL-запроса"""
-        if self.cursor:
-            try:
-                self.cursor.execute(query, params)
-                self.connection.commit()
-            except Exception as e:
-                self.connection.rollback()
-                raise e
+
+        def action(cursor):
+            cursor.execute(query, params)
+
+        self._run(action)
 
     # @log_duration
     def execute_many(self, query, params=None):
         """Массовая вставка данных"""
-        if self.cursor:
-            try:
-                if params and isinstance(params, list):
-                    self.cursor.executemany(query, params)
-                else:
-                    raise ValueError(
-                        "Params must be a list of tuples for bulk insert.")
+        if not params or not isinstance(params, list):
+            raise ValueError(
+                "Params must be a list of tuples for bulk insert.")
 
-                self.connection.commit()
-            except Exception as e:
-                self.connection.rollback()
-                raise e
+        def action(cursor):
+            cursor.executemany(query, params)
+
+        self._run(action)
 
     # @log_duration
     def fetch_all(self, query, params=None):
         """Выборка всех данных"""
-        if self.cursor:
-            try:
-                self.cursor.execute(query, params)
-                return self.cursor.fetchall()
-            except Exception as e:
-                raise e
+
+        def action(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+        return self._run(action, commit=False)
 
     # @log_duration
     def fetch_one(self, query, params=None):
         """Выборка одной строки"""
-        if self.cursor:
-            try:
-                self.cursor.execute(query, params)
-                return self.cursor.fetchone()
-            except Exception as e:
-                raise e
+
+        def action(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchone()
+
+        return self._run(action, commit=False)
 
     # @log_duration
     def execute_and_fetch_single_row(self, query, params=None):
-        if not self.cursor:
-            raise RuntimeError("Cursor is not initialized")
 
-        try:
-            self.cursor.execute(query, params)
+        def action(cursor):
+            cursor.execute(query, params)
             result = None
-            if self.cursor.description:
-                row = self.cursor.fetchone()
+            if cursor.description:
+                row = cursor.fetchone()
                 if row:
-                    colnames = [desc[0] for desc in self.cursor.description]
+                    colnames = [desc[0] for desc in cursor.description]
                     result = dict(zip(colnames, row))
-            if self.connection:
-                self.connection.commit()
 
             return result
 
-        except Exception as e:
-            if self.connection:
-                self.connection.rollback()
-            raise e
+        return self._run(action)
 
     # @log_duration
     def execute_and_fetch_all(self, query, params=None) -> list[dict] | None:
-        if not self.cursor:
-            raise RuntimeError("Cursor is not initialized")
 
-        try:
-            self.cursor.execute(query, params)
-            if not self.cursor.description:
-                if self.connection:
-                    self.connection.commit()
+        def action(cursor):
+            cursor.execute(query, params)
+            if not cursor.description:
                 return None
-            colnames = [desc[0] for desc in self.cursor.description]
-            rows = self.cursor.fetchall()
+            colnames = [desc[0] for desc in cursor.description]
+            rows = cursor.fetchall()
             result = [dict(zip(colnames, row)) for row in rows]
 
-            if self.connection:
-                self.connection.commit()
-
             return result if result else None
 
-        except Exception as e:
-            if self.connection:
-                self.connection.rollback()
-            raise e
+        return self._run(action)
 
     def close(self):
-        if self.cursor:
-            self.cursor.close()
-        if self.connection:
-            self.connection.close()
+        if self.pool and not self.pool.closed:
+            self.pool.closeall()
 
     def __del__(self):
         self.close()
@@ -0,0 +1,95 @@
+import threading
+from typing import Iterable
+
+from app.worker_db_handler import WorkerDBHandler
+
+from app.worker_public_config import (
+    CORE_SCHEMA_NAME,
+    STORE_PROCESS_TABLE_NAME,
+    SERVICE_HEALTH_TABLE_NAME,
+)
+
+
+class WorkerHeartbeat(threading.Thread):
+    """
+    Продлевает process_health_check всех занятых воркером store_process
+    и строку воркера в service_health с фиксированным интервалом,
+    независимо от того, сколько длится текущая задача.
+    Работает через своё соединение с БД.
+    """
+
+    def __init__(self, worker_id: str, version: str, interval_seconds: int):
+        super().__init__(name="worker_heartbeat", daemon=True)
+        self.worker_id = worker_id
+        self.version = version
+        self.interval_seconds = interval_seconds
+        self.db_handler: WorkerDBHandler | None = None
+        self.process_ids: set[int] = set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def set_process_ids(self, process_ids: Iterable[int]):
+        with self.lock:
+            self.process_ids = set(process_ids)
+
+    def beat(self) -> dict | None:
+        with self.lock:
+            process_ids = sorted(self.process_ids)
+
+        query = f"""
+            WITH store_health AS (
+                UPDATE {CORE_SCHEMA_NAME}.{STORE_PROCESS_TABLE_NAME}
+                SET
+                    process_health_check = NOW()
+                WHERE
+                    store_process_id = ANY(%s::int[])
+                    AND service = %s
+                RETURNING store_process_id
+            ),
+            worker_health AS (
+                INSERT INTO {CORE_SCHEMA_NAME}.{SERVICE_HEALTH_TABLE_NAME} (
+                    service_type, service_name, version, last_health_check, updated_at
+                )
+                VALUES (%s, %s, %s, NOW(), NOW())
+                ON CONFLICT (service_type, service_name)
+                DO UPDATE SET
+                    last_health_check = NOW(),
+                    updated_at = NOW(),
+                    version = COALESCE(EXCLUDED.version, {SERVICE_HEALTH_TABLE_NAME}.version)
+                RETURNING id
+            )
+            SELECT
+                (SELECT COUNT(*) FROM store_health) AS updated_processes,
+                (SELECT id FROM worker_health) AS service_health_id;
+        """
+
+        if self.db_handler is None:
+            self.db_handler = WorkerDBHandler(max_connections=1)
+
+        result = self.db_handler.execute_and_fetch_single_row(
+            query,
+            (process_ids, self.worker_id, "worker", self.worker_id,
+             self.version),
+        )
+        print(
+            f"-- heartbeat: updated health_check for {result.get('updated_processes') if result else 0} processes: {process_ids}"
+        )
+        return result
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.beat()
+            except Exception as e:
+                print(f"[heartbeat] Error while health_check: {str(e)}")
+                if self.db_handler:
+                    self.db_handler.close()
+                self.db_handler = None
+
+            self.stop_event.wait(self.interval_seconds)
+
+        if self.db_handler:
+            self.db_handler.close()
+
+    def stop(self):
+        self.stop_event.set()
@@ -6,6 +6,7 @@ import requests
 from datetime import datetime
 
 from app.worker_db_handler import WorkerDBHandler
+from wb_shared.log_buffer import BufferedLogWriter
 from app.worker_public_config import (CORE_SCHEMA_NAME, LOG_TABLE_NAME)
 
 
@@ -15,12 +16,14 @@ class WorkerLogger:
                  db_handler: WorkerDBHandler,
                  worker: str,
                  schema_name: str = CORE_SCHEMA_NAME,
-                 table_name: str = LOG_TABLE_NAME):
+                 table_name: str = LOG_TABLE_NAME,
+                 log_writer: BufferedLogWriter = None):
 
         self.db_handler = db_handler
         self.schema_name = schema_name
         self.table_name = table_name
         self.worker = worker
+        self.log_writer = log_writer
 
     def log(
         self,
@@ -41,6 +44,16 @@ class WorkerLogger:
 
         print(f"[{level.upper()} ({source})] {message}")
 
+        if self.log_writer:
+            return self.log_writer.write(
+                level=level,
+                service=self.worker,
+                source=source,
+                message=message,
+                store_id=store_id,
+                metadata=metadata,
+            )
+
         try:
             metadata_json = json.dumps(metadata) if metadata else None
             self.db_handler.execute_query(
@@ -0,0 +1,157 @@
+import os
+import queue
+import threading
+import time
+import multiprocessing as mp
+from typing import Dict
+
+SUPERVISOR_CHECK_SECONDS = 5
+SECONDS_BEFORE_RESTART = 10
+
+
+def run_worker_process(worker_id: str, stop_event, status_queue):
+    # WORKER читается в Worker.__init__, поэтому у каждого процесса свой id
+    os.environ["WORKER"] = worker_id
+
+    from app.worker_class import Worker
+
+    status_queue.put((worker_id, True, "try to make worker"))
+    worker_obj = Worker()
+    status_queue.put((worker_id, True, "main loop started"))
+
+    while not stop_event.is_set():
+        result = worker_obj.run_iteration()
+        status_queue.put((worker_id, True, result))
+        print(f"[{worker_id}] {result}")
+
+    worker_obj.close()
+    status_queue.put((worker_id, False, "worker stopped"))
+    print(f"[{worker_id}] Worker stopped.")
+
+
+class WorkerProcessInfo:
+
+    def __init__(self, worker_id: str, stop_event):
+        self.worker_id = worker_id
+        self.stop_event = stop_event
+        self.process: mp.Process | None = None
+        self.running = False
+        self.last_response = "worker not started"
+        self.restarts = 0
+        self.last_start = 0
+
+
+class WorkerSupervisor:
+    """
+    Запускает N процессов Worker (WORKER=<base>_<i>), перезапускает упавшие
+    и собирает их статусы для /status. /start и /stop применяются ко всем процессам.
+    """
+
+    def __init__(self, processes_amount: int, base_worker_id: str):
+        # spawn: процессы перезапускаются из потока монитора и из /start при работающем
+        # uvicorn, fork унаследовал бы захваченные другими потоками блокировки
+        self.ctx = mp.get_context("spawn")
+        self.status_queue = self.ctx.Queue()
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.children: Dict[str, WorkerProcessInfo] = {}
+        for i in range(processes_amount):
+            worker_id = f"{base_worker_id}_{i}"
+            self.children[worker_id] = WorkerProcessInfo(
+                worker_id=worker_id,
+                stop_event=self.ctx.Event(),
+            )
+
+    def start_child(self, child: WorkerProcessInfo):
+        child.stop_event.clear()
+        child.process = self.ctx.Process(
+            target=run_worker_process,
+            args=(child.worker_id, child.stop_event, self.status_queue),
+            name=child.worker_id,
+            daemon=True,
+        )
+        child.process.start()
+        child.running = True
+        child.last_start = time.time()
+
+    def start(self):
+        with self.lock:
+            self.stopped = False
+            started = []
+            for child in self.children.values():
+                if child.process is None or not child.process.is_alive():
+                    self.start_child(child)
+                    started.append(child.worker_id)
+            return started
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            for child in self.children.values():
+                child.stop_event.set()
+
+    def collect_statuses(self):
+        while True:
+            try:
+                worker_id, running, last_response = self.status_queue.get_nowait(
+                )
+            except queue.Empty:
+                return
+            child = self.children.get(worker_id)
+            if child:
+                child.running = running
+                child.last_response = last_response
+
+    def restart_crashed(self):
+        with self.lock:
+            for child in self.children.values():
+                if child.process is None or child.process.is_alive():
+                    continue
+
+                child.running = False
+                if self.stopped or child.stop_event.is_set():
+                    continue
+
+                if time.time() - child.last_start < SECONDS_BEFORE_RESTART:
+                    continue
+
+                print(
+                    f"[supervisor] {child.worker_id} exited with code {child.process.exitcode}, restarting"
+                )
+                child.restarts += 1
+                self.start_child(child)
+
+    def monitor_loop(self):
+        while True:
+            self.collect_statuses()
+            self.restart_crashed()
+            time.sleep(SUPERVISOR_CHECK_SECONDS)
+
+    def start_monitor(self):
+        threading.Thread(
+            target=self.monitor_loop,
+            name="worker_supervisor",
+            daemon=True,
+        ).start()
+
+    def get_status(self) -> dict:
+        self.collect_statuses()
+        with self.lock:
+            workers = {
+                worker_id: {
+                    "running": child.running,
+                    "alive": bool(child.process and child.process.is_alive()),
+                    "pid": child.process.pid if child.process else None,
+                    "restarts": child.restarts,
+                    "last_response": child.last_response,
+                }
+                for worker_id, child in self.children.items()
+            }
+        return {
+            "running": any(w["running"] for w in workers.values()),
+            "last_response": {
+                worker_id: w["last_response"]
+                for worker_id, w in workers.items()
+            },
+            "workers": workers,
+        }
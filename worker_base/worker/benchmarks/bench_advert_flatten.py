@@ -0,0 +1,210 @@
+"""
+Сравнение разворачивания fullstats: прежний вариант (4 прохода со списками
+словарей + safe_int/safe_float + csv в StringIO) и колоночный
+(advert_flatten: один проход, приведение типов по колонкам, binary COPY).
+
+Запуск из worker_base/worker:
+    PYTHONPATH=../.. python -m benchmarks.bench_advert_flatten
+"""
+import csv
+import random
+import time
+from datetime import date, timedelta
+from io import StringIO
+
+from app.bulk_loader import CopyFormat, BulkUpsert, UpsertPolicy
+from app.tasks.advert_flatten import iter_advert_stat_copy_chunks
+
+ADVERTS_AMOUNT = 100
+DAYS_AMOUNT = 31
+APP_TYPES = (1, 32, 64)
+NM_PER_APP = 5
+REPEATS = 5
+STORE_ID = 1
+
+ADVERT_STAT_ROWS = BulkUpsert(
+    schema_name="bench",
+    table_name="advert_stat",
+    columns=[("date", "date"), ("store_id", "int4"), ("advert_id", "int4"),
+             ("app_type", "int4"), ("nm_id", "int4"), ("views", "int4"),
+             ("clicks", "int4"), ("ctr", "float8"), ("cpc", "float8"),
+             ("sum", "float8"), ("atbs", "int4"), ("orders", "int4"),
+             ("cr", "float8"), ("shks", "int4"), ("sum_price", "float8")],
+    key_columns=("date", "store_id", "advert_id", "app_type", "nm_id"),
+    policy=UpsertPolicy.UPDATE,
+    copy_format=CopyFormat.BINARY,
+)
+
+
+def make_payload(seed: int = 42) -> list:
+    rnd = random.Random(seed)
+    start = date(2025, 1, 1)
+    payload = []
+    for advert_index in range(ADVERTS_AMOUNT):
+        days = []
+        for day_index in range(DAYS_AMOUNT):
+            apps = []
+            for app_type in APP_TYPES:
+                nm = []
+                for nm_index in range(NM_PER_APP):
+                    views = rnd.randint(0, 10000)
+                    clicks = rnd.randint(0, 500)
+                    nm.append({
+                        "nmId": 100000000 + advert_index * 100 + nm_index,
+                        "name": "Товар",
+                        "views": views,
+                        "clicks": clicks,
+                        "ctr": round(clicks / views * 100, 2) if views else 0,
+                        "cpc": round(rnd.random() * 30, 2),
+                        "sum": round(rnd.random() * 5000, 2),
+                        "atbs": rnd.randint(0, 50),
+                        "orders": rnd.randint(0, 20),
+                        "cr": round(rnd.random() * 10, 2),
+                        "shks": rnd.randint(0, 20),
+                        "sum_price": rnd.choice([None, rnd.randint(0, 90000)]),
+                    })
+                apps.append({"appType": app_type, "nm": nm})
+            days.append({
+                "date": f"{start + timedelta(days=day_index)}T00:00:00+03:00",
+                "apps": apps,
+            })
+        payload.append({"advertId": 20000000 + advert_index, "days": days})
+    return payload
+
+
+def safe_int(value):
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return 0
+
+
+def safe_float(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return 0
+
+
+def legacy_flatten(data) -> list:
+    """Прежний process_advert_data: 4 прохода, на каждом новый список словарей"""
+    advert_stat = [{
+        "advert_id": single_advert["advertId"],
+        "days": single_advert["days"]
+    } for single_advert in data]
+
+    advert_day_stat = []
+    for single_advert in advert_stat:
+        advert_day_stat.extend([{
+            "advert_id": single_advert["advert_id"],
+            "date": single_day["date"][:10],
+            "apps": single_day["apps"]
+        } for single_day in single_advert["days"]])
+
+    advert_day_app_stat = []
+    for single_advert_day in advert_day_stat:
+        advert_day_app_stat.extend([{
+            "advert_id": single_advert_day["advert_id"],
+            "date": single_advert_day["date"],
+            "app_type": single_app["appType"],
+            "nm": single_app["nm"]
+        } for single_app in single_advert_day["apps"]])
+
+    result = []
+    for item in advert_day_app_stat:
+        result.extend([{
+            "advert_id": item["advert_id"],
+            "date": item["date"],
+            "app_type": item["app_type"],
+            "nm_id": single_nm.get("nmId"),
+            "views": single_nm.get("views"),
+            "clicks": single_nm.get("clicks"),
+            "ctr": single_nm.get("ctr"),
+            "cpc": single_nm.get("cpc"),
+            "sum": single_nm.get("sum"),
+            "atbs": single_nm.get("atbs"),
+            "orders": single_nm.get("orders"),
+            "cr": single_nm.get("cr"),
+            "shks": single_nm.get("shks"),
+            "sum_price": single_nm.get("sum_price")
+        } for single_nm in item["nm"]])
+    return result
+
+
+def legacy_serialize(advert_data: list) -> int:
+    """Прежний insert_advert_stat до COPY: safe_* по каждому полю и csv в StringIO"""
+    buf = StringIO()
+    writer = csv.writer(buf, delimiter='\t')
+    for item in advert_data:
+        writer.writerow([
+            item.get("date"),
+            STORE_ID,
+            item.get("advert_id"),
+            item.get("app_type"),
+            item.get("nm_id"),
+            safe_int(item.get("views")),
+            safe_int(item.get("clicks")),
+            safe_float(item.get("ctr")),
+            safe_float(item.get("cpc")),
+            safe_float(item.get("sum")),
+            safe_int(item.get("atbs")),
+            safe_int(item.get("orders")),
+            safe_float(item.get("cr")),
+            safe_int(item.get("shks")),
+            safe_float(item.get("sum_price")),
+        ])
+    return len(buf.getvalue())
+
+
+def run_legacy(payload) -> int:
+    return legacy_serialize(legacy_flatten(payload))
+
+
+def run_columnar(payload) -> int:
+    return sum(
+        len(data)
+        for data, _ in iter_advert_stat_copy_chunks(payload, STORE_ID))
+
+
+def check_columnar_matches_row_encoder(payload):
+    """Колоночная сериализация должна совпадать с построчным binary-кодировщиком"""
+    rows = [(item["date"], STORE_ID, item["advert_id"], item["app_type"],
+             item["nm_id"], safe_int(item["views"]), safe_int(item["clicks"]),
+             safe_float(item["ctr"]), safe_float(item["cpc"]),
+             safe_float(item["sum"]), safe_int(item["atbs"]),
+             safe_int(item["orders"]), safe_float(item["cr"]),
+             safe_int(item["shks"]), safe_float(item["sum_price"]))
+            for item in legacy_flatten(payload)]
+    expected = b"".join(ADVERT_STAT_ROWS.encode_row(row) for row in rows)
+    actual = b"".join(
+        data for data, _ in iter_advert_stat_copy_chunks(payload, STORE_ID))
+    assert actual == expected, "columnar COPY data differs from row encoder"
+
+
+def measure(func, payload) -> float:
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        func(payload)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main():
+    payload = make_payload()
+    rows_amount = ADVERTS_AMOUNT * DAYS_AMOUNT * len(APP_TYPES) * NM_PER_APP
+    check_columnar_matches_row_encoder(payload)
+
+    legacy = measure(run_legacy, payload)
+    columnar = measure(run_columnar, payload)
+
+    print(f"payload: {ADVERTS_AMOUNT} adverts x {DAYS_AMOUNT} days, "
+          f"{rows_amount} rows, best of {REPEATS}")
+    print(f"legacy (4 passes + csv):      {legacy * 1000:8.1f} ms")
+    print(f"columnar (1 pass + numpy):    {columnar * 1000:8.1f} ms")
+    print(f"speed-up: x{legacy / columnar:.1f}")
+
+
+if __name__ == "__main__":
+    main()